@@ -7,9 +7,10 @@ import os
 from dotenv import load_dotenv
 
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 
+from llm_registry import get_llm
+
 # 加载环境变量，例如 OPENAI_API_KEY
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -55,13 +56,9 @@ async def generate_character_description_with_langchain(prompt: str) -> Dict[str
             user_input=prompt,
         )
 
-        llm = ChatOpenAI(
-            api_key=openai_api_key,
-            model="gpt-4o-mini",
-            temperature=0.7,
-        )
+        llm = get_llm(temperature=0.7, api_key=openai_api_key)
 
-        llm_response = await llm.ainvoke(formatted_prompt)
+        llm_response = await llm.ainvoke(formatted_prompt, config={"metadata": {"llm_operation": "background"}})
         print("LLM raw response content:", llm_response.content)
 
         parsed_output = parser.parse(llm_response.content)
@@ -0,0 +1,362 @@
+# load_test.py
+"""
+多玩家并发压测：在数据库副本中复制出足够多的玩家角色，通过 /api/character_entered 进入游戏后，
+每个玩家连续发送 /api/chat 回合，并发数逐级提高。
+LLM调用走真实的 ChatOpenAI 客户端，指向本地的 OpenAI 兼容模拟服务（独立线程，延迟服从对数正态分布），
+Redis 使用 fakeredis。每一级输出：
+- 吞吐（回合/秒）、回合耗时 p50/p95/p99/max、错误率
+- 事件循环延迟（定时协程的实际醒来时间与预期之差）
+- 阻塞事件循环的同步调用：事件循环卡住时采样其调用栈，按后端代码中的调用位置汇总
+  （例如 redis_manager.py 中的同步Redis调用、databaseManager.py 中的SQLite调用）
+
+用法（backend目录下）:
+    python -m benchmark.load_test --concurrency 1,5,10,25 --turns 5 --llm-median-ms 800
+    python -m benchmark.load_test --llm-error-rate 0.02 --output load.json
+默认模拟服务与被测应用在同一进程中运行并争用GIL；高并发时可在另一个终端单独启动模拟服务：
+    python -m benchmark.load_test --serve-mock-llm 8100 --llm-median-ms 800
+    python -m benchmark.load_test --llm-base-url http://127.0.0.1:8100/v1
+"""
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import threading
+from collections import Counter
+from contextlib import redirect_stdout
+from typing import Dict, Any, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.offline import (
+    offline_backend, clone_player_characters, detect_operation, canned_reply, latency_distribution, DEFAULT_DB
+)
+from benchmark.turn_bench import DEFAULT_SCRIPT
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class MockLLMServer:
+    """
+    OpenAI 兼容的模拟服务（POST /v1/chat/completions），在独立线程的事件循环中运行，
+    因此不会被被测应用的阻塞调用拖慢。延迟服从对数正态分布（中位数 median_ms，形状 sigma），
+    error_rate 比例的请求返回 500（客户端会按自身配置重试）。
+    """
+    def __init__(self, median_ms: float, sigma: float, error_rate: float = 0.0, seed: int = 0):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._server: Optional[uvicorn.Server] = None
+        self._thread: Optional[threading.Thread] = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/v1/chat/completions")
+        async def chat_completions(body: Dict[str, Any]):
+            from prompt_budget import count_tokens
+            messages = body.get("messages", [])
+            system_text = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+            user_text = (messages[-1].get("content") or "") if messages else ""
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(self._random.lognormvariate(math.log(self.median_ms / 1000), self.sigma))
+                if self._random.random() < self.error_rate:
+                    self.errors += 1
+                    return JSONResponse(status_code=500, content={"error": {"message": "模拟的服务端错误"}})
+            finally:
+                self.in_flight -= 1
+            content = canned_reply(detect_operation(system_text), system_text, user_text)
+            prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+            completion_tokens = count_tokens(content)
+            return {
+                "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion",
+                "created": int(time.time()), "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens,
+                          "prompt_tokens_details": {"cached_tokens": 0}},
+            }
+
+        return app
+
+    def serve_forever(self, port: int):
+        """在当前进程中单独运行模拟服务（--serve-mock-llm）"""
+        uvicorn.run(self._app(), host="127.0.0.1", port=port, log_level="warning", lifespan="off")
+
+    def start(self) -> str:
+        """在后台线程中启动服务，返回 base_url"""
+        config = uvicorn.Config(self._app(), host="127.0.0.1", port=0, log_level="warning", lifespan="off")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, name="mock-llm", daemon=True)
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        port = self._server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/v1"
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    def stop(self):
+        if self._server:
+            self._server.should_exit = True
+            self._thread.join(timeout=5)
+
+
+class LoopMonitor:
+    """
+    事件循环健康监控：
+    - 协程每 interval 秒醒来一次，实际醒来时间比预期晚多少即为事件循环延迟
+    - 看门狗线程发现事件循环超过 block_threshold 秒没有醒来时，采样事件循环线程的调用栈，
+      记录后端代码中最内层的调用位置（以及最终卡在哪个库中）；每个样本约代表 sample_interval 秒的阻塞
+    """
+    def __init__(self, interval: float = 0.01, block_threshold: float = 0.05, sample_interval: float = 0.005):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.sample_interval = sample_interval
+        self._running = False
+        self._heartbeat = time.perf_counter()
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._loop_thread_id: Optional[int] = None
+        self.reset()
+
+    def reset(self):
+        self.lags_ms: List[float] = []
+        self.blocked: Counter = Counter()
+
+    async def start(self):
+        self._running = True
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.perf_counter()
+        self._task = asyncio.create_task(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._running = False
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._watchdog:
+            self._watchdog.join(timeout=1)
+
+    async def _tick(self):
+        while self._running:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self._heartbeat = now
+            self.lags_ms.append(max(0.0, now - expected) * 1000)
+
+    def _watch(self):
+        while self._running:
+            time.sleep(self.sample_interval)
+            if time.perf_counter() - self._heartbeat < self.interval + self.block_threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self.blocked[self._blocking_site(frame)] += 1
+
+    @staticmethod
+    def _blocking_site(frame) -> str:
+        """最内层的后端代码位置；如果最终卡在第三方库中，附上库名"""
+        innermost = frame
+        library = None
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename.startswith(BACKEND_DIR) and not filename.startswith(BENCHMARK_DIR):
+                site = f"{os.path.relpath(filename, BACKEND_DIR)}:{frame.f_lineno} {frame.f_code.co_name}"
+                return f"{site} -> {library}" if library else site
+            if library is None and "site-packages" in filename:
+                library = filename.split("site-packages" + os.sep, 1)[1].split(os.sep, 1)[0]
+            frame = frame.f_back
+        # 卡在事件循环自身调度的回调中（例如大量协程切换、响应解析），只显示最内层的库文件
+        filename = innermost.f_code.co_filename
+        for marker in ("site-packages" + os.sep, os.sep + "lib" + os.sep):
+            if marker in filename:
+                filename = filename.rsplit(marker, 1)[1]
+                break
+        return f"(事件循环回调) {filename}:{innermost.f_lineno} {innermost.f_code.co_name}"
+
+    def report(self, top: int = 8) -> Dict[str, Any]:
+        return {
+            "lag": latency_distribution(self.lags_ms),
+            "blocking_sites": [
+                {"site": site, "samples": samples, "blocked_ms": round(samples * self.sample_interval * 1000, 1)}
+                for site, samples in self.blocked.most_common(top)
+            ],
+        }
+
+
+async def _enter(client: httpx.AsyncClient, character_id: str, errors: Counter) -> Optional[str]:
+    response = await client.post("/api/character_entered", json={"character_id": character_id})
+    if response.status_code != 200:
+        errors[f"character_entered {response.status_code}"] += 1
+        return None
+    return response.json()["session_token"]
+
+
+async def _player(client: httpx.AsyncClient, session_token: str, script: List[str], turns: int, offset: int,
+                  timings: List[float], errors: Counter):
+    for turn in range(turns):
+        player_input = script[(offset + turn) % len(script)]
+        start = time.perf_counter()
+        try:
+            response = await client.post("/api/chat", json={"input": player_input, "session_token": session_token})
+            if response.status_code != 200:
+                errors[f"chat {response.status_code}"] += 1
+        except Exception as e:
+            errors[f"chat {type(e).__name__}"] += 1
+        timings.append((time.perf_counter() - start) * 1000)
+
+
+async def _run_level(client: httpx.AsyncClient, characters: List[str], concurrency: int, args,
+                     script: List[str], monitor: LoopMonitor, llm_server: MockLLMServer) -> Dict[str, Any]:
+    from metrics import metrics
+    errors: Counter = Counter()
+    # character_entered 会打印大量加载日志
+    with redirect_stdout(io.StringIO()):
+        tokens = await asyncio.gather(*[_enter(client, character_id, errors) for character_id in characters[:concurrency]])
+
+    metrics.reset()
+    monitor.reset()
+    llm_server.reset_stats()
+    timings: List[float] = []
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _player(client, token, script, args.turns, index, timings, errors)
+        for index, token in enumerate(tokens) if token
+    ])
+    elapsed = time.perf_counter() - started
+
+    snapshot = metrics.snapshot()
+    turn_errors = sum(count for key, count in errors.items() if key.startswith("chat"))
+    loop_report = monitor.report()
+    return {
+        "concurrency": concurrency,
+        "turns": len(timings),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_turns_per_s": round(len(timings) / elapsed, 2) if elapsed else 0.0,
+        "turn": latency_distribution(timings),
+        "error_rate": round(turn_errors / len(timings), 4) if timings else 0.0,
+        "errors": dict(errors),
+        "event_loop_lag": loop_report["lag"],
+        "blocking_sites": loop_report["blocking_sites"],
+        # 使用外部模拟服务时没有服务端计数
+        "llm": {**({"requests": llm_server.requests, "server_errors": llm_server.errors,
+                    "max_in_flight": llm_server.max_in_flight} if llm_server.running else {}),
+                **{k: v for k, v in snapshot["dependencies"].items() if k.startswith("llm/")}},
+        "nodes": snapshot["nodes"],
+    }
+
+
+async def run(args) -> List[Dict[str, Any]]:
+    levels = sorted({int(level) for level in args.concurrency.split(",") if level.strip()})
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = [line.strip() for line in f if line.strip()]
+
+    llm_server = MockLLMServer(args.llm_median_ms, args.llm_sigma, args.llm_error_rate, args.seed)
+    os.environ["OPENAI_BASE_URL"] = args.llm_base_url or llm_server.start()
+    monitor = LoopMonitor(args.lag_interval_ms / 1000, args.block_threshold_ms / 1000)
+    results = []
+    try:
+        async with offline_backend(None, os.path.abspath(args.db)) as app:
+            from llm_cache import llm_cache
+            llm_cache.enabled = llm_cache.enabled and not args.no_llm_cache
+            characters = clone_player_characters(max(levels))
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=None) as client:
+                # 预热：首次调用时的模块初始化、连接建立不计入任何一级
+                with redirect_stdout(io.StringIO()):
+                    warmup_token = await _enter(client, characters[0], Counter())
+                await _player(client, warmup_token, script, 1, 0, [], Counter())
+                await monitor.start()
+                try:
+                    for concurrency in levels:
+                        result = await _run_level(client, characters, concurrency, args, script, monitor, llm_server)
+                        results.append(result)
+                        _print_level(result)
+                finally:
+                    await monitor.stop()
+    finally:
+        llm_server.stop()
+    return results
+
+
+def _print_level(result: Dict[str, Any]):
+    turn, lag = result["turn"], result["event_loop_lag"]
+    print(f"\n并发 {result['concurrency']}: {result['turns']} 回合 / {result['elapsed_s']}s, "
+          f"吞吐 {result['throughput_turns_per_s']} 回合/s, 错误率 {result['error_rate']:.2%}")
+    print(f"  回合耗时(ms)   p50 {turn.get('p50_ms', 0):.0f}  p95 {turn.get('p95_ms', 0):.0f}  "
+          f"p99 {turn.get('p99_ms', 0):.0f}  max {turn.get('max_ms', 0):.0f}")
+    print(f"  事件循环延迟(ms) p50 {lag.get('p50_ms', 0):.1f}  p99 {lag.get('p99_ms', 0):.1f}  max {lag.get('max_ms', 0):.1f}")
+    if "requests" in result["llm"]:
+        print(f"  LLM请求 {result['llm']['requests']}（服务端错误 {result['llm']['server_errors']}，"
+              f"最大并发 {result['llm']['max_in_flight']}）")
+    if result["errors"]:
+        print(f"  错误: {result['errors']}")
+    for site in result["blocking_sites"]:
+        print(f"  阻塞 {site['blocked_ms']:>8.1f}ms  {site['site']}")
+
+
+def _print_summary(results: List[Dict[str, Any]]):
+    print(f"\n{'并发':>6} {'吞吐/s':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'错误率':>8} {'循环延迟p99':>12} {'循环延迟max':>12}")
+    for r in results:
+        print(f"{r['concurrency']:>6} {r['throughput_turns_per_s']:>8.2f} {r['turn'].get('p50_ms', 0):>9.0f} "
+              f"{r['turn'].get('p95_ms', 0):>9.0f} {r['turn'].get('p99_ms', 0):>9.0f} {r['error_rate']:>8.2%} "
+              f"{r['event_loop_lag'].get('p99_ms', 0):>12.1f} {r['event_loop_lag'].get('max_ms', 0):>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/api/chat 多玩家并发压测")
+    parser.add_argument("--db", default=DEFAULT_DB, help="源数据库路径（会复制后再测试）")
+    parser.add_argument("--concurrency", default="1,5,10,25", help="逐级测试的并发玩家数，逗号分隔")
+    parser.add_argument("--turns", type=int, default=5, help="每个玩家连续发送的回合数")
+    parser.add_argument("--script", help="玩家输入脚本，每行一条")
+    parser.add_argument("--llm-median-ms", type=float, default=800.0, help="模拟LLM延迟的中位数")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="模拟LLM延迟对数正态分布的形状参数（越大长尾越重）")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="模拟LLM返回500的比例")
+    parser.add_argument("--llm-base-url", help="使用已启动的模拟服务（或其他OpenAI兼容服务），不在进程内启动")
+    parser.add_argument("--serve-mock-llm", type=int, metavar="PORT", help="只在指定端口运行模拟服务")
+    parser.add_argument("--no-llm-cache", action="store_true", help="关闭LLM响应缓存")
+    parser.add_argument("--lag-interval-ms", type=float, default=10.0)
+    parser.add_argument("--block-threshold-ms", type=float, default=50.0, help="事件循环卡住多久开始采样调用栈")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="把结果保存为JSON")
+    args = parser.parse_args()
+
+    if args.serve_mock_llm:
+        MockLLMServer(args.llm_median_ms, args.llm_sigma, args.llm_error_rate, args.seed).serve_forever(args.serve_mock_llm)
+        sys.exit(0)
+    results = asyncio.run(run(args))
+    _print_summary(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
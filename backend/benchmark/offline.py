@@ -0,0 +1,327 @@
+# offline.py
+"""
+离线运行后端所需的替身，供基准测试使用：不访问网络，也不修改仓库中的 database.db / chroma_db。
+- DeterministicChatModel: 替代 ChatOpenAI 的确定性模型，按调用类型返回预设JSON，延迟可配置
+- install_fake_llm: 让 llm_registry.get_llm 返回同一个替身模型
+- install_fake_redis: 用 fakeredis 替换 redis_manager 的同步/异步客户端（仍经过耗时统计）
+- install_local_memory_store: NPC长期记忆改用内存中的ChromaDB集合和本地哈希向量
+- use_database_copy: 在 database.db 的临时副本上运行
+- offline_backend: 安装以上全部替身并执行 main.py 的启动/关闭流程
+本模块会设置离线运行需要的环境变量，需在导入任何后端模块之前导入。
+"""
+
+import io
+import os
+import atexit
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import statistics
+from contextlib import asynccontextmanager, redirect_stdout
+from typing import Dict, Any, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("LLM_WARMUP", "false")
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# 基准测试需要完整的样本来计算分位数
+os.environ.setdefault("METRICS_QUANTILE_WINDOW", "100000")
+# 记忆管理器导入时会打开持久化的ChromaDB目录，改到临时目录
+if not os.getenv("CHROMA_PERSIST_DIRECTORY"):
+    os.environ["CHROMA_PERSIST_DIRECTORY"] = tempfile.mkdtemp(prefix="trpg_bench_chroma_")
+    atexit.register(shutil.rmtree, os.environ["CHROMA_PERSIST_DIRECTORY"], True)
+
+import redis
+import redis.asyncio
+import fakeredis
+import fakeredis.aioredis
+import chromadb
+from pydantic import Field
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatResult, ChatGeneration
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "database.db")
+
+# 没有 llm_operation 元数据时，按system消息中的标志文字判断调用类型
+_OPERATION_MARKERS = (
+    ("指令解析器", "intent_parse"),
+    ("事件判断器", "soft_event_check"),
+    ("回合规划器", "turn_plan"),
+    ("NPC筛选器", "npc_filter"),
+    ("记忆压缩专家", "memory_compress"),
+    ("你将扮演", "npc_reaction"),
+)
+_PROMPT_NPC_ID_RE = re.compile(r"\(id: ([^)]+)\)")
+_SELECTION_NPC_ID_RE = re.compile(r'"id": "([^"]+)"')
+
+
+def _digest(*parts: str) -> int:
+    return int(hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()[:12], 16)
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def latency_distribution(samples_ms: List[float]) -> Dict[str, float]:
+    """耗时样本(ms)的均值、分位数和最大值，字段名与 metrics 的 snapshot 一致"""
+    samples = sorted(samples_ms)
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "avg_ms": round(statistics.fmean(samples), 2),
+        "p50_ms": round(_percentile(samples, 0.5), 2),
+        "p95_ms": round(_percentile(samples, 0.95), 2),
+        "p99_ms": round(_percentile(samples, 0.99), 2),
+        "max_ms": round(samples[-1], 2),
+    }
+
+
+def _message_text(message) -> str:
+    content = getattr(message, 'content', message)
+    return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+
+
+def detect_operation(system_text: str) -> str:
+    for marker, operation in _OPERATION_MARKERS:
+        if marker in system_text:
+            return operation
+    return "default"
+
+
+def _rotate(ids: List[str], pick: int, count: int) -> List[str]:
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    start = pick % len(ids)
+    return (ids[start:] + ids[:start])[:count]
+
+
+def _intent(system_text: str, user_text: str, pick: int) -> Dict[str, Any]:
+    npc_ids = _PROMPT_NPC_ID_RE.findall(system_text.split("NPC: [", 1)[-1].split("]", 1)[0])
+    if npc_ids:
+        return {"intent": "talk", "target": npc_ids[pick % len(npc_ids)], "topic": user_text[-20:]}
+    return {"intent": "inspect", "target": user_text[-20:]}
+
+
+def canned_reply(operation: str, system_text: str, user_text: str, seed: int = 0,
+                 responses: Optional[Dict[str, Any]] = None) -> str:
+    """
+    各类调用的预设回复，由提示词决定，与调用顺序无关。
+    responses 可按调用类型（intent_parse、npc_reaction 等）覆盖，值为字符串或JSON对象。
+    """
+    if responses and operation in responses:
+        reply = responses[operation]
+        return reply if isinstance(reply, str) else json.dumps(reply, ensure_ascii=False)
+    pick = _digest(str(seed), user_text)
+
+    if operation == "intent_parse":
+        return json.dumps(_intent(system_text, user_text, pick), ensure_ascii=False)
+    if operation == "npc_filter":
+        return json.dumps({"selected_npc_ids": _rotate(_SELECTION_NPC_ID_RE.findall(system_text), pick, 2),
+                           "reasoning": "离线基准"}, ensure_ascii=False)
+    if operation == "turn_plan":
+        selected = []
+        if "选择需要做出反应的NPC" in system_text:
+            selection_text = system_text.split("选择需要做出反应的NPC", 1)[1]
+            selected = _rotate(_SELECTION_NPC_ID_RE.findall(selection_text), pick, 2)
+        return json.dumps({"player_action": _intent(system_text, user_text, pick),
+                           "selected_npc_ids": selected, "soft_event": None}, ensure_ascii=False)
+    if operation == "soft_event_check":
+        return json.dumps({"should_trigger": False, "reason": "离线基准"}, ensure_ascii=False)
+    if operation == "npc_reaction":
+        visibility = "private" if pick % 4 == 0 else "public"
+        return json.dumps({"visibility": visibility, "dialogue": "我注意到了。", "action": "看了看四周",
+                           "new_status": "警觉", "new_goal": "观察局势"}, ensure_ascii=False)
+    if operation == "memory_compress":
+        return "离线基准生成的记忆摘要。"
+    return "{}"
+
+
+class DeterministicChatModel(BaseChatModel):
+    """
+    确定性的本地模型：同样的提示词总是得到同样的回复和同样的延迟。
+    延迟 = latency_ms + [0, jitter_ms) 内由提示词哈希决定的抖动；回复见 canned_reply。
+    """
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    seed: int = 0
+    responses: Dict[str, Any] = Field(default_factory=dict)
+    call_counts: Dict[str, int] = Field(default_factory=dict)
+
+    @property
+    def _llm_type(self) -> str:
+        return "deterministic-offline"
+
+    def _operation(self, messages, run_manager) -> str:
+        metadata = getattr(run_manager, 'metadata', None) or {}
+        if metadata.get("llm_operation"):
+            return metadata["llm_operation"]
+        return detect_operation(_message_text(messages[0]) if messages else "")
+
+    def _delay(self, prompt: str) -> float:
+        jitter = random.Random(_digest(str(self.seed), prompt)).random() * self.jitter_ms
+        return (self.latency_ms + jitter) / 1000
+
+    def _reply(self, operation: str, messages) -> str:
+        system_text = _message_text(messages[0]) if messages else ""
+        user_text = _message_text(messages[-1]) if messages else ""
+        return canned_reply(operation, system_text, user_text, self.seed, self.responses)
+
+    def _result(self, operation: str, messages) -> ChatResult:
+        from prompt_budget import count_message_tokens, count_tokens
+        content = self._reply(operation, messages)
+        input_tokens = count_message_tokens(messages)
+        output_tokens = count_tokens(content)
+        message = AIMessage(content=content, usage_metadata={
+            "input_tokens": input_tokens, "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        })
+        self.call_counts[operation] = self.call_counts.get(operation, 0) + 1
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        operation = self._operation(messages, run_manager)
+        # 同步调用与真实客户端一样阻塞当前线程
+        time.sleep(self._delay("".join(_message_text(m) for m in messages)))
+        return self._result(operation, messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        operation = self._operation(messages, run_manager)
+        await asyncio.sleep(self._delay("".join(_message_text(m) for m in messages)))
+        return self._result(operation, messages)
+
+
+class _HashEmbedding(chromadb.EmbeddingFunction):
+    """把字符二元组哈希到固定维度的本地向量，不需要下载嵌入模型"""
+    def __init__(self, dimensions: int = 64):
+        self.dimensions = dimensions
+
+    def __call__(self, input):
+        vectors = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for i in range(max(1, len(text) - 1)):
+                vector[_digest(text[i:i + 2]) % self.dimensions] += 1.0
+            norm = sum(v * v for v in vector) ** 0.5 or 1.0
+            vectors.append([v / norm for v in vector])
+        return vectors
+
+
+def install_fake_llm(model: DeterministicChatModel):
+    """所有 get_llm 调用都返回同一个替身模型（挂上与真实客户端相同的指标回调）"""
+    from llm_registry import llm_registry
+    from metrics import llm_metrics_handler
+    if llm_metrics_handler not in (model.callbacks or []):
+        model.callbacks = list(model.callbacks or []) + [llm_metrics_handler]
+    llm_registry.get_llm = lambda *args, **kwargs: model
+
+
+def install_fake_redis() -> fakeredis.FakeServer:
+    """redis_manager 的同步/异步客户端改为同一个 fakeredis 服务端；返回该服务端"""
+    from redis_manager import redis_manager, InstrumentedRedis, AsyncInstrumentedRedis
+    from memory_manager import memory_manager
+
+    server = fakeredis.FakeServer()
+    redis_manager._client = InstrumentedRedis(connection_pool=redis.ConnectionPool(
+        connection_class=fakeredis.FakeConnection, server=server, decode_responses=True))
+    redis_manager._async_pool = redis.asyncio.ConnectionPool(
+        connection_class=fakeredis.aioredis.FakeConnection, server=server, decode_responses=True,
+        max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)))
+    redis_manager._async_client = AsyncInstrumentedRedis(connection_pool=redis_manager._async_pool)
+    redis_manager._is_connected = True
+    # main.py 启动时会调用 initialize()，这里保持替身不被真实连接覆盖
+    redis_manager.initialize = lambda *args, **kwargs: None
+    # 记忆管理器的同步客户端不解码响应，与其默认配置一致
+    memory_manager.redis_client = redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=fakeredis.FakeConnection, server=server))
+    return server
+
+
+def install_local_memory_store():
+    """NPC长期记忆改用内存中的集合，避免写入仓库的 chroma_db 和下载嵌入模型"""
+    from memory_manager import memory_manager
+    memory_manager.client = chromadb.EphemeralClient()
+    memory_manager.npc_memories = memory_manager.client.get_or_create_collection(
+        name="npc_memories", embedding_function=_HashEmbedding())
+
+
+def use_database_copy(source: str = DEFAULT_DB) -> str:
+    """把 database.db 复制到临时目录并让 db_manager 使用该副本；返回副本所在目录"""
+    from databaseManager import db_manager
+    work_dir = tempfile.mkdtemp(prefix="trpg_bench_")
+    copy_path = os.path.join(work_dir, "database.db")
+    shutil.copy(source, copy_path)
+    db_manager.db_path = copy_path
+    return work_dir
+
+
+def clone_player_characters(count: int) -> List[str]:
+    """在数据库副本中复制出 count 个玩家角色（角色卡各表逐行复制），返回新角色ID"""
+    from databaseManager import db_manager, CHARACTER_SHEET_TABLES
+    template_id = player_character_ids()[0]
+    columns = {
+        table: [col['name'] for col in db_manager.execute_query("SELECT name FROM pragma_table_info(?)", (table,))]
+        for table in CHARACTER_SHEET_TABLES.values()
+    }
+    new_ids = []
+    for index in range(count):
+        new_id = hashlib.sha256(f"bench-player-{index}".encode("utf-8")).hexdigest()
+        for table, table_columns in columns.items():
+            key = 'id' if table == 'characters' else 'character_id'
+            values = ", ".join("?" if col == key else f'"{col}"' for col in table_columns)
+            names = ", ".join(f'"{col}"' for col in table_columns)
+            db_manager.execute_query(
+                f"INSERT OR REPLACE INTO {table} ({names}) SELECT {values} FROM {table} WHERE {key} = ?",
+                (new_id, template_id))
+        new_ids.append(new_id)
+    return new_ids
+
+
+def player_character_ids() -> List[str]:
+    from databaseManager import db_manager
+    return [row['id'] for row in db_manager.execute_query("SELECT id FROM characters WHERE if_npc = 0 ORDER BY id") or []]
+
+
+async def enter_character(character_id: str) -> str:
+    """调用 /api/character_entered 的处理函数，返回会话令牌"""
+    from character import handle_character_entered, CharacterIdRequest
+    with redirect_stdout(io.StringIO()):
+        result = await handle_character_entered(CharacterIdRequest(character_id=character_id))
+    return result["session_token"]
+
+
+@asynccontextmanager
+async def offline_backend(model: Optional[DeterministicChatModel], db_source: str = DEFAULT_DB):
+    """
+    安装全部替身并运行 main.py 的 lifespan；退出时删除数据库副本。
+    model 为 None 时保留真实的 ChatOpenAI 客户端（例如指向 OPENAI_BASE_URL 上的模拟服务）。
+    """
+    with redirect_stdout(io.StringIO()):
+        import main
+    if model is not None:
+        install_fake_llm(model)
+    install_fake_redis()
+    install_local_memory_store()
+    work_dir = use_database_copy(db_source)
+    try:
+        with redirect_stdout(io.StringIO()):
+            lifespan = main.lifespan(main.app)
+            await lifespan.__aenter__()
+        try:
+            yield main.app
+        finally:
+            with redirect_stdout(io.StringIO()):
+                await lifespan.__aexit__(None, None, None)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,93 @@
+# sqlite_bench.py
+"""
+SQLite 访问方式的微基准：每次查询新建连接（旧行为） vs 每线程长连接 + WAL + 语句缓存。
+在数据库副本上运行，不会修改仓库中的 database.db。
+
+用法（backend目录下）:
+    python -m benchmark.sqlite_bench --iterations 2000
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from databaseManager import DatabaseManager
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "database.db")
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def _measure(func: Callable[[], object], iterations: int, warmup: int = 20) -> Dict[str, float]:
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1_000_000)
+    samples.sort()
+    return {
+        "mean_us": statistics.fmean(samples),
+        "p50_us": _percentile(samples, 0.5),
+        "p95_us": _percentile(samples, 0.95),
+        "p99_us": _percentile(samples, 0.99),
+    }
+
+
+def _workloads(db: DatabaseManager, character_id: str, object_id: int, npc_id: str) -> Dict[str, Callable[[], object]]:
+    return {
+        "object_name": lambda: db.execute_query(
+            "SELECT object_name FROM interactable_objects WHERE object_id = ?", (object_id,)),
+        "events_on_map": lambda: db.execute_query(
+            "SELECT * FROM events WHERE map_id = ?", (1,)),
+        "get_character_data": lambda: db.get_character_data(character_id),
+        "update_npc_state": lambda: db.update_npc_state(npc_id, new_status="正常"),
+    }
+
+
+def run(db_path: str, iterations: int):
+    work_dir = tempfile.mkdtemp(prefix="sqlite_bench_")
+    try:
+        results = {}
+        for label, persistent in (("per_query_connect", False), ("pooled_wal", True)):
+            # 两种模式各用一份独立副本，避免WAL设置影响对照组
+            copy_path = os.path.join(work_dir, f"{label}.db")
+            shutil.copy(db_path, copy_path)
+            db = DatabaseManager(copy_path, persistent=persistent)
+            character_id = db.execute_query("SELECT id FROM characters WHERE if_npc = 0 LIMIT 1")[0]['id']
+            npc_id = db.execute_query("SELECT id FROM characters WHERE if_npc = 1 LIMIT 1")[0]['id']
+            object_id = db.execute_query("SELECT object_id FROM interactable_objects LIMIT 1")[0]['object_id']
+            results[label] = {
+                name: _measure(func, iterations)
+                for name, func in _workloads(db, character_id, object_id, npc_id).items()
+            }
+            db.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'workload':<20} {'mode':<18} {'mean(us)':>10} {'p50(us)':>10} {'p95(us)':>10} {'p99(us)':>10}")
+    for name in results["per_query_connect"]:
+        for label in results:
+            r = results[label][name]
+            print(f"{name:<20} {label:<18} {r['mean_us']:>10.1f} {r['p50_us']:>10.1f} {r['p95_us']:>10.1f} {r['p99_us']:>10.1f}")
+        speedup = results["per_query_connect"][name]["mean_us"] / results["pooled_wal"][name]["mean_us"]
+        print(f"{'':<20} {'speedup':<18} {speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLite 连接方式微基准")
+    parser.add_argument("--db", default=DEFAULT_DB, help="源数据库路径（会复制后再测试）")
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+    run(os.path.abspath(args.db), args.iterations)
@@ -0,0 +1,152 @@
+# turn_bench.py
+"""
+完整回合的离线基准：用确定性替身模型代替 ChatOpenAI，在 fakeredis 和 database.db 副本上
+按脚本依次运行若干局游戏（character_entered + 多个 /api/chat 回合），
+输出回合总耗时以及每个LangGraph节点、每类依赖调用的耗时分布。不需要网络。
+
+用法（backend目录下）:
+    python -m benchmark.turn_bench --sessions 5 --llm-latency-ms 300 --llm-jitter-ms 200
+    python -m benchmark.turn_bench --output baseline.json          # 保存结果
+    python -m benchmark.turn_bench --baseline baseline.json        # 与保存的结果对比
+    python -m benchmark.turn_bench --script turns.txt --responses responses.json
+--script 每行一条玩家输入；--responses 为 {调用类型: 回复} 的JSON，覆盖替身模型的默认回复
+（调用类型: intent_parse, npc_filter, turn_plan, soft_event_check, npc_reaction, memory_compress）。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.offline import (
+    DeterministicChatModel, offline_backend, enter_character, player_character_ids, latency_distribution, DEFAULT_DB
+)
+
+DEFAULT_SCRIPT = [
+    "你好",
+    "大家好，这里发生了什么？",
+    "检查吧台",
+    "问问杰克最近有没有见过奇怪的人",
+    "我想仔细观察这个挂坠",
+    "我要去加油站",
+    "我要回阿卡姆",
+]
+
+
+async def _play_session(character_id: str, script: List[str], timings: List[float], errors: List[str]):
+    from fastapi import HTTPException
+    from graph import chat_endpoint, ChatRequest
+    session_token = await enter_character(character_id)
+    for player_input in script:
+        start = time.perf_counter()
+        try:
+            await chat_endpoint(ChatRequest(input=player_input, session_token=session_token))
+        except HTTPException as e:
+            errors.append(f"{player_input}: {e.detail}")
+        timings.append((time.perf_counter() - start) * 1000)
+
+
+async def run(args) -> Dict[str, Any]:
+    random.seed(args.seed)
+    responses = {}
+    if args.responses:
+        with open(args.responses, encoding="utf-8") as f:
+            responses = json.load(f)
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = [line.strip() for line in f if line.strip()]
+
+    model = DeterministicChatModel(latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms,
+                                   seed=args.seed, responses=responses)
+    async with offline_backend(model, os.path.abspath(args.db)):
+        from metrics import metrics
+        from llm_cache import llm_cache
+        characters = player_character_ids()
+        if not characters:
+            raise SystemExit("数据库中没有玩家角色")
+
+        # 预热：首次导入、编译和连接建立不计入结果
+        await _play_session(characters[0], script[:args.warmup_turns], [], [])
+        metrics.reset()
+        model.call_counts.clear()
+
+        timings, errors = [], []
+        started = time.perf_counter()
+        for session in range(args.sessions):
+            await _play_session(characters[session % len(characters)], script, timings, errors)
+        elapsed = time.perf_counter() - started
+
+        snapshot = metrics.snapshot()
+        return {
+            "config": {"sessions": args.sessions, "turns_per_session": len(script), "seed": args.seed,
+                       "llm_latency_ms": args.llm_latency_ms, "llm_jitter_ms": args.llm_jitter_ms},
+            "elapsed_s": round(elapsed, 3),
+            "turn": latency_distribution(timings),
+            "errors": errors,
+            "nodes": snapshot["nodes"],
+            "dependencies": snapshot["dependencies"],
+            "llm_calls": dict(sorted(model.call_counts.items())),
+            "llm_cache": llm_cache.get_stats(),
+            "prompt_cache": snapshot["prompt_cache"],
+        }
+
+
+def _print_table(title: str, rows: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]] = None):
+    print(f"\n{title}")
+    print(f"{'name':<34} {'count':>6} {'avg(ms)':>10} {'p50(ms)':>10} {'p95(ms)':>10} {'p99(ms)':>10} {'max(ms)':>10}"
+          + (f" {'Δp50':>8} {'Δp95':>8}" if baseline is not None else ""))
+    for name, r in sorted(rows.items()):
+        line = (f"{name:<34} {r.get('count', 0):>6} {r.get('avg_ms', 0):>10.1f} {r.get('p50_ms', 0):>10.1f} "
+                f"{r.get('p95_ms', 0):>10.1f} {r.get('p99_ms', 0):>10.1f} {r.get('max_ms', 0):>10.1f}")
+        if baseline is not None:
+            base = baseline.get(name)
+            for q in ("p50_ms", "p95_ms"):
+                if base and base.get(q):
+                    line += f" {(r.get(q, 0) - base[q]) / base[q] * 100:>+7.1f}%"
+                else:
+                    line += f" {'-':>8}"
+        print(line)
+
+
+def report(result: Dict[str, Any], baseline: Dict[str, Any] = None):
+    config = result["config"]
+    print(f"{config['sessions']} 局 x {config['turns_per_session']} 回合, 模型延迟 {config['llm_latency_ms']}ms"
+          f" + 抖动 {config['llm_jitter_ms']}ms, 总耗时 {result['elapsed_s']}s, 错误 {len(result['errors'])}")
+    _print_table("回合总耗时", {"chat": result["turn"]}, {"chat": baseline["turn"]} if baseline else None)
+    _print_table("LangGraph节点", result["nodes"], baseline["nodes"] if baseline else None)
+    _print_table("依赖调用", result["dependencies"], baseline["dependencies"] if baseline else None)
+    print("\nLLM调用次数:", result["llm_calls"])
+    for error in result["errors"]:
+        print("错误:", error)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="完整回合的离线基准")
+    parser.add_argument("--db", default=DEFAULT_DB, help="源数据库路径（会复制后再测试）")
+    parser.add_argument("--sessions", type=int, default=3, help="依次运行的游戏局数")
+    parser.add_argument("--script", help="玩家输入脚本，每行一条")
+    parser.add_argument("--warmup-turns", type=int, default=2)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--responses", help="覆盖替身模型默认回复的JSON文件")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="把结果保存为JSON")
+    parser.add_argument("--baseline", help="与之前 --output 保存的结果对比")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
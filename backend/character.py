@@ -1,7 +1,7 @@
 # character.py
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from character_state import set_current_character_id
+from character_state import create_session
 from databaseManager import db_manager
 from redis_manager import (
     save_character_sheet, 
@@ -24,7 +24,6 @@ async def handle_character_entered(request: CharacterIdRequest):
     """
     try:
         character_id = request.character_id
-        set_current_character_id(character_id)
         
         # 0. 先更新数据库中的位置和载具信息
         update_query = "UPDATE characters SET current_location_id = ?, current_vehicle_id = ? WHERE id = ?"
@@ -77,12 +76,14 @@ async def handle_character_entered(request: CharacterIdRequest):
         print(f"已保存地图状态到Redis: map_id={current_map_id}, map_state={map_state}")
         
         # 为地图上的每个NPC也创建初始session_state (如果不存在)
+        # 所有NPC的角色卡一次批量读取
+        npc_sheets = db_manager.get_character_data_many([npc['id'] for npc in npcs_on_map])
         for npc in npcs_on_map:
             npc_id = npc['id']
             print(f"处理地图NPC: {npc_id}")
             
             # 确保NPC的完整数据保存到Redis
-            npc_sheet = db_manager.get_character_data(npc_id)
+            npc_sheet = npc_sheets.get(npc_id)
             if npc_sheet:
                 print(f"保存NPC {npc_id} 的完整数据到Redis")
                 save_character_sheet(npc_id, npc_sheet)
@@ -106,7 +107,14 @@ async def handle_character_entered(request: CharacterIdRequest):
 
         print(f"角色 {character_id} 和地图 {current_map_id} 的所有动态状态已加载到Redis")
         
-        return {"status": "success", "message": "所有状态已成功加载到Redis", "map_state_counts": {"npcs": len(npcs_on_map), "objects": len(objects_on_map)}}
+        # 状态就绪后再创建会话，之后的 /chat 请求通过令牌定位到该角色
+        session_token = create_session(character_id)
+        
+        return {
+            "status": "success", "message": "所有状态已成功加载到Redis",
+            "session_token": session_token,
+            "map_state_counts": {"npcs": len(npcs_on_map), "objects": len(objects_on_map)}
+        }
         
     except Exception as e:
         import traceback
@@ -1,23 +1,166 @@
 # character_state.py
 """
-角色状态管理模块
-用于在不同模块间共享角色信息
+角色会话管理模块
+每个玩家进入游戏时获得一个会话令牌 (session token)，令牌 -> 角色ID 的映射保存在进程内并写入Redis。
+不同会话的回合可以并行执行；同一角色的回合通过回合锁串行化，避免状态的读取和写回交错。
+进程内的令牌与Redis中的副本一样在 SESSION_TTL 秒后过期；回合锁在没有回合持有或等待时自动释放。
 """
 
-# 全局变量存储当前角色ID
+import time
+import asyncio
+import secrets
+import weakref
+from typing import Dict, Optional, Tuple
+
+from log_manager import get_logger
+
+logger = get_logger("character_state")
+
+SESSION_KEY_PREFIX = "session_token:"
+SESSION_TTL = 86400
+
+# 会话令牌 -> (角色ID, 过期时间 time.monotonic())
+_sessions: Dict[str, Tuple[str, float]] = {}
+# 角色ID -> 回合锁；只要有回合持有或等待锁就存在引用，空闲的锁随之回收
+_turn_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# 兼容未携带会话令牌的旧客户端：最近一次进入游戏的角色ID
 _current_character_id = None
 
+def _get_redis():
+    from redis_manager import get_redis_client
+    return get_redis_client()
+
+def _remember_session(session_token: str, character_id: str, ttl: float = SESSION_TTL):
+    _sessions[session_token] = (character_id, time.monotonic() + ttl)
+
+def _cached_session(session_token: str) -> Optional[str]:
+    """进程内的令牌映射；已过期的条目顺便删除"""
+    cached = _sessions.get(session_token)
+    if not cached:
+        return None
+    character_id, expires_at = cached
+    if expires_at > time.monotonic():
+        return character_id
+    del _sessions[session_token]
+    return None
+
+def _purge_expired_sessions():
+    now = time.monotonic()
+    for session_token in [token for token, (_, expires_at) in _sessions.items() if expires_at <= now]:
+        del _sessions[session_token]
+
+def create_session(character_id: str) -> str:
+    """
+    为角色创建新的会话令牌
+    """
+    global _current_character_id
+    _purge_expired_sessions()
+    session_token = secrets.token_urlsafe(24)
+    _remember_session(session_token, character_id)
+    _current_character_id = character_id
+    try:
+        redis_client = _get_redis()
+        if redis_client:
+            redis_client.set(f"{SESSION_KEY_PREFIX}{session_token}", character_id, ex=SESSION_TTL)
+    except Exception as e:
+        logger.warning("保存会话令牌到Redis失败: %s", e)
+    logger.info("已为角色 %s 创建会话", character_id)
+    return session_token
+
+def get_session_character_id(session_token: str) -> Optional[str]:
+    """
+    根据会话令牌获取角色ID；进程内未命中时回退到Redis（例如服务重启后）
+    """
+    if not session_token:
+        return None
+    character_id = _cached_session(session_token)
+    if character_id:
+        return character_id
+    key = f"{SESSION_KEY_PREFIX}{session_token}"
+    try:
+        redis_client = _get_redis()
+        if not redis_client:
+            return None
+        character_id = redis_client.get(key)
+        # 进程内副本沿用Redis中剩余的有效期
+        ttl = redis_client.ttl(key) if character_id else -1
+    except Exception as e:
+        logger.warning("从Redis读取会话令牌失败: %s", e)
+        return None
+    if character_id:
+        _remember_session(session_token, character_id, ttl if ttl > 0 else SESSION_TTL)
+    return character_id
+
+async def aget_session_character_id(session_token: str) -> Optional[str]:
+    """get_session_character_id 的异步版本：进程内未命中时用异步Redis客户端回退查找"""
+    if not session_token:
+        return None
+    character_id = _cached_session(session_token)
+    if character_id:
+        return character_id
+    key = f"{SESSION_KEY_PREFIX}{session_token}"
+    try:
+        from redis_manager import get_async_redis_client
+        redis_client = get_async_redis_client()
+        if not redis_client:
+            return None
+        character_id = await redis_client.get(key)
+        ttl = await redis_client.ttl(key) if character_id else -1
+    except Exception as e:
+        logger.warning("从Redis读取会话令牌失败: %s", e)
+        return None
+    if character_id:
+        _remember_session(session_token, character_id, ttl if ttl > 0 else SESSION_TTL)
+    return character_id
+
+async def aresolve_character_id(session_token: Optional[str] = None) -> Optional[str]:
+    """resolve_character_id 的异步版本，供请求处理函数使用"""
+    if session_token:
+        return await aget_session_character_id(session_token)
+    return _current_character_id
+
+def resolve_character_id(session_token: Optional[str] = None) -> Optional[str]:
+    """
+    解析本次请求对应的角色ID。携带令牌时只按令牌查找；
+    未携带令牌时使用最近一次进入游戏的角色（单人模式兼容）。
+    """
+    if session_token:
+        return get_session_character_id(session_token)
+    return _current_character_id
+
+def end_session(session_token: str):
+    """
+    结束会话
+    """
+    _sessions.pop(session_token, None)
+    try:
+        redis_client = _get_redis()
+        if redis_client:
+            redis_client.delete(f"{SESSION_KEY_PREFIX}{session_token}")
+    except Exception as e:
+        logger.warning("从Redis删除会话令牌失败: %s", e)
+
+def get_turn_lock(character_id: str) -> asyncio.Lock:
+    """
+    获取角色的回合锁：同一角色的回合串行执行，不同角色之间互不阻塞
+    """
+    lock = _turn_locks.get(character_id)
+    if lock is None:
+        lock = _turn_locks[character_id] = asyncio.Lock()
+    return lock
+
 def set_current_character_id(character_id: str):
     """
-    设置当前角色ID
+    设置当前角色ID（单人模式兼容）
     """
     global _current_character_id
     _current_character_id = character_id
-    print(f"角色状态已更新: {character_id}")
+    logger.info("角色状态已更新: %s", character_id)
 
 def get_current_character_id() -> str:
     """
-    获取当前角色ID
+    获取当前角色ID（单人模式兼容）
     """
     return _current_character_id
 
@@ -27,7 +170,7 @@ def clear_current_character_id():
     """
     global _current_character_id
     _current_character_id = None
-    print("角色状态已清除")
+    logger.info("角色状态已清除")
 
 def is_character_loaded() -> bool:
     """
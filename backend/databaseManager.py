@@ -2,52 +2,123 @@
 
 import sqlite3
 import os
+import threading
 from typing import Dict, Any, Optional, List
 import json
 
+from metrics import metrics
+from log_manager import get_logger
+
+logger = get_logger("databaseManager")
+
+# 连接配置：每个线程复用一个长连接（WAL模式下读写互不阻塞），
+# sqlite3 按SQL文本缓存已编译的语句，长连接上重复的查询无需重新编译
+SQLITE_PERSISTENT_CONNECTIONS = os.getenv("SQLITE_PERSISTENT_CONNECTIONS", "true").lower() in ("1", "true", "yes")
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 16384))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 256))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+# 角色卡的组成部分 -> 数据表；info 为主表，其余按 character_id 关联
+CHARACTER_SHEET_TABLES = {
+    'info': 'characters',
+    'attributes': 'attributes',
+    'derived_attributes': 'derived_attributes',
+    'skills': 'skills',
+    'backgrounds': 'backgrounds',
+}
+# 单次联表查询最多包含的角色数（低于SQLite的参数数量上限）
+CHARACTER_BATCH_SIZE = 500
+
 class DatabaseManager:
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, persistent: Optional[bool] = None):
         if db_path is None:
             current_dir = os.path.dirname(os.path.abspath(__file__))
             self.db_path = os.path.join(current_dir, "..", "database.db")
         else:
             self.db_path = db_path
-        print(f"数据库路径: {os.path.abspath(self.db_path)}")
+        self.persistent = SQLITE_PERSISTENT_CONNECTIONS if persistent is None else persistent
+        # 每个线程一个连接（asyncio.to_thread 的工作线程会被复用）
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._sheet_query: Optional[str] = None
+        logger.info("数据库路径: %s", os.path.abspath(self.db_path))
         self.ensure_database_exists()
 
     def ensure_database_exists(self):
         if not os.path.exists(self.db_path):
-            print(f"警告：数据库文件 {self.db_path} 不存在")
+            logger.warning("数据库文件 %s 不存在", self.db_path)
+
+    def _open_connection(self) -> sqlite3.Connection:
+        # check_same_thread=False 只是为了允许 close() 在关闭时统一释放；每个连接仍只由所属线程使用
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE,
+                               timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
 
     def get_connection(self):
+        """获取当前线程的连接；非长连接模式下每次新建，由调用方关闭"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
+            if not self.persistent:
+                conn = sqlite3.connect(self.db_path)
+                conn.row_factory = sqlite3.Row
+                return conn
+            conn = getattr(self._local, "conn", None)
+            # db_path 被修改（例如测试时换用数据库副本）后重新连接
+            if conn is None or self._local.path != self.db_path:
+                conn = self._open_connection()
+                self._local.conn = conn
+                self._local.path = self.db_path
+                with self._connections_lock:
+                    self._connections.append(conn)
             return conn
         except Exception as e:
-            print(f"数据库连接失败: {e}")
+            logger.error("数据库连接失败: %s", e)
             return None
 
+    def close(self):
+        """关闭所有线程的长连接（应用关闭时调用）"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.warning("关闭数据库连接失败: %s", e)
+        self._local = threading.local()
+        if connections:
+            logger.info("已关闭 %s 个数据库连接", len(connections))
+
     def execute_query(self, query: str, params: tuple = ()) -> Optional[List[Dict]]:
-        conn = self.get_connection()
-        if not conn:
-            return None
-        try:
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            if query.strip().upper().startswith('SELECT'):
-                results = cursor.fetchall()
-                return [dict(row) for row in results]
-            else:
-                conn.commit()
+        operation = query.strip().split(None, 1)[0].lower() if query.strip() else "unknown"
+        with metrics.track_dependency("sqlite", operation):
+            conn = self.get_connection()
+            if not conn:
                 return None
-        except Exception as e:
-            print(f"查询执行失败: {e}")
-            print(f"SQL: {query}")
-            print(f"参数: {params}")
-            return None
-        finally:
-            conn.close()
+            try:
+                cursor = conn.execute(query, params)
+                if operation == "select":
+                    results = cursor.fetchall()
+                    return [dict(row) for row in results]
+                else:
+                    conn.commit()
+                    return None
+            except Exception as e:
+                logger.error("查询执行失败: %s", e, sql=query, params=params)
+                if conn.in_transaction:
+                    conn.rollback()
+                return None
+            finally:
+                if not self.persistent:
+                    conn.close()
 
     def get_initial_world_state(self) -> Dict[str, Any]:
         query = "SELECT state_key, state_value FROM world_state"
@@ -59,7 +130,7 @@ class DatabaseManager:
                     world_state[row['state_key']] = json.loads(row['state_value'])
                 except (json.JSONDecodeError, TypeError):
                     world_state[row['state_key']] = row['state_value']
-        print(f"从数据库加载了初始世界状态: {world_state}")
+        logger.info("从数据库加载了初始世界状态: %s", world_state)
         return world_state
 
     # --- 新增：获取地图实体 ---
@@ -81,18 +152,65 @@ class DatabaseManager:
                     item['current_state'] = {}
         return results or []
     
-    # --- 角色相关 (原有函数保持不变) ---
+    # --- 角色相关 ---
     def get_character_data(self, character_id: str) -> Optional[Dict[str, Any]]:
         if not character_id: return None
-        character_info = self.get_character_info(character_id)
-        if not character_info: return None
-        return {
-            'info': character_info,
-            'attributes': self.get_character_attributes(character_id),
-            'derived_attributes': self.get_character_derived_attributes(character_id),
-            'skills': self.get_character_skills(character_id),
-            'backgrounds': self.get_character_backgrounds(character_id)
-        }
+        return self.get_character_data_many([character_id]).get(character_id)
+
+    def _character_sheet_query(self) -> Optional[str]:
+        """
+        构建一次性读取完整角色卡的联表查询（按表结构生成，结果缓存）。
+        每列别名为 "<角色卡字段>__<列名>"，便于把一行拆回各个部分。
+        """
+        if self._sheet_query is not None:
+            return self._sheet_query
+        select_columns = []
+        joins = []
+        for alias, (section, table) in enumerate(CHARACTER_SHEET_TABLES.items()):
+            columns = self.execute_query("SELECT name FROM pragma_table_info(?)", (table,))
+            if not columns:
+                logger.error("无法读取表 %s 的结构", table)
+                return None
+            table_alias = f"t{alias}"
+            select_columns += [f'{table_alias}."{col["name"]}" AS "{section}__{col["name"]}"' for col in columns]
+            if section == 'info':
+                joins.append(f"FROM {table} {table_alias}")
+            else:
+                joins.append(f"LEFT JOIN {table} {table_alias} ON {table_alias}.character_id = t0.id")
+        self._sheet_query = f"SELECT {', '.join(select_columns)} {' '.join(joins)} WHERE t0.id IN ({{placeholders}})"
+        return self._sheet_query
+
+    def get_character_data_many(self, character_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        批量读取角色卡：每 CHARACTER_BATCH_SIZE 个角色只需一次联表查询。
+        返回 {角色ID: 角色卡}，数据库中不存在的角色不出现在结果中。
+        角色卡结构与逐个查询时相同：info / attributes / derived_attributes / skills / backgrounds
+        """
+        unique_ids = list(dict.fromkeys(cid for cid in character_ids if cid))
+        if not unique_ids:
+            return {}
+        query_template = self._character_sheet_query()
+        if not query_template:
+            return {}
+
+        sheets: Dict[str, Dict[str, Any]] = {}
+        for start in range(0, len(unique_ids), CHARACTER_BATCH_SIZE):
+            batch = unique_ids[start:start + CHARACTER_BATCH_SIZE]
+            rows = self.execute_query(query_template.format(placeholders=", ".join("?" * len(batch))), tuple(batch)) or []
+            for row in rows:
+                sheet = {section: {} for section in CHARACTER_SHEET_TABLES}
+                for key, value in row.items():
+                    section, column = key.split("__", 1)
+                    sheet[section][column] = value
+                character_id = sheet['info']['id']
+                # 与逐表查询一致：每张表取第一行，没有记录的表为空字典
+                if character_id in sheets:
+                    continue
+                for section in CHARACTER_SHEET_TABLES:
+                    if section != 'info' and sheet[section].get('character_id') is None:
+                        sheet[section] = {}
+                sheets[character_id] = sheet
+        return sheets
     
     def get_character_info(self, character_id: str) -> Optional[Dict[str, Any]]:
         query = "SELECT * FROM characters WHERE id = ?"
@@ -123,7 +241,7 @@ class DatabaseManager:
         for section in ['attributes', 'derived_attributes', 'skills']:
             if attribute_name in character_sheet.get(section, {}):
                 return character_sheet[section][attribute_name]
-        print(f"警告：在角色卡中未找到属性 '{attribute_name}'")
+        logger.warning("在角色卡中未找到属性 '%s'", attribute_name)
         return None
     
     def update_npc_state(self, character_id: str, new_status: Optional[str] = None, new_goal: Optional[str] = None):
@@ -138,7 +256,7 @@ class DatabaseManager:
         params.append(character_id)
         query = f"UPDATE characters SET {', '.join(updates)} WHERE id = ?"
         self.execute_query(query, tuple(params))
-        print(f"数据库中NPC {character_id} 的状态已更新。")
+        logger.debug("数据库中NPC %s 的状态已更新。", character_id)
 
     # 注意：NPC记忆现在使用ChromaDB存储，这些方法已废弃
     # 请使用 memory_manager.py 中的方法
@@ -150,6 +268,10 @@ def get_character_data(character_id: str) -> Optional[Dict[str, Any]]:
     """获取角色数据的便捷函数"""
     return db_manager.get_character_data(character_id)
 
+def get_character_data_many(character_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """批量获取角色数据的便捷函数"""
+    return db_manager.get_character_data_many(character_ids)
+
 def get_attribute_by_name(character_sheet: Dict[str, Any], attribute_name: str) -> Optional[int]:
     """根据属性名获取属性值的便捷函数"""
     return db_manager.get_attribute_by_name(character_sheet, attribute_name)
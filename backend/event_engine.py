@@ -0,0 +1,245 @@
+# event_engine.py
+"""
+事件触发引擎：剧本加载时将每个事件的前置条件编译为谓词对象，
+并按 地图 -> (intent, target) 建立索引。每回合只需评估与玩家行动可能匹配的少数事件，
+不再对地图上的全部事件重复 json.loads 和扫描。
+异步调用方使用 acandidate_events：涉及NPC状态的前置条件所需的 session_state 会先用异步Redis客户端并行读取，
+评估谓词时不再在事件循环上执行同步Redis调用。
+"""
+
+import json
+import asyncio
+from typing import Dict, Any, List, Optional, Tuple
+
+from scenario_catalog import scenario_catalog
+from redis_manager import get_session_state, aget_session_state
+from llm_cache import llm_cache
+from log_manager import get_logger
+
+logger = get_logger("event_engine")
+
+# 索引中的通配符：事件未对该字段提出要求
+ANY = None
+
+
+class NeverPredicate:
+    """前置条件格式错误的事件永远不会被硬性触发"""
+    def __call__(self, state: Dict[str, Any], completed: set) -> bool:
+        return False
+
+
+class PreEventsPredicate:
+    """要求指定的前置事件全部已完成"""
+    def __init__(self, pre_event_ids: List[int]):
+        self.pre_event_ids = tuple(pre_event_ids)
+
+    def __call__(self, state: Dict[str, Any], completed: set) -> bool:
+        return all(pid in completed for pid in self.pre_event_ids)
+
+
+class PlayerActionPredicate:
+    """要求玩家行动的各字段与期望值完全相等"""
+    def __init__(self, requirements: Dict[str, Any]):
+        self.requirements = tuple(requirements.items())
+
+    def __call__(self, state: Dict[str, Any], completed: set) -> bool:
+        action = state.get('player_action') or {}
+        return all(action.get(key) == expected for key, expected in self.requirements)
+
+
+class AgentStatePredicate:
+    """
+    要求玩家或指定NPC的 session_state 满足给定字段。
+    NPC的状态优先取 state['agent_states'] 中预先读取的值，没有时才同步读取Redis。
+    """
+    def __init__(self, requirements: Dict[str, Any]):
+        agent_id = requirements.get('agent_id')
+        self.agent_id = agent_id if agent_id and agent_id != 'player' else None
+        self.requirements = tuple(
+            ('current_map_id' if key == 'current_location_id' else key, expected)
+            for key, expected in requirements.items() if key != 'agent_id'
+        )
+
+    def __call__(self, state: Dict[str, Any], completed: set) -> bool:
+        target_session = state['session_state']
+        if self.agent_id:
+            agent_states = state.get('agent_states')
+            if agent_states is not None:
+                target_session = agent_states.get(self.agent_id) or {}
+            else:
+                try:
+                    target_session = get_session_state(self.agent_id) or {}
+                except Exception:
+                    pass
+        return all(target_session.get(key) == expected for key, expected in self.requirements)
+
+
+def _index_key(value: Any) -> Any:
+    """不可哈希的期望值无法进入索引，退化为通配，由谓词负责精确判断"""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ANY
+
+
+class CompiledEvent:
+    """编译后的事件：原始数据行 + 谓词列表 + 索引键"""
+    def __init__(self, event: Dict[str, Any], order: int):
+        self.event = event
+        self.event_id = event['event_id']
+        self.map_id = event.get('map_id')
+        self.if_unique = bool(event.get('if_unique'))
+        self.order = order
+        self.predicates = []
+        self.index_key: Tuple[Any, Any] = (ANY, ANY)
+        self._compile()
+
+    def _compile(self):
+        pre_event_ids_str = self.event.get('pre_event_ids')
+        if pre_event_ids_str:
+            try:
+                self.predicates.append(PreEventsPredicate(json.loads(pre_event_ids_str)))
+            except (json.JSONDecodeError, TypeError):
+                self.predicates = [NeverPredicate()]
+                return
+
+        if not self.event.get('preconditions'):
+            return
+
+        try:
+            preconditions = json.loads(self.event['preconditions'])
+        except (json.JSONDecodeError, TypeError):
+            self.predicates = [NeverPredicate()]
+            return
+        if not isinstance(preconditions, dict):
+            return
+
+        action_reqs = preconditions.get('player_action')
+        if isinstance(action_reqs, dict) and action_reqs:
+            self.predicates.append(PlayerActionPredicate(action_reqs))
+            self.index_key = (_index_key(action_reqs.get('intent', ANY)), _index_key(action_reqs.get('target', ANY)))
+
+        agent_reqs = preconditions.get('agent_state')
+        if isinstance(agent_reqs, dict):
+            self.predicates.append(AgentStatePredicate(agent_reqs))
+
+    def is_available(self, completed: set) -> bool:
+        """唯一事件完成后不再可用"""
+        return not (self.if_unique and self.event_id in completed)
+
+    def matches(self, state: Dict[str, Any], completed: set) -> bool:
+        return all(predicate(state, completed) for predicate in self.predicates)
+
+
+class EventEngine:
+    def __init__(self):
+        self._events_by_id: Dict[int, CompiledEvent] = {}
+        self._events_by_map: Dict[Any, List[CompiledEvent]] = {}
+        self._index: Dict[Any, Dict[Tuple[Any, Any], List[CompiledEvent]]] = {}
+        self._loaded = False
+
+    def load(self, events: Optional[List[Dict[str, Any]]] = None):
+        """从剧本目录（或给定的事件列表）编译并索引所有事件"""
+        if events is None:
+            events = scenario_catalog.events()
+
+        events_by_id, events_by_map, index = {}, {}, {}
+        for order, event in enumerate(events):
+            compiled = CompiledEvent(event, order)
+            events_by_id[compiled.event_id] = compiled
+            events_by_map.setdefault(compiled.map_id, []).append(compiled)
+            index.setdefault(compiled.map_id, {}).setdefault(compiled.index_key, []).append(compiled)
+
+        self._events_by_id, self._events_by_map, self._index = events_by_id, events_by_map, index
+        self._loaded = True
+        logger.info("事件引擎已加载 %s 个事件，覆盖 %s 张地图", len(events_by_id), len(events_by_map))
+
+    def reload(self):
+        """剧本内容变更后重新加载剧本目录并重新编译，同时清空依赖剧本内容的LLM响应缓存"""
+        scenario_catalog.reload()
+        self.load()
+        llm_cache.invalidate()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def get_event(self, event_id: int) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        compiled = self._events_by_id.get(event_id)
+        return compiled.event if compiled else None
+
+    def events_on_map(self, map_id: int) -> List[Dict[str, Any]]:
+        """地图上的全部事件原始数据（供软性判断使用）"""
+        self._ensure_loaded()
+        return [compiled.event for compiled in self._events_by_map.get(map_id, [])]
+
+    def _indexed_candidates(self, map_id: int, state: Dict[str, Any], completed: set) -> List[CompiledEvent]:
+        """索引中与玩家行动可能匹配、且仍可触发的事件（尚未评估谓词）"""
+        self._ensure_loaded()
+        map_index = self._index.get(map_id)
+        if not map_index:
+            return []
+
+        action = state.get('player_action') or {}
+        intent, target = _index_key(action.get('intent')), _index_key(action.get('target'))
+        keys = {(intent, target), (intent, ANY), (ANY, target), (ANY, ANY)}
+        return [
+            compiled
+            for key in keys
+            for compiled in map_index.get(key, [])
+            if compiled.is_available(completed)
+        ]
+
+    @staticmethod
+    def _matched_events(candidates: List[CompiledEvent], state: Dict[str, Any], completed: set) -> List[Dict[str, Any]]:
+        matched = [compiled for compiled in candidates if compiled.matches(state, completed)]
+        matched.sort(key=lambda compiled: compiled.order)
+        return [compiled.event for compiled in matched]
+
+    def candidate_events(self, map_id: int, state: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """返回当前回合满足全部前置条件的事件，顺序与事件ID顺序一致"""
+        completed = set(state.get('completed_events') or [])
+        return self._matched_events(self._indexed_candidates(map_id, state, completed), state, completed)
+
+    async def acandidate_events(self, map_id: int, state: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """candidate_events 的异步版本：先并行读取前置条件涉及的NPC状态，再同步评估谓词"""
+        completed = set(state.get('completed_events') or [])
+        candidates = self._indexed_candidates(map_id, state, completed)
+        agent_ids = list(dict.fromkeys(
+            predicate.agent_id
+            for compiled in candidates for predicate in compiled.predicates
+            if isinstance(predicate, AgentStatePredicate) and predicate.agent_id
+        ))
+        agent_states = {}
+        if agent_ids:
+            results = await asyncio.gather(*[aget_session_state(agent_id) for agent_id in agent_ids],
+                                           return_exceptions=True)
+            agent_states = {
+                agent_id: result for agent_id, result in zip(agent_ids, results) if not isinstance(result, Exception)
+            }
+        return self._matched_events(candidates, dict(state, agent_states=agent_states), completed)
+
+
+def format_events_for_prompt(events: List[Dict[str, Any]]) -> str:
+    """软性判断提示词中的事件列表：事件ID、描述和前置条件"""
+    events_info = []
+    for event in events:
+        event_desc = f"事件{event['event_id']}: {event['event_info']}"
+        if event.get('preconditions'):
+            try:
+                preconditions = json.loads(event['preconditions'])
+                event_desc += f" (前置条件: {preconditions})"
+            except (json.JSONDecodeError, TypeError):
+                pass
+        events_info.append(event_desc)
+    return "\n".join(events_info)
+
+def soft_check_candidates(events: List[Dict[str, Any]], completed_events: List[int]) -> List[Dict[str, Any]]:
+    """可供软性判断的事件：排除已完成的唯一事件"""
+    completed = set(completed_events or [])
+    return [event for event in events if not (event.get('if_unique') and event['event_id'] in completed)]
+
+# 创建全局实例
+event_engine = EventEngine()
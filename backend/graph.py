@@ -1,35 +1,46 @@
 # graph.py
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import TypedDict, List, Dict, Any, Optional
 from langgraph.graph import StateGraph, END
 import json
+import os
 import asyncio
 import random
+import time
 from datetime import datetime
 
 # --- LLM and Langchain Imports ---
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.callbacks.manager import adispatch_custom_event
 
 # --- Local Module Imports ---
 from databaseManager import db_manager
-from character_state import get_current_character_id
+from character_state import aresolve_character_id, get_turn_lock
 from memory_manager import memory_manager
 from map_movement import map_movement_manager
 from npc_filter import npc_filter
+from turn_planner import turn_planner
+from event_engine import event_engine, format_events_for_prompt, soft_check_candidates
+from llm_registry import get_llm
+from llm_cache import cached_ainvoke, is_json
+from metrics import metrics, instrument_node
+from prompt_budget import PromptSection, fit_sections
+from prompt_layout import build_npc_messages, npc_prompt_cache
+from log_manager import get_logger, turn_logging
+from scenario_catalog import scenario_catalog
 from redis_manager import (
-    get_world_state, save_world_state,
-    get_map_state, save_map_state,
-    get_session_state, save_session_state,
-    get_character_sheet, save_character_sheet,
-    get_conversation_history, save_conversation_history,
-    get_completed_event_ids, save_completed_event_ids,
-    apply_state_changes, apply_map_state_changes
+    aget_map_state,
+    aget_character_sheet, aget_character_sheets, asave_character_sheet,
+    aload_turn_snapshot, asave_turn_snapshot, turn_cache,
+    aapply_state_changes, aapply_map_state_changes
 )
 import player_action_parser
 from player_action_parser import get_skill_value_from_sheet # 导入新工具函数
 
+logger = get_logger("graph")
+
 class AgentState(TypedDict):
     player_input: str
     final_output: str
@@ -38,7 +49,8 @@ class AgentState(TypedDict):
     session_state: Dict[str, Any]
     world_state: Dict[str, Any]
     map_state: Dict[str, Any]
-    conversation_history: List[Dict[str, str]]
+    conversation_history: List[Dict[str, str]]  # 最近的若干条对话（不是完整历史）
+    new_messages: List[Dict[str, str]]  # 本回合新增的对话，回合结束时追加到Redis
     completed_events: List[int]
     active_npcs: List[Dict[str, Any]]
     interactable_objects: List[Dict[str, Any]]
@@ -50,159 +62,170 @@ class AgentState(TypedDict):
     turn_context_summary: str
     selected_npcs: List[str]
     npc_reactions_info: List[Dict[str, Any]]
+    npc_memories: Dict[str, Dict[str, Any]]
 
-def check_preconditions(event: Dict[str, Any], state: AgentState) -> bool:
-    pre_event_ids_str = event.get('pre_event_ids')
-    if pre_event_ids_str:
-        try:
-            pre_event_ids = json.loads(pre_event_ids_str)
-            if not all(pid in state['completed_events'] for pid in pre_event_ids):
-                return False
-        except (json.JSONDecodeError, TypeError):
-            return False
-
-    if not event.get('preconditions'):
-        return True
-    
+async def _emit_stream_event(name: str, data: Dict[str, Any]):
+    """向流式接口推送自定义事件；普通 ainvoke 调用时没有监听者，事件会被直接忽略"""
     try:
-        preconditions = json.loads(event['preconditions'])
-    except (json.JSONDecodeError, TypeError):
-        return False
-
-    if 'player_action' in preconditions:
-        action = state.get('player_action', {})
-        for key, expected_value in preconditions['player_action'].items():
-            if action.get(key) != expected_value:
-                return False
-                
-    if 'agent_state' in preconditions:
-        agent_reqs = preconditions['agent_state']
-        target_session = state['session_state']
-        try:
-            target_id = agent_reqs.get('agent_id')
-            if target_id and target_id != 'player':
-                target_session = get_session_state(target_id) or {}
-        except Exception:
-            pass
-        for key, expected_value in agent_reqs.items():
-            if key == 'agent_id': continue
-            session_key = 'current_map_id' if key == 'current_location_id' else key
-            if target_session.get(session_key) != expected_value:
-                return False
-        
-    return True
+        await adispatch_custom_event(name, data)
+    except Exception as e:
+        logger.warning("[Stream] 推送事件 %s 失败: %s", name, e)
 
-async def orchestrator_agent(state: AgentState):
-    print("--- 节点: Orchestrator ---")
-    print(f"[Orchestrator] 输入: '{state['player_input']}' | 角色: {state['character_id']}")
-    print(f"[Orchestrator] session_state: {state['session_state']}")
-    print(f"[Orchestrator] map_state 初始: {state['map_state']}")
-    map_state = state['map_state']
-    
-    npc_ids = map_state.get('npcs', [])
-    print(f"[Orchestrator] 从 map_state 读取 NPC IDs: {npc_ids}")
-    
-    # 先加载所有NPC的基础信息
+async def _load_npc_infos(npc_ids: List[str]) -> List[Dict[str, Any]]:
+    """从Redis加载地图上所有NPC的基础信息（一次 MGET）"""
     all_npcs = []
+    npc_sheets = await aget_character_sheets(npc_ids)
     for npc_id in npc_ids:
-        npc_sheet = get_character_sheet(npc_id)
+        npc_sheet = npc_sheets[npc_id]
         if npc_sheet and npc_sheet.get('info'):
             npc_info = npc_sheet['info']
             npc_info['id'] = npc_id
             all_npcs.append(npc_info)
+    npc_prompt_cache.precompile(all_npcs)
+    return all_npcs
+
+def _npc_names_from_catalog(npc_ids: List[str]) -> List[Dict[str, Any]]:
+    """意图解析提示词所需的NPC名字（剧本目录中查找，不需要等待角色卡加载）"""
+    npcs = []
+    for npc_id in npc_ids:
+        profile = scenario_catalog.get_npc_profile(npc_id)
+        if profile:
+            npcs.append({"id": npc_id, "name": profile.get('name')})
+    return npcs
+
+def _load_object_infos(objects_state: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """为地图上的可交互物品补全名称（剧本目录中查找）"""
+    return [
+        {"object_id": obj_id, "object_name": scenario_catalog.get_object_name(obj_id)}
+        for obj_id in objects_state
+    ]
+
+async def _prefetch_npc_memories(npc_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """并行预取NPC记忆，供 npc_loop 直接使用"""
+    results = await asyncio.gather(*[
+        memory_manager.aget_npc_memories_for_context(npc_id) for npc_id in npc_ids
+    ])
+    return dict(zip(npc_ids, results))
+
+def _extract_recent_npcs(conversation_history: List[Dict[str, Any]]) -> List[str]:
+    """从最近几轮对话中提取激活过的NPC ID"""
+    recent_npcs = []
+    for msg in conversation_history[-10:]:  # 只看最近10条消息
+        if msg.get('role') == 'npc' and msg.get('character_id'):
+            if msg['character_id'] not in recent_npcs:
+                recent_npcs.append(msg['character_id'])
+    return recent_npcs
+
+async def _timed(timings: Dict[str, float], phase: str, awaitable):
+    """等待 awaitable 并记录该阶段耗时(毫秒)"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[phase] = (time.perf_counter() - start) * 1000
+
+async def orchestrator_agent(state: AgentState):
+    logger.debug("--- 节点: Orchestrator ---")
+    logger.info("[Orchestrator] 输入: '%s' | 角色: %s", state['player_input'], state['character_id'])
+    logger.trace("[Orchestrator] session_state: %s", state['session_state'])
+    logger.trace("[Orchestrator] map_state 初始: %s", state['map_state'])
+    map_state = state['map_state']
+    phase_timings = {}
+    orchestrator_start = time.perf_counter()
     
-    print(f"[Orchestrator] 所有NPC加载完成: {[n.get('id') for n in all_npcs]}")
+    npc_ids = map_state.get('npcs', [])
+    logger.debug("[Orchestrator] 从 map_state 读取 NPC IDs: %s", npc_ids)
+    objects_state = map_state.get('objects', {})
+    logger.debug("[Orchestrator] 从 map_state 读取 Objects: keys=%s", list(objects_state.keys()))
     
+    # NPC角色卡从Redis加载，与意图解析的LLM调用并行；解析提示词只需要NPC的名字，取自内存中的剧本目录
+    hydrate_task = asyncio.create_task(_timed(phase_timings, "hydrate", _load_npc_infos(npc_ids)))
+    interactable_objects = _load_object_infos(objects_state)
+    state['interactable_objects'] = interactable_objects
+    logger.trace("[Orchestrator] interactable_objects: %s", state['interactable_objects'])
+
+    # 不依赖玩家意图的工作与意图解析的LLM调用并行执行
+    memories_task = asyncio.create_task(
+        _timed(phase_timings, "memory_prefetch", _prefetch_npc_memories(npc_ids))
+    )
+    recent_npcs = _extract_recent_npcs(state.get('conversation_history') or [])
+
+    try:
+        # 回合规划模式：一次LLM调用同时得到意图、需要反应的NPC和软性事件判断（需要NPC的状态和目标，先等待加载）
+        plan = None
+        if turn_planner.enabled:
+            all_npcs = await hydrate_task
+            plan = await _timed(phase_timings, "plan", turn_planner.plan_turn(
+                state['player_input'], all_npcs, state['interactable_objects'],
+                state['session_state'], state['completed_events'],
+                selected_npcs=state.get('selected_npcs'), recent_npcs=recent_npcs, max_npcs=3
+            ))
+
+        if plan:
+            state['player_action'] = plan['player_action']
+        else:
+            state['player_action'] = await _timed(phase_timings, "parse", player_action_parser.parse_player_action(
+                state['player_input'], _npc_names_from_catalog(npc_ids), state['interactable_objects'],
+                current_map_id=state['session_state'].get('current_map_id', 1)
+            ))
+        all_npcs = await hydrate_task
+    except BaseException:
+        hydrate_task.cancel()
+        memories_task.cancel()
+        raise
+    logger.debug("[Orchestrator] 所有NPC加载完成: %s", [n.get('id') for n in all_npcs])
+
     # 暂时不筛选，等玩家行动解析后再筛选
     state['all_npcs'] = all_npcs
     state['active_npcs'] = all_npcs  # 初始时包含所有NPC
-    
-    objects_state = map_state.get('objects', {})
-    print(f"[Orchestrator] 从 map_state 读取 Objects: keys={list(objects_state.keys())}")
-    state['interactable_objects'] = []
-    for obj_id, obj_state in objects_state.items():
-        obj_info = db_manager.execute_query("SELECT object_name FROM interactable_objects WHERE object_id = ?", (obj_id,))
-        obj_name = obj_info[0]['object_name'] if obj_info else f"物品{obj_id}"
-        state['interactable_objects'].append({"object_id": obj_id, "object_name": obj_name})
-    print(f"[Orchestrator] interactable_objects: {state['interactable_objects']}")
-
-    state['player_action'] = await player_action_parser.parse_player_action(
-        state['player_input'], state['active_npcs'], state['interactable_objects']
-    )
-    print(f"[Orchestrator] 解析到的玩家意图: {state['player_action']}")
+    logger.info("[Orchestrator] 解析到的玩家意图: %s", state['player_action'])
     
     # 根据玩家行动筛选相关的NPC
     # 检查是否有玩家选择的NPC
     selected_npcs = state.get('selected_npcs', [])
     if selected_npcs:
-        print(f"[Orchestrator] 使用玩家选择的NPC: {selected_npcs}")
+        logger.debug("[Orchestrator] 使用玩家选择的NPC: %s", selected_npcs)
         # 只激活玩家选择的NPC
         state['active_npcs'] = [npc for npc in state['all_npcs'] if npc.get('id') in selected_npcs]
-        print(f"[Orchestrator] 激活玩家选择的NPC: {[n.get('id') for n in state['active_npcs']]}")
+        logger.debug("[Orchestrator] 激活玩家选择的NPC: %s", [n.get('id') for n in state['active_npcs']])
     elif state['all_npcs'] and len(state['all_npcs']) > 3:
-        print(f"[Orchestrator] 开始NPC筛选，当前有{len(state['all_npcs'])}个NPC")
-        
-        # 获取最近几轮激活的NPC（从对话历史中提取）
-        recent_npcs = []
-        try:
-            conversation_history = get_conversation_history(state['character_id'])
-            # 从最近几轮对话中提取NPC ID
-            for msg in conversation_history[-10:]:  # 只看最近10条消息
-                if msg.get('role') == 'npc' and msg.get('character_id'):
-                    if msg['character_id'] not in recent_npcs:
-                        recent_npcs.append(msg['character_id'])
-        except:
-            pass
+        logger.debug("[Orchestrator] 开始NPC筛选，当前有%s个NPC", len(state['all_npcs']))
         
-        state['active_npcs'] = await npc_filter.filter_npcs_by_relevance(
-            state['player_input'],
-            state['player_action'],
-            state['all_npcs'],
-            max_npcs=3,
-            recent_npcs=recent_npcs
-        )
-        print(f"[Orchestrator] NPC筛选完成，激活{len(state['active_npcs'])}个NPC: {[n.get('id') for n in state['active_npcs']]}")
+        if plan and plan['selected_npc_ids'] is not None:
+            # 规划器返回的空列表表示本回合没有NPC需要反应
+            selected_ids = plan['selected_npc_ids']
+            state['active_npcs'] = [npc for npc in state['all_npcs'] if npc.get('id') in selected_ids]
+        else:
+            state['active_npcs'] = await npc_filter.filter_npcs_by_relevance(
+                state['player_input'],
+                state['player_action'],
+                state['all_npcs'],
+                max_npcs=3,
+                recent_npcs=recent_npcs
+            )
+        logger.info("[Orchestrator] NPC筛选完成，激活%s个NPC: %s", len(state['active_npcs']), [n.get('id') for n in state['active_npcs']])
         if recent_npcs:
-            print(f"[Orchestrator] 最近激活的NPC: {recent_npcs}")
+            logger.debug("[Orchestrator] 最近激活的NPC: %s", recent_npcs)
     else:
-        print(f"[Orchestrator] NPC数量较少({len(state['all_npcs'])}个)且无玩家选择，激活所有NPC")
+        logger.info("[Orchestrator] NPC数量较少(%s个)且无玩家选择，激活所有NPC", len(state['all_npcs']))
 
     # 先检查当前地图的事件触发条件
     if not state['session_state'].get('pending_check_event_id'):
         current_map_id = state['session_state'].get('current_map_id', 1)
-        all_events = db_manager.execute_query("SELECT * FROM events WHERE map_id = ?", (current_map_id,))
-        print(f"[Orchestrator] 地图 {current_map_id} 上的所有事件: {[e['event_id'] for e in all_events]}")
+        all_events = event_engine.events_on_map(current_map_id)
+        logger.debug("[Orchestrator] 地图 %s 上的所有事件: %s", current_map_id, [e['event_id'] for e in all_events])
         
         if all_events:
-            # 显示每个事件的详细信息
-            for event in all_events:
-                event_id = event['event_id']
-                event_info = event['event_info']
-                if_unique = event.get('if_unique', 0)
-                is_completed = event_id in state['completed_events']
-                preconditions_met = check_preconditions(event, state)
-                
-                print(f"[Orchestrator] 事件 {event_id}: {event_info}")
-                print(f"  - 唯一性: {if_unique} (已完成: {is_completed})")
-                print(f"  - 前置条件满足: {preconditions_met}")
-                if not preconditions_met:
-                    try:
-                        preconditions = json.loads(event.get('preconditions', '{}'))
-                        print(f"  - 前置条件详情: {preconditions}")
-                    except:
-                        print(f"  - 前置条件详情: {event.get('preconditions', '无')}")
-            
-            candidate_events = [
-                event for event in all_events
-                if not (event.get('if_unique') and event['event_id'] in state['completed_events'])
-                and check_preconditions(event, state)
-            ]
+            # 事件引擎只评估与当前玩家行动可能匹配的事件
+            events_start = time.perf_counter()
+            candidate_events = await event_engine.acandidate_events(current_map_id, state)
+            phase_timings['events'] = (time.perf_counter() - events_start) * 1000
             
-            print(f"[Orchestrator] 符合条件的候选事件: {[e['event_id'] for e in candidate_events]}")
+            logger.debug("[Orchestrator] 符合条件的候选事件: %s", [e['event_id'] for e in candidate_events])
             
             if candidate_events:
                 state['triggered_event'] = candidate_events[0]
-                print(f"[Orchestrator] 事件已触发: {candidate_events[0]['event_id']} - {candidate_events[0]['event_info']}")
+                logger.info("[Orchestrator] 事件已触发: %s - %s", candidate_events[0]['event_id'], candidate_events[0]['event_info'])
                 
                 # 立即应用事件的状态更改，让NPC在生成反应时就知道状态变化
                 try:
@@ -213,40 +236,43 @@ async def orchestrator_agent(state: AgentState):
                     if 'success' in outcomes:
                         outcome_data = outcomes['success']
                         if 'npc_state_change' in outcome_data:
-                            print(f"[Orchestrator] 立即应用NPC状态更改: {outcome_data['npc_state_change']}")
+                            logger.debug("[Orchestrator] 立即应用NPC状态更改: %s", outcome_data['npc_state_change'])
                             for change in outcome_data['npc_state_change']:
-                                db_manager.update_npc_state(change['character_id'], new_status=change.get('new_status'))
+                                await asyncio.to_thread(db_manager.update_npc_state, change['character_id'], new_status=change.get('new_status'))
                                 # 同时更新Redis中的NPC状态
                                 npc_id = change['character_id']
-                                npc_sheet = get_character_sheet(npc_id)
+                                npc_sheet = await aget_character_sheet(npc_id)
                                 if npc_sheet and npc_sheet.get('info'):
                                     npc_sheet['info']['status'] = change.get('new_status')
-                                    save_character_sheet(npc_id, npc_sheet)
-                                    print(f"[Orchestrator] 已更新NPC {npc_id} 状态为: {change.get('new_status')}")
+                                    await asave_character_sheet(npc_id, npc_sheet)
+                                    logger.debug("[Orchestrator] 已更新NPC %s 状态为: %s", npc_id, change.get('new_status'))
                     
                     elif 'failure' in outcomes:
                         outcome_data = outcomes['failure']
                         if 'npc_state_change' in outcome_data:
-                            print(f"[Orchestrator] 立即应用NPC状态更改: {outcome_data['npc_state_change']}")
+                            logger.debug("[Orchestrator] 立即应用NPC状态更改: %s", outcome_data['npc_state_change'])
                             for change in outcome_data['npc_state_change']:
-                                db_manager.update_npc_state(change['character_id'], new_status=change.get('new_status'))
+                                await asyncio.to_thread(db_manager.update_npc_state, change['character_id'], new_status=change.get('new_status'))
                                 # 同时更新Redis中的NPC状态
                                 npc_id = change['character_id']
-                                npc_sheet = get_character_sheet(npc_id)
+                                npc_sheet = await aget_character_sheet(npc_id)
                                 if npc_sheet and npc_sheet.get('info'):
                                     npc_sheet['info']['status'] = change.get('new_status')
-                                    save_character_sheet(npc_id, npc_sheet)
-                                    print(f"[Orchestrator] 已更新NPC {npc_id} 状态为: {change.get('new_status')}")
+                                    await asave_character_sheet(npc_id, npc_sheet)
+                                    logger.debug("[Orchestrator] 已更新NPC %s 状态为: %s", npc_id, change.get('new_status'))
                 except Exception as e:
-                    print(f"[Orchestrator] 应用事件状态更改时出错: {e}")
+                    logger.warning("[Orchestrator] 应用事件状态更改时出错: %s", e)
             else:
-                print("[Orchestrator] 本回合无可触发事件，尝试软性判断...")
+                logger.debug("[Orchestrator] 本回合无可触发事件，尝试软性判断...")
                 
-                # 软性判断：让LLM判断是否有事件应该被触发
-                soft_candidate = await soft_check_event_trigger(state, all_events)
+                # 软性判断：让LLM判断是否有事件应该被触发（规划模式下已随回合规划一并完成）
+                if plan:
+                    soft_candidate = plan['soft_event']
+                else:
+                    soft_candidate = await soft_check_event_trigger(state, all_events)
                 if soft_candidate:
                     state['triggered_event'] = soft_candidate
-                    print(f"[Orchestrator] 软性判断触发事件: {soft_candidate['event_id']} - {soft_candidate['event_info']}")
+                    logger.info("[Orchestrator] 软性判断触发事件: %s - %s", soft_candidate['event_id'], soft_candidate['event_info'])
                     
                     # 立即应用软性判断事件的状态更改
                     try:
@@ -257,98 +283,98 @@ async def orchestrator_agent(state: AgentState):
                         if 'success' in outcomes:
                             outcome_data = outcomes['success']
                             if 'npc_state_change' in outcome_data:
-                                print(f"[Orchestrator] 立即应用NPC状态更改: {outcome_data['npc_state_change']}")
+                                logger.debug("[Orchestrator] 立即应用NPC状态更改: %s", outcome_data['npc_state_change'])
                                 for change in outcome_data['npc_state_change']:
-                                    db_manager.update_npc_state(change['character_id'], new_status=change.get('new_status'))
+                                    await asyncio.to_thread(db_manager.update_npc_state, change['character_id'], new_status=change.get('new_status'))
                                     # 同时更新Redis中的NPC状态
                                     npc_id = change['character_id']
-                                    npc_sheet = get_character_sheet(npc_id)
+                                    npc_sheet = await aget_character_sheet(npc_id)
                                     if npc_sheet and npc_sheet.get('info'):
                                         npc_sheet['info']['status'] = change.get('new_status')
-                                        save_character_sheet(npc_id, npc_sheet)
-                                        print(f"[Orchestrator] 已更新NPC {npc_id} 状态为: {change.get('new_status')}")
+                                        await asave_character_sheet(npc_id, npc_sheet)
+                                        logger.debug("[Orchestrator] 已更新NPC %s 状态为: %s", npc_id, change.get('new_status'))
                         
                         elif 'failure' in outcomes:
                             outcome_data = outcomes['failure']
                             if 'npc_state_change' in outcome_data:
-                                print(f"[Orchestrator] 立即应用NPC状态更改: {outcome_data['npc_state_change']}")
+                                logger.debug("[Orchestrator] 立即应用NPC状态更改: %s", outcome_data['npc_state_change'])
                                 for change in outcome_data['npc_state_change']:
-                                    db_manager.update_npc_state(change['character_id'], new_status=change.get('new_status'))
+                                    await asyncio.to_thread(db_manager.update_npc_state, change['character_id'], new_status=change.get('new_status'))
                                     # 同时更新Redis中的NPC状态
                                     npc_id = change['character_id']
-                                    npc_sheet = get_character_sheet(npc_id)
+                                    npc_sheet = await aget_character_sheet(npc_id)
                                     if npc_sheet and npc_sheet.get('info'):
                                         npc_sheet['info']['status'] = change.get('new_status')
-                                        save_character_sheet(npc_id, npc_sheet)
-                                        print(f"[Orchestrator] 已更新NPC {npc_id} 状态为: {change.get('new_status')}")
+                                        await asave_character_sheet(npc_id, npc_sheet)
+                                        logger.debug("[Orchestrator] 已更新NPC %s 状态为: %s", npc_id, change.get('new_status'))
                     except Exception as e:
-                        print(f"[Orchestrator] 应用软性判断事件状态更改时出错: {e}")
+                        logger.warning("[Orchestrator] 应用软性判断事件状态更改时出错: %s", e)
                 else:
-                    print("[Orchestrator] 软性判断也无事件可触发")
+                    logger.debug("[Orchestrator] 软性判断也无事件可触发")
         else:
-            print(f"[Orchestrator] 地图 {current_map_id} 上没有事件")
+            logger.debug("[Orchestrator] 地图 %s 上没有事件", current_map_id)
     else:
-        print(f"[Orchestrator] 发现挂起检定 pending_check_event_id={state['session_state'].get('pending_check_event_id')}")
+        logger.debug("[Orchestrator] 发现挂起检定 pending_check_event_id=%s", state['session_state'].get('pending_check_event_id'))
 
     # 如果没有事件触发，才处理移动意图
     if not state.get('triggered_event') and state['player_action'].get('intent') == 'move' and state['player_action'].get('target_location_id'):
         target_map_id = state['player_action']['target_location_id']
-        print(f"[Orchestrator] 检测到移动意图，目标地图: {target_map_id}")
+        logger.info("[Orchestrator] 检测到移动意图，目标地图: %s", target_map_id)
         
-        # 执行移动
-        if map_movement_manager.move_character_to_map(state['character_id'], target_map_id):
+        # 执行移动（涉及数据库、Redis和ChromaDB的同步调用，在线程中执行）
+        if await asyncio.to_thread(map_movement_manager.move_character_to_map, state['character_id'], target_map_id):
             # 移动成功，更新地图状态
             new_map_id = target_map_id
             state['session_state']['current_map_id'] = new_map_id
-            state['map_state'] = get_map_state(new_map_id)
+            state['map_state'] = await aget_map_state(new_map_id)
             
             # 重新加载新地图的NPC和对象
             npc_ids = state['map_state'].get('npcs', [])
-            print(f"[Orchestrator] 新地图NPC IDs: {npc_ids}")
+            logger.debug("[Orchestrator] 新地图NPC IDs: %s", npc_ids)
             
             # 修复：确保NPC信息正确加载
             state['all_npcs'] = []
+            npc_sheets = await aget_character_sheets(npc_ids)
+            # Redis中缺失的NPC从数据库批量重新加载
+            missing_npc_ids = [npc_id for npc_id in npc_ids if not (npc_sheets[npc_id] and npc_sheets[npc_id].get('info'))]
+            if missing_npc_ids:
+                logger.warning("[Orchestrator] 无法获取NPC %s 的信息，尝试从数据库重新加载...", missing_npc_ids)
+                reloaded_sheets = await asyncio.to_thread(db_manager.get_character_data_many, missing_npc_ids)
             for npc_id in npc_ids:
-                npc_sheet = get_character_sheet(npc_id)
+                npc_sheet = npc_sheets[npc_id]
                 if npc_sheet and npc_sheet.get('info'):
                     npc_info = npc_sheet['info']
                     # 确保NPC信息包含必要的字段
                     npc_info['id'] = npc_id
                     state['all_npcs'].append(npc_info)
-                    print(f"[Orchestrator] 加载NPC: {npc_info.get('name', npc_id)}")
+                    logger.debug("[Orchestrator] 加载NPC: %s", npc_info.get('name', npc_id))
                 else:
-                    print(f"[Orchestrator] 警告：无法获取NPC {npc_id} 的信息，尝试从数据库重新加载...")
-                    # 如果Redis中没有NPC数据，从数据库重新加载
-                    npc_sheet = db_manager.get_character_data(npc_id)
+                    npc_sheet = reloaded_sheets.get(npc_id)
                     if npc_sheet:
-                        save_character_sheet(npc_id, npc_sheet)
+                        await asave_character_sheet(npc_id, npc_sheet)
                         npc_info = npc_sheet.get('info', {})
                         npc_info['id'] = npc_id
                         state['all_npcs'].append(npc_info)
-                        print(f"[Orchestrator] 成功从数据库重新加载NPC: {npc_info.get('name', npc_id)}")
+                        logger.debug("[Orchestrator] 成功从数据库重新加载NPC: %s", npc_info.get('name', npc_id))
                     else:
-                        print(f"[Orchestrator] 错误：无法从数据库获取NPC {npc_id} 的信息")
+                        logger.error("[Orchestrator] 无法从数据库获取NPC %s 的信息", npc_id)
             
             # 移动后，暂时激活所有NPC（等玩家行动后再筛选）
             state['active_npcs'] = state['all_npcs']
             
-            objects_state = state['map_state'].get('objects', {})
-            state['interactable_objects'] = []
-            for obj_id, obj_state in objects_state.items():
-                obj_info = db_manager.execute_query("SELECT object_name FROM interactable_objects WHERE object_id = ?", (obj_id,))
-                obj_name = obj_info[0]['object_name'] if obj_info else f"物品{obj_id}"
-                state['interactable_objects'].append({"object_id": obj_id, "object_name": obj_name})
+            state['interactable_objects'] = _load_object_infos(state['map_state'].get('objects', {}))
             
-            print(f"[Orchestrator] 移动完成，新地图: {new_map_id}")
-            print(f"[Orchestrator] 新地图NPC: {[n.get('id') for n in state['active_npcs']]}")
-            print(f"[Orchestrator] 新地图对象: {state['interactable_objects']}")
+            logger.info("[Orchestrator] 移动完成，新地图: %s", new_map_id)
+            logger.debug("[Orchestrator] 新地图NPC: %s", [n.get('id') for n in state['active_npcs']])
+            logger.trace("[Orchestrator] 新地图对象: %s", state['interactable_objects'])
         else:
-            print(f"[Orchestrator] 移动到地图 {target_map_id} 失败")
+            logger.warning("[Orchestrator] 移动到地图 %s 失败", target_map_id)
 
     
     # 如果是移动意图，添加移动描述
     if state['player_action'].get('intent') == 'move' and state['player_action'].get('target_location_id'):
-        movement_desc = map_movement_manager.get_movement_description(
+        movement_desc = await asyncio.to_thread(
+            map_movement_manager.get_movement_description,
             state['character_id'], 
             state['player_action']['target_location_id']
         )
@@ -356,26 +382,37 @@ async def orchestrator_agent(state: AgentState):
     else:
         state['turn_context_summary'] = f"玩家的行动是：'{state['player_input']}'。\n"
     
+    # 记忆预取与意图解析、NPC筛选、软性判断全程重叠，最后才等待结果
+    try:
+        state['npc_memories'] = await memories_task
+    except Exception as e:
+        logger.warning("[Orchestrator] 预取NPC记忆失败: %s", e)
+        state['npc_memories'] = {}
+
+    phase_timings['total'] = (time.perf_counter() - orchestrator_start) * 1000
+    logger.info("[Orchestrator] 阶段耗时(ms)", **{phase: round(ms, 1) for phase, ms in phase_timings.items()})
     return state
 
 async def resolve_check_agent(state: AgentState):
-    print("--- 节点: Resolve Check ---")
+    logger.debug("--- 节点: Resolve Check ---")
     event_id = state['session_state']['pending_check_event_id']
-    print(f"[Resolve] 待解决事件ID: {event_id}")
-    event_data = db_manager.execute_query("SELECT * FROM events WHERE event_id = ?", (event_id,))[0]
+    logger.debug("[Resolve] 待解决事件ID: %s", event_id)
+    event_data = scenario_catalog.get_event(event_id)
     state['pending_event_data'] = event_data
     
     effects = json.loads(event_data['effects'])
     check_info = effects['skill_check']
-    print(f"[Resolve] 检定信息: {check_info}")
+    logger.debug("[Resolve] 检定信息: %s", check_info)
     
     char_id_to_check = state['character_id'] if check_info.get('character_id', -1) == -1 else check_info['character_id']
 
-    result = player_action_parser.check_skill_directly(
+    # 检定会读取SQLite中的角色卡，放到工作线程执行
+    result = await asyncio.to_thread(
+        player_action_parser.check_skill_directly,
         char_id_to_check, check_info['skill_id'], check_info['difficulty']
     )
     state['skill_check_result'] = result
-    print(f"[Resolve] 检定结果: {result}")
+    logger.info("[Resolve] 检定结果: %s", result)
     
     outcome_key = 'success' if result.get('success') else 'failure'
     outcome_narrative = effects.get('outcomes', {}).get(outcome_key, {}).get('narrative', '')
@@ -386,38 +423,188 @@ async def resolve_check_agent(state: AgentState):
     return state
 
 async def setup_suspense_agent(state: AgentState):
-    print("--- 节点: Setup Suspense ---")
+    logger.debug("--- 节点: Setup Suspense ---")
     event = state['triggered_event']
-    print(f"[Suspense] 设置悬念事件ID: {event.get('event_id') if event else None}")
+    logger.debug("[Suspense] 设置悬念事件ID: %s", event.get('event_id') if event else None)
     state['session_state']['pending_check_event_id'] = event['event_id']
     effects = json.loads(event['effects'])
     state['final_output'] = effects['outcomes']['suspense_narrative']
-    print(f"[Suspense] 输出悬念文本长度: {len(state['final_output'])}")
+    logger.debug("[Suspense] 输出悬念文本长度: %s", len(state['final_output']))
+    await _emit_stream_event("narrative", {"stage": "suspense", "content": state['final_output']})
     return state
     
+# NPC并发模式：回合开始时所有NPC以回合初始上下文并行生成反应，之后按敏捷顺序依次提交。
+# 只要排在前面的NPC的反应改变了某个NPC可见的上下文（公开反应或察觉到的暗中行动），
+# 就用新的上下文重新生成该NPC的反应，因此感知语义与串行模式完全一致。
+NPC_LOOP_CONCURRENT = os.getenv("NPC_LOOP_CONCURRENT", "true").lower() in ("1", "true", "yes")
+# 可选的省调用模式（默认关闭）：前序公开反应只有点名提到某个NPC时才让它重新生成，
+# 其余前序反应该NPC在本回合看不到（会随回合总结写入短期记忆），换取更少的LLM调用
+NPC_LOOP_RELEVANCE_RERUN = os.getenv("NPC_LOOP_RELEVANCE_RERUN", "false").lower() in ("1", "true", "yes")
+
+# NPC提示词情景部分（公开情景、其他NPC、察觉、记忆）的总token预算；角色设定字段的上限见 prompt_layout
+NPC_CONTEXT_TOKEN_BUDGET = int(os.getenv("NPC_CONTEXT_TOKEN_BUDGET", 1500))
+
+def _discard_task(task: asyncio.Task):
+    """取消不再需要的预生成任务，并吞掉其可能已产生的异常"""
+    if task.done():
+        if not task.cancelled():
+            task.exception()
+    else:
+        task.cancel()
+
+def _build_npc_memory_context(memory_data: Dict[str, Any]) -> str:
+    """把NPC的短期记忆和长期记忆拼成提示词片段"""
+    memory_context = ""
+    
+    if memory_data['short_term'] or memory_data['long_term']:
+        memory_context = "--- 你的记忆 ---\n"
+        
+        # 短期记忆（最近的）
+        if memory_data['short_term']:
+            memory_context += "【短期记忆】\n"
+            for memory in memory_data['short_term'][:3]:  # 只显示最近3条
+                memory_context += f"• {memory['content']}\n"
+            memory_context += "\n"
+        
+        # 长期记忆（相关的）
+        if memory_data['long_term']:
+            memory_context += "【长期记忆】\n"
+            for memory in memory_data['long_term']:
+                similarity = memory.get('similarity', 0)
+                memory_context += f"• {memory['content']} (相关度: {1-similarity:.2f})\n"
+    return memory_context
+
+def _build_other_npcs_context(sorted_npcs: List[Dict[str, Any]], npc_id: str) -> str:
+    """构建其他NPC的行动上下文（不包含敏感信息）"""
+    other_npcs_context = ""
+    if len(sorted_npcs) > 1:
+        other_npcs_context = "--- 其他NPC的行动 ---\n"
+        for other_npc in sorted_npcs:
+            if other_npc.get('id') != npc_id:
+                other_npc_name = other_npc.get('name', '未知NPC')
+                other_npc_status = other_npc.get('status', '正常')
+                # 不暴露其他NPC的目标，只显示基本信息
+                other_npcs_context += f"• {other_npc_name} (状态: {other_npc_status})\n"
+        other_npcs_context += "\n"
+    return other_npcs_context
+
+def _roll_npc_perception(npc_id: str, npc_name: str, private_actions_this_turn: List[Dict[str, Any]],
+                         npc_sheets: Dict[str, Dict[str, Any]]) -> str:
+    """对本回合已提交的暗中行动进行察觉检定，返回该NPC额外察觉到的内容"""
+    perception_context = ""
+    observer_sheet = npc_sheets.get(npc_id, {})
+    observer_investigate = get_skill_value_from_sheet(observer_sheet, 'investigate')
+
+    for private_action in private_actions_this_turn:
+        actor_sheet = npc_sheets.get(private_action['npc_id'], {})
+        actor_stealth = get_skill_value_from_sheet(actor_sheet, 'stealth')
+        
+        dice_roll = random.randint(1, 100)
+        if dice_roll <= observer_investigate and dice_roll > actor_stealth / 2:
+            perception_context += f"[你察覺到 {private_action['npc_name']} 似乎在暗中{private_action['reaction'].replace('我', '').replace('说：', '低语了些什么...')}]\n"
+            logger.debug("[Perception][NPC] %s 成功察觉到 %s 的行动", npc_name, private_action['npc_name'])
+    return perception_context
+
+def _assemble_npc_context(public_context: str, other_npcs_context: str, perception_context: str, memory_context: str) -> str:
+    """
+    按固定顺序拼接NPC可见的完整上下文。
+    超出 NPC_CONTEXT_TOKEN_BUDGET 时依次裁剪：其他NPC列表、记忆（保留短期记忆和最相关的长期记忆）、察觉、公开情景。
+    """
+    perception_section = "--- 你额外察觉到的情况 ---\n" + perception_context if perception_context else ""
+    texts, _ = fit_sections([
+        PromptSection("public_context", public_context, priority=3),
+        PromptSection("other_npcs", other_npcs_context, max_tokens=200, priority=0),
+        PromptSection("perception", perception_section, max_tokens=300, priority=2),
+        PromptSection("memory", memory_context, max_tokens=600, priority=1),
+    ], NPC_CONTEXT_TOKEN_BUDGET)
+    return "".join(texts)
+
+def _reactions_addressing_npc(npc_info: Dict[str, Any], all_reactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """本回合已提交的公开反应中，提到了该NPC的那些"""
+    npc_name = npc_info.get('name')
+    return [
+        reaction for reaction in all_reactions
+        if reaction["visibility"] == "public" and reaction["npc_id"] != npc_info.get('id') and npc_name in reaction["reaction"]
+    ]
+
+def _npc_llm_config(npc_info: Dict[str, Any]) -> Dict[str, Any]:
+    """为NPC反应的LLM调用附加元数据，便于流式接口转发对应NPC的token增量"""
+    return {"metadata": {"stream_source": "npc", "llm_operation": "npc_reaction",
+                         "npc_id": npc_info.get('id'), "npc_name": npc_info.get('name')}}
+
+async def _commit_npc_reaction(state: AgentState, npc_info: Dict[str, Any], response, public_context: str,
+                         all_reactions: List[Dict[str, Any]], private_actions_this_turn: List[Dict[str, Any]]) -> str:
+    """按行动顺序提交一个NPC的反应，返回更新后的 public_context"""
+    npc_id = npc_info.get('id')
+    npc_name = npc_info.get('name')
+    try:
+        logger.trace("[NPC Loop] %s 的LLM原始回应: %s", npc_name, response.content)
+        npc_response = json.loads(response.content)
+        logger.trace("[NPC] %s 模型回应: %s", npc_id, npc_response)
+        await asyncio.to_thread(db_manager.update_npc_state, npc_id, npc_response.get('new_status'), npc_response.get('new_goal'))
+        
+        reaction_text = ""
+        if npc_response.get('dialogue'): reaction_text += f'说：“{npc_response["dialogue"]}”'
+        if npc_response.get('action'): reaction_text += f' {npc_response["action"]}'
+        
+        if reaction_text:
+            reaction_entry = {
+                "npc_id": npc_id, "npc_name": npc_name, 
+                "reaction": reaction_text.strip(),
+                "visibility": npc_response.get("visibility", "public")
+            }
+            all_reactions.append(reaction_entry)
+
+            if reaction_entry["visibility"] == "public":
+                public_context += f"{npc_name}{reaction_text}\n"
+            else:
+                private_actions_this_turn.append(reaction_entry)
+        
+        # 收集当前NPC的反应信息，稍后统一更新记忆
+        reaction_info = {
+            "npc_id": npc_id,
+            "npc_name": npc_name,
+            "reaction_text": reaction_text,
+            "visibility": npc_response.get("visibility", "public"),
+            "new_goal": npc_response.get('new_goal', ''),
+            "new_status": npc_response.get('new_status', ''),
+            "public_context": public_context
+        }
+        
+        # 保存反应信息，稍后统一处理记忆
+        state['npc_reactions_info'].append(reaction_info)
+
+    except (json.JSONDecodeError, KeyError) as e:
+        logger.warning("[NPC Loop] 解析 %s 的回应失败，跳过此NPC: %s", npc_name, e)
+    return public_context
+
 async def npc_loop_agent(state: AgentState):
     """
     NPC处理循环：实现动态、有序的对抗感知。
+    并发模式下先并行生成所有NPC的反应，再按敏捷顺序提交，仅在可见上下文变化时重新生成。
     """
-    print("--- 节点: NPC Loop ---")
+    logger.debug("--- 节点: NPC Loop ---")
     active_npcs_info = state.get('active_npcs', [])
-    print(f"[NPC] 本回合NPC数量: {len(active_npcs_info)}")
-    print(f"[NPC] active_npcs_info 详细内容: {active_npcs_info}")
+    logger.debug("[NPC] 本回合NPC数量: %s", len(active_npcs_info))
+    logger.trace("[NPC] active_npcs_info 详细内容: %s", active_npcs_info)
     if not active_npcs_info:
-        print("[NPC] 没有活跃NPC，返回空反应列表")
+        logger.debug("[NPC] 没有活跃NPC，返回空反应列表")
         state['npc_reactions'] = []
         return state
 
     all_reactions = []
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.7)
+    llm = get_llm(temperature=0.7)
+    
+    # 行动顺序和察觉检定所需的角色卡一次读取
+    npc_sheets = await aget_character_sheets([npc_info.get('id') for npc_info in active_npcs_info])
     
     def get_dex(npc_info):
-        sheet = get_character_sheet(npc_info.get('id'))
+        sheet = npc_sheets.get(npc_info.get('id'), {})
         return sheet.get('attributes', {}).get('dexterity', 50)
     
     sorted_npcs = sorted(active_npcs_info, key=get_dex, reverse=True)
-    print(f"[NPC Loop] 行动顺序: {[npc.get('name') for npc in sorted_npcs]}")
-    print(f"[NPC Loop] 排序后的NPC列表: {sorted_npcs}")
+    logger.debug("[NPC Loop] 行动顺序: %s", [npc.get('name') for npc in sorted_npcs])
+    logger.trace("[NPC Loop] 排序后的NPC列表: %s", sorted_npcs)
     
     public_context = state['turn_context_summary']
     
@@ -435,192 +622,86 @@ async def npc_loop_agent(state: AgentState):
         except:
             pass
     
-    print(f"[NPC Loop] public_context: {public_context}")
+    logger.trace("[NPC Loop] public_context: %s", public_context)
     private_actions_this_turn = []
-    
+
+    valid_npcs = []
     for npc_info in sorted_npcs:
-        npc_id = npc_info.get('id')
-        npc_name = npc_info.get('name')
-        print(f"[NPC Loop] 处理NPC: id={npc_id}, name={npc_name}")
-        if not npc_id or not npc_name: 
-            print(f"[NPC Loop] 跳过无效NPC: id={npc_id}, name={npc_name}")
+        if not npc_info.get('id') or not npc_info.get('name'):
+            logger.debug("[NPC Loop] 跳过无效NPC: id=%s, name=%s", npc_info.get('id'), npc_info.get('name'))
             continue
+        valid_npcs.append(npc_info)
 
-        perception_context = ""
-        observer_sheet = get_character_sheet(npc_id)
-        observer_investigate = get_skill_value_from_sheet(observer_sheet, 'investigate')
+    # 记忆与其他NPC列表在本回合内不受NPC反应影响，提前准备
+    prefetched_memories = dict(state.get('npc_memories') or {})
+    missing_memory_ids = [npc_info['id'] for npc_info in valid_npcs if npc_info['id'] not in prefetched_memories]
+    if missing_memory_ids:
+        prefetched_memories.update(await _prefetch_npc_memories(missing_memory_ids))
+    static_contexts = {
+        npc_info['id']: (
+            _build_other_npcs_context(sorted_npcs, npc_info['id']),
+            _build_npc_memory_context(prefetched_memories[npc_info['id']])
+        )
+        for npc_info in valid_npcs
+    }
 
-        for private_action in private_actions_this_turn:
-            actor_sheet = get_character_sheet(private_action['npc_id'])
-            actor_stealth = get_skill_value_from_sheet(actor_sheet, 'stealth')
-            
-            dice_roll = random.randint(1, 100)
-            if dice_roll <= observer_investigate and dice_roll > actor_stealth / 2:
-                perception_context += f"[你察覺到 {private_action['npc_name']} 似乎在暗中{private_action['reaction'].replace('我', '').replace('说：', '低语了些什么...')}]\n"
-                print(f"[Perception][NPC] {npc_name} 成功察觉到 {private_action['npc_name']} 的行动")
+    # 并发模式：以回合初始上下文为所有NPC预先发起生成
+    speculative = {}
+    if NPC_LOOP_CONCURRENT and len(valid_npcs) > 1:
+        for npc_info in valid_npcs:
+            other_npcs_context, memory_context = static_contexts[npc_info['id']]
+            context = _assemble_npc_context(public_context, other_npcs_context, "", memory_context)
+            task = asyncio.create_task(llm.ainvoke(build_npc_messages(npc_info, context), config=_npc_llm_config(npc_info)))
+            speculative[npc_info['id']] = (context, task)
+        logger.debug("[NPC Loop] 并发模式：已并行发起 %s 个NPC的反应生成", len(speculative))
 
-        # 加载NPC的短期记忆和长期记忆
-        memory_data = memory_manager.get_npc_memories_for_context(npc_id)
-        memory_context = ""
-        
-        if memory_data['short_term'] or memory_data['long_term']:
-            memory_context = "--- 你的记忆 ---\n"
-            
-            # 短期记忆（最近的）
-            if memory_data['short_term']:
-                memory_context += "【短期记忆】\n"
-                for memory in memory_data['short_term'][:3]:  # 只显示最近3条
-                    memory_context += f"• {memory['content']}\n"
-                memory_context += "\n"
-            
-            # 长期记忆（相关的）
-            if memory_data['long_term']:
-                memory_context += "【长期记忆】\n"
-                for memory in memory_data['long_term']:
-                    similarity = memory.get('similarity', 0)
-                    memory_context += f"• {memory['content']} (相关度: {1-similarity:.2f})\n"
-        
-        # 构建其他NPC的行动上下文（不包含敏感信息）
-        other_npcs_context = ""
-        if len(sorted_npcs) > 1:
-            other_npcs_context = "--- 其他NPC的行动 ---\n"
-            for other_npc in sorted_npcs:
-                if other_npc.get('id') != npc_id:
-                    other_npc_name = other_npc.get('name', '未知NPC')
-                    other_npc_status = other_npc.get('status', '正常')
-                    # 不暴露其他NPC的目标，只显示基本信息
-                    other_npcs_context += f"• {other_npc_name} (状态: {other_npc_status})\n"
-            other_npcs_context += "\n"
-        
-        full_context_for_npc = public_context
-        if other_npcs_context:
-            full_context_for_npc += other_npcs_context
-        if perception_context:
-            full_context_for_npc += "--- 你额外察觉到的情况 ---\n" + perception_context
-        if memory_context:
-            full_context_for_npc += memory_context
-
-        print(f"[NPC Loop] 给 {npc_name} 的完整上下文: {full_context_for_npc}")
-        print(f"[NPC Loop] 开始调用LLM生成 {npc_name} 的反应...")
-
-        system_prompt = f"""
-        你正在扮演NPC：{npc_name}。
-        你的当前状态是：'{npc_info.get('status', '正常')}'，你的目标是：'{npc_info.get('current_goal', '无')}'。
-        
-        【你的初始知识】：
-        {npc_info.get('initial_knowledge', '无特殊知识')}
-        
-        【扮演须知】：
-        {npc_info.get('roleplay_guidelines', '保持角色一致性')}
-        
-        【重要：增强自主性】
-        你是一个有独立思考能力的NPC，不要只是被动地回应玩家。你应该：
-        1. **主动追求目标**：根据你的目标主动行动，即使玩家没有直接与你互动
-        2. **观察环境变化**：注意周围发生的一切，包括其他NPC的行动
-        3. **与其他NPC互动**：主动与其他NPC交流、合作或产生冲突
-        4. **表达个人观点**：分享你的想法、担忧或建议
-        5. **推动剧情发展**：通过你的行动和对话推动故事向前发展
-        
-        【行动优先级】：
-        1. **优先回应玩家**：如果玩家直接问你问题或与你互动，必须优先回应
-        2. **关注事件结果**：如果刚才发生了事件，必须根据事件结果调整你的反应
-        3. 然后考虑你的个人目标和当前状态
-        4. 再观察环境和其他NPC的行动
-        5. 最后可以主动推进自己的剧情
-        
-        根据以下情景，以第一人称视角做出符合你个性的反应。请严格按照扮演须知来表现角色特征。
-        
-        你的回应必须是严格的JSON格式，包含以下字段：
-        - "visibility": "public" 或 "private"
-        - "dialogue": "你要说的话"
-        - "action": "你要做的动作"
-        - "new_status": "新状态"
-        - "new_goal": "新目标"
-        
-        【visibility 判断规则】：
-        - "public": 基本信息、直接回答、明显的行为动作、对当前情况的反应
-        - "private": 内心想法、秘密计划、暗中观察、不想让别人知道的行动
-        
-        示例：
-        - 正常行动、普通对话 → "public"
-        - 表达恐惧、寻求帮助 → "public"
-        - 内心独白、秘密计划 → "private"
-        - 暗中观察、偷偷行动 → "private"
-        
-        示例格式：
-        {{"visibility": "public", "dialogue": "天哪！", "action": "惊恐地后退", "new_status": "受惊", "new_goal": "寻求安全"}}
-        
-        注意：必须返回有效的JSON，不要有任何其他文字。
-        """
-        response = await llm.ainvoke([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=f"""
-                当前情景: {full_context_for_npc}
-
-                【思考提示】：
-请仔细思考以下问题，然后做出反应：
-
-1. **玩家互动优先级**：玩家是否在直接与你互动？如果是，必须优先回应！
-2. **事件结果影响**：刚才是否发生了事件？事件结果如何影响你的状态和反应？
-3. **你的个人目标**：你现在最想做什么？你的目标是什么？
-4. **环境观察**：你注意到了什么？有什么变化？
-5. **其他NPC**：你对其他NPC的行动有什么看法？想与他们互动吗？
-6. **主动行动**：在回应玩家后，你还能主动做什么来推进你的目标？
-7. **情感状态**：你现在的感受如何？这会影响你的行动吗？
-
-**重要提醒**：
-- 如果玩家直接问你问题或与你说话，你必须先回应玩家！
-- 如果刚才发生了事件，你必须根据事件结果调整你的反应和状态！
-            """)
-        ])
+    try:
+        for npc_info in valid_npcs:
+            npc_id = npc_info.get('id')
+            npc_name = npc_info.get('name')
+            logger.debug("[NPC Loop] 处理NPC: id=%s, name=%s", npc_id, npc_name)
 
-        try:
-            print(f"[NPC Loop] {npc_name} 的LLM原始回应: {response.content}")
-            npc_response = json.loads(response.content)
-            print(f"[NPC] {npc_id} 模型回应: {npc_response}")
-            db_manager.update_npc_state(npc_id, npc_response.get('new_status'), npc_response.get('new_goal'))
-            
-            reaction_text = ""
-            if npc_response.get('dialogue'): reaction_text += f'说：“{npc_response["dialogue"]}”'
-            if npc_response.get('action'): reaction_text += f' {npc_response["action"]}'
-            
-            if reaction_text:
-                reaction_entry = {
-                    "npc_id": npc_id, "npc_name": npc_name, 
-                    "reaction": reaction_text.strip(),
-                    "visibility": npc_response.get("visibility", "public")
-                }
-                all_reactions.append(reaction_entry)
-
-                if reaction_entry["visibility"] == "public":
-                    public_context += f"{npc_name}{reaction_text}\n"
-                else:
-                    private_actions_this_turn.append(reaction_entry)
-            
-            # 收集当前NPC的反应信息，稍后统一更新记忆
-            reaction_info = {
-                "npc_id": npc_id,
-                "npc_name": npc_name,
-                "reaction_text": reaction_text,
-                "visibility": npc_response.get("visibility", "public"),
-                "new_goal": npc_response.get('new_goal', ''),
-                "new_status": npc_response.get('new_status', ''),
-                "public_context": public_context
-            }
-            
-            # 保存反应信息，稍后统一处理记忆
-            state['npc_reactions_info'].append(reaction_info)
+            perception_context = _roll_npc_perception(npc_id, npc_name, private_actions_this_turn, npc_sheets)
+            other_npcs_context, memory_context = static_contexts[npc_id]
+            full_context_for_npc = _assemble_npc_context(public_context, other_npcs_context, perception_context, memory_context)
+
+            logger.trace("[NPC Loop] 给 %s 的完整上下文: %s", npc_name, full_context_for_npc)
 
-        except (json.JSONDecodeError, KeyError) as e:
-            print(f"解析NPC {npc_id} 的回应失败: {e}")
-            print(f"[NPC Loop] {npc_name} 的回应解析失败，跳过此NPC")
+            speculative_context, speculative_task = speculative.pop(npc_id, (None, None))
+            if speculative_task is None:
+                reuse = False
+            elif NPC_LOOP_RELEVANCE_RERUN:
+                reuse = not perception_context and not _reactions_addressing_npc(npc_info, all_reactions)
+            else:
+                reuse = speculative_context == full_context_for_npc
+            if reuse:
+                logger.debug("[NPC Loop] %s 的可见上下文未变化，采用并行生成的反应", npc_name)
+                response = await speculative_task
+            else:
+                if speculative_task is not None:
+                    _discard_task(speculative_task)
+                    logger.debug("[NPC Loop] %s 的可见上下文已被前序NPC改变，重新生成反应", npc_name)
+                logger.debug("[NPC Loop] 开始调用LLM生成 %s 的反应...", npc_name)
+                response = await llm.ainvoke(build_npc_messages(npc_info, full_context_for_npc), config=_npc_llm_config(npc_info))
+
+            reaction_count = len(all_reactions)
+            public_context = await _commit_npc_reaction(
+                state, npc_info, response, public_context, all_reactions, private_actions_this_turn
+            )
+            # 公开反应一经提交立即推送给流式客户端
+            if len(all_reactions) > reaction_count and all_reactions[-1]["visibility"] == "public":
+                await _emit_stream_event("npc_reaction", all_reactions[-1])
+    finally:
+        # 出错时不留下悬空的预生成任务
+        for _, task in speculative.values():
+            _discard_task(task)
 
     state['npc_reactions'] = all_reactions
-    print(f"[NPC] 本回合生成反应数量: {len(all_reactions)}")
+    logger.info("[NPC] 本回合生成反应数量: %s", len(all_reactions))
     
     # 统一更新所有NPC的短期记忆（包含完整的回合信息）
     if 'npc_reactions_info' in state and state['npc_reactions_info']:
-        print("[NPC] 开始统一更新NPC短期记忆...")
+        logger.debug("[NPC] 开始统一更新NPC短期记忆...")
         
         # 构建完整的回合总结
         full_round_summary = state['turn_context_summary']
@@ -651,12 +732,12 @@ async def npc_loop_agent(state: AgentState):
             }
             
             # 添加到短期记忆
-            memory_manager.add_npc_memory(
+            await memory_manager.aadd_npc_memory(
                 character_id=npc_id,
                 memory_text=current_observation,
                 context=context
             )
-            print(f"[NPC] 已更新 {npc_name} 的短期记忆")
+            logger.debug("[NPC] 已更新 %s 的短期记忆", npc_name)
         
         # 清理临时数据
         del state['npc_reactions_info']
@@ -664,34 +745,36 @@ async def npc_loop_agent(state: AgentState):
     return state
 
 async def narrative_synthesizer_agent(state: AgentState):
-    print("--- 节点: Narrative Synthesizer ---")
+    logger.debug("--- 节点: Narrative Synthesizer ---")
     final_narrative = state['turn_context_summary']
     event_to_complete = None
     
-    def process_event_effects(outcome_data):
+    async def process_event_effects(outcome_data):
         nonlocal final_narrative
         if 'narrative' in outcome_data: final_narrative = outcome_data['narrative'] + "\n"
         elif 'narrative_injection' in outcome_data: final_narrative += outcome_data['narrative_injection'] + "\n"
 
         if 'state_changes' in outcome_data:
-            print(f"[Narrative] 应用玩家状态更改: {outcome_data['state_changes']}")
-            apply_state_changes(state['character_id'], outcome_data['state_changes'])
+            logger.debug("[Narrative] 应用玩家状态更改: %s", outcome_data['state_changes'])
+            changed = await aapply_state_changes(state['character_id'], outcome_data['state_changes'])
+            # 回合结束时会整体写回玩家的 session_state，先合并刚刚修改的字段，避免被旧值覆盖
+            state['session_state'].update(changed.get(state['character_id'], {}))
         if 'npc_state_change' in outcome_data:
-            print(f"[Narrative] 应用NPC状态更改: {outcome_data['npc_state_change']}")
-            for change in outcome_data['npc_state_change']: db_manager.update_npc_state(change['character_id'], new_status=change.get('new_status'))
+            logger.debug("[Narrative] 应用NPC状态更改: %s", outcome_data['npc_state_change'])
+            for change in outcome_data['npc_state_change']: await asyncio.to_thread(db_manager.update_npc_state, change['character_id'], new_status=change.get('new_status'))
         if 'world_state_change' in outcome_data:
-            print(f"[Narrative] 应用世界状态更改: {outcome_data['world_state_change']}")
+            logger.debug("[Narrative] 应用世界状态更改: %s", outcome_data['world_state_change'])
             state['world_state'].update(outcome_data['world_state_change'])
         if 'map_state_change' in outcome_data:
-            print(f"[Narrative] 应用地图状态更改: {outcome_data['map_state_change']}")
+            logger.debug("[Narrative] 应用地图状态更改: %s", outcome_data['map_state_change'])
             # map_state_change 是一个字典，需要包装成列表
-            apply_map_state_changes([outcome_data['map_state_change']])
+            await aapply_map_state_changes([outcome_data['map_state_change']])
             # 同步更新state中的map_state，确保最终保存的是最新数据
             current_map_id = state['session_state'].get('current_map_id', 1)
-            state['map_state'] = get_map_state(current_map_id)
-            print(f"[Narrative] 已同步更新state中的map_state: {state['map_state']}")
+            state['map_state'] = await aget_map_state(current_map_id)
+            logger.trace("[Narrative] 已同步更新state中的map_state: %s", state['map_state'])
         if 'object_state_change' in outcome_data:
-            print(f"[Narrative] 应用物品状态更改: {outcome_data['object_state_change']}")
+            logger.debug("[Narrative] 应用物品状态更改: %s", outcome_data['object_state_change'])
             for change in outcome_data['object_state_change']:
                 obj_id = str(change['object_id'])
                 if obj_id in state['map_state']['objects']: state['map_state']['objects'][obj_id].update(change['set_state'])
@@ -701,13 +784,13 @@ async def narrative_synthesizer_agent(state: AgentState):
         event_to_complete = event_data
         effects = json.loads(event_data['effects'])
         outcome_key = 'success' if state['skill_check_result'].get('success') else 'failure'
-        print(f"[Narrative] 处理检定事件 {event_data.get('event_id')} 的分支: {outcome_key}")
-        process_event_effects(effects['outcomes'][outcome_key])
+        logger.debug("[Narrative] 处理检定事件 %s 的分支: %s", event_data.get('event_id'), outcome_key)
+        await process_event_effects(effects['outcomes'][outcome_key])
     elif state.get('triggered_event'):
         event = state['triggered_event']
         event_to_complete = event
-        print(f"[Narrative] 处理即时事件 {event.get('event_id')}")
-        process_event_effects(json.loads(event['effects']))
+        logger.debug("[Narrative] 处理即时事件 %s", event.get('event_id'))
+        await process_event_effects(json.loads(event['effects']))
 
     # NPC回复将在前端单独显示，这里只保留叙述部分
     # for reaction in state.get('npc_reactions', []):
@@ -718,57 +801,62 @@ async def narrative_synthesizer_agent(state: AgentState):
     player_investigate = get_skill_value_from_sheet(player_sheet, 'investigate')
     for reaction in state.get('npc_reactions', []):
         if reaction.get("visibility") == "private":
-            actor_sheet = get_character_sheet(reaction['npc_id'])
+            actor_sheet = await aget_character_sheet(reaction['npc_id'])
             actor_stealth = get_skill_value_from_sheet(actor_sheet, 'stealth')
             dice_roll = random.randint(1, 100)
             if dice_roll <= player_investigate and dice_roll > actor_stealth / 2:
                 perception_narrative = f"你察觉到了一些异样：{reaction['npc_name']}似乎{reaction['reaction'].replace('我', '在').replace('说：', '低声说了些什么……')}\n"
                 final_narrative += perception_narrative
-                print(f"[Perception][Player] 成功察觉到 {reaction['npc_name']} 的行动 (掷骰:{dice_roll} vs 调查:{player_investigate})")
+                logger.debug("[Perception][Player] 成功察觉到 %s 的行动 (掷骰:%s vs 调查:%s)", reaction['npc_name'], dice_roll, player_investigate)
 
     state['final_output'] = final_narrative.strip() or "一切如常。"
-    print(f"[Narrative] 最终叙事长度: {len(state['final_output'])}")
+    logger.debug("[Narrative] 最终叙事长度: %s", len(state['final_output']))
+    await _emit_stream_event("narrative", {"stage": "final", "content": state['final_output']})
 
     if event_to_complete and event_to_complete.get('if_unique'):
         if event_to_complete['event_id'] not in state['completed_events']:
             state['completed_events'].append(event_to_complete['event_id'])
-            print(f"[Narrative] 记录唯一事件完成: {event_to_complete['event_id']}")
+            logger.debug("[Narrative] 记录唯一事件完成: %s", event_to_complete['event_id'])
 
-    state['conversation_history'].append({"role": "user", "content": state['player_input']})
-    state['conversation_history'].append({"role": "assistant", "content": state['final_output']})
+    new_messages = [
+        {"role": "user", "content": state['player_input']},
+        {"role": "assistant", "content": state['final_output']},
+    ]
+    state['conversation_history'].extend(new_messages)
+    state['new_messages'].extend(new_messages)
     return state
 
 workflow = StateGraph(AgentState)
-workflow.add_node("orchestrator", orchestrator_agent)
-workflow.add_node("resolve_check", resolve_check_agent)
-workflow.add_node("setup_suspense", setup_suspense_agent)
-workflow.add_node("npc_loop", npc_loop_agent)
-workflow.add_node("narrative_synthesizer", narrative_synthesizer_agent)
+workflow.add_node("orchestrator", instrument_node("orchestrator", orchestrator_agent))
+workflow.add_node("resolve_check", instrument_node("resolve_check", resolve_check_agent))
+workflow.add_node("setup_suspense", instrument_node("setup_suspense", setup_suspense_agent))
+workflow.add_node("npc_loop", instrument_node("npc_loop", npc_loop_agent))
+workflow.add_node("narrative_synthesizer", instrument_node("narrative_synthesizer", narrative_synthesizer_agent))
 workflow.set_entry_point("orchestrator")
 
 def event_logic_router(state: AgentState):
-    print(f"[Router] 路由决策开始...")
-    print(f"[Router] pending_check_event_id: {state['session_state'].get('pending_check_event_id')}")
+    logger.debug("[Router] 路由决策开始...")
+    logger.debug("[Router] pending_check_event_id: %s", state['session_state'].get('pending_check_event_id'))
     
     if state['session_state'].get('pending_check_event_id'): 
-        print(f"[Router] 有挂起检定，路由到: resolve_check")
+        logger.debug("[Router] 有挂起检定，路由到: resolve_check")
         return "resolve_check"
     
     event = state.get('triggered_event')
-    print(f"[Router] 触发的事件: {event}")
+    logger.trace("[Router] 触发的事件: %s", event)
     
     if event:
         try:
             effects = json.loads(event.get('effects', '{}'))
             skill_check_required = effects.get('skill_check', {}).get('required', False)
-            print(f"[Router] 事件 {event.get('event_id')} 需要技能检定: {skill_check_required}")
+            logger.debug("[Router] 事件 %s 需要技能检定: %s", event.get('event_id'), skill_check_required)
             if skill_check_required: 
-                print(f"[Router] 路由到: setup_suspense")
+                logger.debug("[Router] 路由到: setup_suspense")
                 return "setup_suspense"
         except Exception as e:
-            print(f"[Router] 解析事件effects失败: {e}")
+            logger.warning("[Router] 解析事件effects失败: %s", e)
         
-    print(f"[Router] 默认路由到: npc_loop")
+    logger.debug("[Router] 默认路由到: npc_loop")
     return "npc_loop"
 
 workflow.add_conditional_edges(
@@ -788,164 +876,236 @@ graph_router = APIRouter()
 class ChatRequest(BaseModel):
     input: str
     selected_npcs: Optional[List[str]] = []
+    session_token: Optional[str] = None
 
-@graph_router.post("/chat")
-async def chat_endpoint(request: ChatRequest):
-    character_id = get_current_character_id()
-    if not character_id: raise HTTPException(status_code=400, detail="没有角色已加载。")
-    
-    session_state = get_session_state(character_id)
+async def _resolve_request_character(request: ChatRequest) -> str:
+    """根据会话令牌确定本回合的角色"""
+    character_id = await aresolve_character_id(request.session_token)
+    if not character_id:
+        if request.session_token:
+            raise HTTPException(status_code=401, detail="会话不存在或已过期，请重新进入游戏。")
+        raise HTTPException(status_code=400, detail="没有角色已加载。")
+    return character_id
+
+async def _build_initial_state(character_id: str, request: ChatRequest) -> AgentState:
+    """从Redis一次性加载本回合所需的全部状态，构造LangGraph的初始状态"""
+    snapshot = await aload_turn_snapshot(character_id)
+    session_state = snapshot['session_state']
     current_map_id = session_state.get('current_map_id', 1)
-    print(f"\n{'='*20} [ 新回合开始 ] {'='*20}")
-    print(f"[Chat] 请求输入: '{request.input}' | 角色: {character_id} | 地图: {current_map_id}")
+    logger.info("[Chat] 请求输入: '%s' | 角色: %s | 地图: %s", request.input, character_id, current_map_id)
     if request.selected_npcs:
-        print(f"[Chat] 玩家选择的NPC: {request.selected_npcs}")
+        logger.debug("[Chat] 玩家选择的NPC: %s", request.selected_npcs)
     
-    initial_state = AgentState(
+    return AgentState(
         player_input=request.input, character_id=character_id,
-        character_sheet=get_character_sheet(character_id),
-        session_state=session_state, world_state=get_world_state(),
-        map_state=get_map_state(current_map_id),
-        conversation_history=get_conversation_history(character_id),
-        completed_events=get_completed_event_ids(character_id),
+        character_sheet=snapshot['character_sheet'],
+        session_state=session_state, world_state=snapshot['world_state'],
+        map_state=snapshot['map_state'],
+        conversation_history=snapshot['conversation_history'], new_messages=[],
+        completed_events=snapshot['completed_events'],
         final_output="", active_npcs=[], interactable_objects=[], player_action={},
         triggered_event=None, skill_check_result=None, npc_reactions=[], 
         pending_event_data=None, turn_context_summary="", selected_npcs=request.selected_npcs,
-        npc_reactions_info=[]
+        npc_reactions_info=[], npc_memories={}
     )
+
+async def _persist_final_state(character_id: str, final_state: AgentState):
+    """回合结束后将状态以单个事务写回Redis"""
+    logger.debug("[Chat] 保存状态: world_state_keys=%s", list(final_state['world_state'].keys()))
+    logger.debug("[Chat] 保存状态: map_state_npcs=%s objects=%s", final_state['map_state'].get('npcs', []), list(final_state['map_state'].get('objects', {}).keys()))
+    logger.trace("[Chat] 保存状态: session_state=%s", final_state['session_state'])
+    logger.debug("[Chat] 保存状态: completed_events=%s", final_state['completed_events'])
+    
+    # 使用session_state中的当前地图ID，而不是回合开始时的current_map_id
+    current_map_id = final_state['session_state'].get('current_map_id', 1)
+    await asave_turn_snapshot(
+        character_id, final_state['world_state'],
+        current_map_id, final_state['map_state'],
+        final_state['session_state'],
+        final_state['new_messages'],
+        final_state['completed_events']
+    )
+    
+    logger.info("[Chat] 回合结束，回复长度: %s", len(final_state.get('final_output', '')))
+
+def _narrative_chat_message(content: str, timestamp: str) -> Dict[str, Any]:
+    return {"type": "narrative", "content": content, "timestamp": timestamp}
+
+def _npc_chat_message(reaction: Dict[str, Any], timestamp: str) -> Dict[str, Any]:
+    return {
+        "type": "npc",
+        "npc_name": reaction.get("npc_name", "未知NPC"),
+        "npc_id": reaction.get("npc_id", ""),
+        "content": reaction.get("reaction", ""),
+        "timestamp": timestamp
+    }
+
+def _build_chat_messages(final_state: AgentState) -> List[Dict[str, Any]]:
+    """构建聊天格式的回复"""
+    chat_messages = []
+    current_timestamp = datetime.now().isoformat()
+    
+    # 添加主要叙述
+    if final_state.get("final_output"):
+        chat_messages.append(_narrative_chat_message(final_state.get("final_output"), current_timestamp))
+    
+    # 添加NPC回复
+    for reaction in final_state.get('npc_reactions', []):
+        if reaction.get("visibility", "public") == "public":
+            chat_messages.append(_npc_chat_message(reaction, current_timestamp))
+    
+    return chat_messages
+
+@graph_router.post("/chat")
+async def chat_endpoint(request: ChatRequest):
+    character_id = await _resolve_request_character(request)
+    
     try:
-        player_action_parser.set_event_loop(asyncio.get_running_loop())
-        final_state = await app_langgraph.ainvoke(initial_state)
-        
-        print(f"[Chat] 保存状态: world_state_keys={list(final_state['world_state'].keys())}")
-        print(f"[Chat] 保存状态: map_state_npcs={final_state['map_state'].get('npcs', [])} objects={list(final_state['map_state'].get('objects', {}).keys())}")
-        print(f"[Chat] 保存状态: session_state={final_state['session_state']}")
-        print(f"[Chat] 保存状态: completed_events={final_state['completed_events']}")
-        
-        save_world_state(final_state['world_state'])
-        # 使用session_state中的当前地图ID，而不是函数开始时的current_map_id
-        current_map_id = final_state['session_state'].get('current_map_id', 1)
-        save_map_state(current_map_id, final_state['map_state'])
-        save_session_state(character_id, final_state['session_state'])
-        save_conversation_history(character_id, final_state['conversation_history'])
-        save_completed_event_ids(character_id, final_state['completed_events'])
-        
-        print(f"[Chat] 回复长度: {len(final_state.get('final_output', ''))}")
-        print(f"{'='*20} [ 回合结束 ] {'='*20}\n")
-        # 构建聊天格式的回复
-        chat_messages = []
-        current_timestamp = datetime.now().isoformat()
-        
-        # 添加主要叙述
-        if final_state.get("final_output"):
-            chat_messages.append({
-                "type": "narrative",
-                "content": final_state.get("final_output"),
-                "timestamp": current_timestamp
-            })
-        
-        # 添加NPC回复
-        for reaction in final_state.get('npc_reactions', []):
-            if reaction.get("visibility", "public") == "public":
-                chat_messages.append({
-                    "type": "npc",
-                    "npc_name": reaction.get("npc_name", "未知NPC"),
-                    "npc_id": reaction.get("npc_id", ""),
-                    "content": reaction.get("reaction", ""),
-                    "timestamp": current_timestamp
-                })
-        
-        return {"chat_messages": chat_messages}
+        # 同一会话的回合串行执行：状态的加载到写回之间不允许另一回合插入
+        async with get_turn_lock(character_id):
+            with turn_logging(character_id), turn_cache(), metrics.turns.time("chat"):
+                initial_state = await _build_initial_state(character_id, request)
+                player_action_parser.set_event_loop(asyncio.get_running_loop())
+                final_state = await app_langgraph.ainvoke(initial_state)
+                await _persist_final_state(character_id, final_state)
+        return {"chat_messages": _build_chat_messages(final_state)}
     except Exception as e:
-        import traceback
-        print(f"LangGraph 运行出错: {traceback.format_exc()}")
+        logger.error("LangGraph 运行出错", exc_info=True)
         raise HTTPException(status_code=500, detail="LangGraph 运行失败。")
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    """编码一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-async def soft_check_event_trigger(state: AgentState, all_events: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+@graph_router.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
     """
-    软性判断：当硬性前置条件都不满足时，让LLM判断是否有事件应该被触发
+    /chat 的流式版本 (Server-Sent Events)。各部分一旦产生就立即推送：
+    - narrative: 悬念叙事 (stage=suspense) 或最终叙事 (stage=final)
+    - npc: 每个已提交的公开NPC反应，格式与 /chat 的 chat_messages 相同
+    - token: NPC反应生成过程中的LLM token增量 (按 run_id 区分，被丢弃的预生成也可能出现，以 npc 事件为准)
+    - done: 状态写回完成后的完整 chat_messages
+    - error: 回合执行失败
     """
-    try:
-        from langchain_openai import ChatOpenAI
-        from langchain_core.messages import SystemMessage, HumanMessage
-        
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.1)
-        
-        # 过滤掉已完成且唯一的事件
-        available_events = [
-            event for event in all_events
-            if not (event.get('if_unique') and event['event_id'] in state['completed_events'])
-        ]
-        
-        if not available_events:
-            return None
-            
-        # 构建事件信息
-        events_info = []
-        for event in available_events:
-            event_desc = f"事件{event['event_id']}: {event['event_info']}"
-            if event.get('preconditions'):
+    character_id = await _resolve_request_character(request)
+
+    async def event_generator():
+        final_state = None
+        # 同一会话的回合串行执行，锁一直持有到状态写回完成
+        async with get_turn_lock(character_id):
+            turn_start = time.perf_counter()
+            with turn_logging(character_id), turn_cache():
                 try:
-                    preconditions = json.loads(event['preconditions'])
-                    event_desc += f" (前置条件: {preconditions})"
-                except:
-                    pass
-            events_info.append(event_desc)
-        
-        events_text = "\n".join(events_info)
-        
-        system_prompt = f"""
-        你是一个COC跑团的智能事件判断器。根据玩家的行动和当前状态，判断是否有事件应该被触发。
+                    initial_state = await _build_initial_state(character_id, request)
+                    player_action_parser.set_event_loop(asyncio.get_running_loop())
+                    async for event in app_langgraph.astream_events(initial_state, version="v2"):
+                        kind = event["event"]
+                        if kind == "on_custom_event":
+                            timestamp = datetime.now().isoformat()
+                            if event["name"] == "narrative":
+                                message = _narrative_chat_message(event["data"]["content"], timestamp)
+                                message["stage"] = event["data"].get("stage")
+                                yield _sse("narrative", message)
+                            elif event["name"] == "npc_reaction":
+                                yield _sse("npc", _npc_chat_message(event["data"], timestamp))
+                        elif kind == "on_chat_model_stream":
+                            metadata = event.get("metadata", {})
+                            if metadata.get("stream_source") != "npc":
+                                continue
+                            delta = getattr(event["data"].get("chunk"), "content", "")
+                            if delta:
+                                yield _sse("token", {
+                                    "npc_id": metadata.get("npc_id"), "npc_name": metadata.get("npc_name"),
+                                    "run_id": event["run_id"], "delta": delta
+                                })
+                        elif kind == "on_chain_end" and not event.get("parent_ids"):
+                            # 顶层图运行结束，输出即最终状态
+                            final_state = event["data"].get("output")
+
+                    if final_state is None:
+                        raise RuntimeError("LangGraph 未返回最终状态")
+                    await _persist_final_state(character_id, final_state)
+                    metrics.turns.observe(time.perf_counter() - turn_start, "chat_stream")
+                    yield _sse("done", {"chat_messages": _build_chat_messages(final_state)})
+                except Exception:
+                    metrics.turns.observe(time.perf_counter() - turn_start, "chat_stream", error=True)
+                    logger.error("LangGraph 流式运行出错", exc_info=True)
+                    yield _sse("error", {"detail": "LangGraph 运行失败。"})
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+SOFT_EVENT_CHECK_PREFIX = """你是一个COC跑团的智能事件判断器。根据用户消息中玩家的行动和当前状态，判断下方可用事件列表中是否有事件应该被触发。
+
+【重要】请严格按照以下标准判断是否触发事件：
 
-        当前玩家行动: {state.get('player_action', {})}
-        当前状态: 地图ID={state['session_state'].get('current_map_id')}, 载具ID={state['session_state'].get('current_vehicle_id')}
+1. **语义匹配度要求**：
+   - 玩家意图与事件描述必须有高度语义相似性（80%以上匹配）
+   - 不能因为"有点相似"就触发，必须是"非常相似"或"几乎一致"
 
-        可用事件列表:
-        {events_text}
+2. **状态兼容性**：
+   - 当前状态必须与事件要求的状态高度兼容
+   - 如果事件要求特定状态（如载具ID、位置等），当前状态必须基本满足
 
-        【重要】请严格按照以下标准判断是否触发事件：
+3. **逻辑合理性**：
+   - 事件触发必须符合游戏逻辑和剧情发展
+   - 不能为了触发而触发
 
-        1. **语义匹配度要求**：
-           - 玩家意图与事件描述必须有高度语义相似性（80%以上匹配）
-           - 不能因为"有点相似"就触发，必须是"非常相似"或"几乎一致"
+4. **触发阈值**：
+   - 只有当玩家行动与事件描述达到"几乎可以确定要触发"的程度时才触发
+   - 如果存在任何明显的不匹配，就不应该触发
 
-        2. **状态兼容性**：
-           - 当前状态必须与事件要求的状态高度兼容
-           - 如果事件要求特定状态（如载具ID、位置等），当前状态必须基本满足
+示例判断：
+- "我想回忆附近有什么地方" → 事件5（回忆避难所）： 高度匹配，应该触发
+- "让我看看这个挂坠" → 事件8（观察挂坠）： 高度匹配，应该触发
+- "我想开车" → 事件1（遭遇艾米利亚）： 语义不匹配，不应触发
+- "我想聊天" → 任何事件： 过于宽泛，不应触发
 
-        3. **逻辑合理性**：
-           - 事件触发必须符合游戏逻辑和剧情发展
-           - 不能为了触发而触发
+如果认为有事件应该触发，返回JSON格式：
+{"should_trigger": true, "event_id": 事件ID, "reason": "触发原因", "confidence": "高/中/低"}
 
-        4. **触发阈值**：
-           - 只有当玩家行动与事件描述达到"几乎可以确定要触发"的程度时才触发
-           - 如果存在任何明显的不匹配，就不应该触发
+如果认为没有事件应该触发，返回：
+{"should_trigger": false, "reason": "无合适事件或匹配度不足"}
 
-        示例判断：
-        - "我想回忆附近有什么地方" → 事件5（回忆避难所）： 高度匹配，应该触发
-        - "让我看看这个挂坠" → 事件8（观察挂坠）： 高度匹配，应该触发
-        - "我想开车" → 事件1（遭遇艾米利亚）： 语义不匹配，不应触发
-        - "我想聊天" → 任何事件： 过于宽泛，不应触发
+严格只返回JSON格式。
+"""
 
-        如果认为有事件应该触发，返回JSON格式：
-        {{"should_trigger": true, "event_id": 事件ID, "reason": "触发原因", "confidence": "高/中/低"}}
+async def soft_check_event_trigger(state: AgentState, all_events: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    软性判断：当硬性前置条件都不满足时，让LLM判断是否有事件应该被触发
+    """
+    try:
+        llm = get_llm(temperature=0.1)
         
-        如果认为没有事件应该触发，返回：
-        {{"should_trigger": false, "reason": "无合适事件或匹配度不足"}}
+        # 过滤掉已完成且唯一的事件
+        available_events = soft_check_candidates(all_events, state['completed_events'])
         
-        严格只返回JSON格式。
-        """
+        if not available_events:
+            return None
+            
+        # 构建事件信息
+        events_text = format_events_for_prompt(available_events)
         
+        # 静态规则在前，当前地图的事件列表其次，本回合的行动和状态放在用户消息中
+        system_prompt = f"{SOFT_EVENT_CHECK_PREFIX}\n可用事件列表:\n{events_text}\n"
         messages = [
             SystemMessage(content=system_prompt),
-            HumanMessage(content=f"玩家输入: {state.get('player_input', '')}")
+            HumanMessage(content=(
+                f"当前玩家行动: {state.get('player_action', {})}\n"
+                f"当前状态: 地图ID={state['session_state'].get('current_map_id')}, "
+                f"载具ID={state['session_state'].get('current_vehicle_id')}\n"
+                f"玩家输入: {state.get('player_input', '')}"
+            ))
         ]
         
-        response = await llm.ainvoke(messages)
+        content = await cached_ainvoke("soft_event_check", llm, messages, is_cacheable=is_json)
         
         try:
-            result = json.loads(response.content)
+            result = json.loads(content)
             if result.get('should_trigger') and result.get('event_id'):
                 # 检查置信度，只接受高置信度的触发
                 confidence = result.get('confidence', '低')
@@ -953,18 +1113,18 @@ async def soft_check_event_trigger(state: AgentState, all_events: List[Dict[str,
                     # 找到对应的事件
                     target_event = next((e for e in available_events if e['event_id'] == result['event_id']), None)
                     if target_event:
-                        print(f"[Soft Check] LLM判断应该触发事件 {result['event_id']}: {result.get('reason', '无原因')} (置信度: {confidence})")
+                        logger.info("[Soft Check] LLM判断应该触发事件 %s: %s (置信度: %s)", result['event_id'], result.get('reason', '无原因'), confidence)
                         return target_event
                 else:
-                    print(f"[Soft Check] LLM判断置信度过低({confidence})，拒绝触发事件 {result['event_id']}")
+                    logger.info("[Soft Check] LLM判断置信度过低(%s)，拒绝触发事件 %s", confidence, result['event_id'])
             else:
-                print(f"[Soft Check] LLM判断无事件应触发: {result.get('reason', '无原因')}")
+                logger.debug("[Soft Check] LLM判断无事件应触发: %s", result.get('reason', '无原因'))
         except json.JSONDecodeError:
-            print(f"[Soft Check] LLM回应JSON解析失败: {response.content}")
+            logger.warning("[Soft Check] LLM回应JSON解析失败: %s", content)
             
         return None
         
     except Exception as e:
-        print(f"[Soft Check] 软性判断出错: {e}")
+        logger.error("[Soft Check] 软性判断出错: %s", e)
         return None
 
@@ -0,0 +1,142 @@
+# llm_cache.py
+"""
+确定性LLM调用（意图解析、NPC筛选、软性事件判断）的响应缓存。
+键为 归一化后的提示词 + 模型参数 的哈希，值存放在Redis中：
+每条缓存带TTL，每个命名空间用一个有序集合记录访问时间，超过容量时按LRU淘汰。
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+from typing import Dict, Any, List, Optional, Callable
+
+from redis_manager import get_redis_client, get_async_redis_client
+from log_manager import get_logger
+
+logger = get_logger("llm_cache")
+
+CACHE_KEY_PREFIX = "llm_cache:"
+LRU_KEY_PREFIX = "llm_cache_lru:"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    """去除提示词模板缩进带来的空白差异"""
+    return _WHITESPACE_RE.sub(" ", text or "").strip()
+
+
+class LLMResponseCache:
+    def __init__(self):
+        self.enabled = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.ttl = int(os.getenv("LLM_CACHE_TTL", 21600))
+        self.max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1000))
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def make_key(self, namespace: str, llm, messages: List[Any]) -> str:
+        payload = {
+            "model": getattr(llm, "model_name", None),
+            "temperature": getattr(llm, "temperature", None),
+            "messages": [(getattr(m, "type", ""), _normalize(getattr(m, "content", str(m)))) for m in messages],
+        }
+        digest = hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        return f"{CACHE_KEY_PREFIX}{namespace}:{digest}"
+
+    def _count(self, namespace: str, field: str):
+        stats = self._stats.setdefault(namespace, {"hits": 0, "misses": 0, "stores": 0, "evictions": 0})
+        stats[field] += 1
+
+    async def aget(self, namespace: str, key: str) -> Optional[str]:
+        redis_client = get_async_redis_client()
+        if not redis_client:
+            return None
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.zadd(f"{LRU_KEY_PREFIX}{namespace}", {key: time.time()}, xx=True)
+            cached, _ = await pipe.execute()
+        except Exception as e:
+            logger.warning("[LLM Cache] 读取缓存失败: %s", e)
+            return None
+        self._count(namespace, "hits" if cached is not None else "misses")
+        return cached
+
+    async def aset(self, namespace: str, key: str, content: str):
+        redis_client = get_async_redis_client()
+        if not redis_client:
+            return
+        lru_key = f"{LRU_KEY_PREFIX}{namespace}"
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.setex(key, self.ttl, content)
+            pipe.zadd(lru_key, {key: time.time()})
+            pipe.zcard(lru_key)
+            _, _, size = await pipe.execute()
+            self._count(namespace, "stores")
+            if size > self.max_entries:
+                evicted = await redis_client.zpopmin(lru_key, size - self.max_entries)
+                if evicted:
+                    await redis_client.delete(*[member for member, _ in evicted])
+                    for _ in evicted:
+                        self._count(namespace, "evictions")
+        except Exception as e:
+            logger.warning("[LLM Cache] 写入缓存失败: %s", e)
+
+    def invalidate(self, namespace: Optional[str] = None):
+        """使某个命名空间（默认全部）的缓存失效，用于剧本内容变更后"""
+        redis_client = get_redis_client()
+        if not redis_client:
+            return
+        namespaces = [namespace] if namespace else [
+            key[len(LRU_KEY_PREFIX):] for key in redis_client.scan_iter(match=f"{LRU_KEY_PREFIX}*")
+        ]
+        for ns in namespaces:
+            lru_key = f"{LRU_KEY_PREFIX}{ns}"
+            members = redis_client.zrange(lru_key, 0, -1)
+            if members:
+                redis_client.delete(*members)
+            redis_client.delete(lru_key)
+            logger.info("[LLM Cache] 已清空命名空间 %s 的 %s 条缓存", ns, len(members))
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {}
+        for namespace, counters in self._stats.items():
+            lookups = counters["hits"] + counters["misses"]
+            stats[namespace] = {**counters, "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0}
+        return stats
+
+
+# 创建全局实例
+llm_cache = LLMResponseCache()
+
+async def cached_ainvoke(namespace: str, llm, messages: List[Any],
+                         is_cacheable: Callable[[str], bool] = None) -> str:
+    """
+    带缓存的 llm.ainvoke，返回响应文本。
+    is_cacheable 用于拒绝缓存无效回应（例如无法解析的JSON）。
+    """
+    config = {"metadata": {"llm_operation": namespace}}
+    if not llm_cache.enabled:
+        response = await llm.ainvoke(messages, config=config)
+        return response.content
+
+    key = llm_cache.make_key(namespace, llm, messages)
+    cached = await llm_cache.aget(namespace, key)
+    if cached is not None:
+        logger.debug("[LLM Cache] 命中缓存: %s", namespace)
+        return cached
+
+    response = await llm.ainvoke(messages, config=config)
+    content = response.content
+    if is_cacheable is None or is_cacheable(content):
+        await llm_cache.aset(namespace, key, content)
+    return content
+
+def is_json(content: str) -> bool:
+    try:
+        json.loads(content)
+        return True
+    except (json.JSONDecodeError, TypeError):
+        return False
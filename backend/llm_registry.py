@@ -0,0 +1,97 @@
+# llm_registry.py
+"""
+进程级LLM客户端注册表：
+所有 ChatOpenAI 实例共享同一组 keep-alive HTTP 连接池，按 (模型, 温度) 缓存，
+避免每次调用都新建 HTTP 客户端并重新进行 TLS 握手。
+"""
+
+import os
+from typing import Dict, Any, Optional, Tuple
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+from metrics import llm_metrics_handler
+from log_manager import get_logger
+
+logger = get_logger("llm_registry")
+
+DEFAULT_MODEL = "gpt-4o-mini"
+
+
+class LLMRegistry:
+    def __init__(self):
+        self._http_client: Optional[httpx.Client] = None
+        self._http_async_client: Optional[httpx.AsyncClient] = None
+        self._clients: Dict[Tuple, ChatOpenAI] = {}
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60)),
+        )
+
+    def _get_http_clients(self) -> Tuple[httpx.Client, httpx.AsyncClient]:
+        """延迟创建共享的同步/异步连接池"""
+        timeout = httpx.Timeout(float(os.getenv("LLM_TIMEOUT", 60)), connect=10.0)
+        if self._http_client is None:
+            self._http_client = httpx.Client(limits=self._limits(), timeout=timeout)
+        if self._http_async_client is None:
+            self._http_async_client = httpx.AsyncClient(limits=self._limits(), timeout=timeout)
+        return self._http_client, self._http_async_client
+
+    def get_llm(self, model: str = DEFAULT_MODEL, temperature: float = 0.0, **kwargs: Any) -> ChatOpenAI:
+        """
+        获取指定模型和温度的LLM客户端。同一配置在进程内只创建一次，
+        ChatOpenAI 本身无状态，可在多个并发任务之间安全共享。
+        """
+        key = (model, float(temperature), tuple(sorted(kwargs.items())))
+        llm = self._clients.get(key)
+        if llm is None:
+            http_client, http_async_client = self._get_http_clients()
+            llm = ChatOpenAI(
+                model=model,
+                temperature=temperature,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                callbacks=[llm_metrics_handler],
+                **kwargs
+            )
+            self._clients[key] = llm
+            logger.info("[LLM Registry] 创建LLM客户端: model=%s, temperature=%s", model, temperature)
+        return llm
+
+    async def warmup(self):
+        """启动时预先建立到API的连接，使第一个请求不必承担TLS握手"""
+        if os.getenv("LLM_WARMUP", "true").lower() not in ("1", "true", "yes"):
+            return
+        _, http_async_client = self._get_http_clients()
+        base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+        try:
+            await http_async_client.get(
+                f"{base_url}/models",
+                headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"},
+                timeout=5.0
+            )
+            logger.info("[LLM Registry] 连接池预热完成: %s", base_url)
+        except Exception as e:
+            logger.warning("[LLM Registry] 连接池预热失败（不影响后续请求）: %s", e)
+
+    async def aclose(self):
+        """关闭共享连接池；之后的 get_llm 会重新创建"""
+        if self._http_async_client is not None:
+            await self._http_async_client.aclose()
+        if self._http_client is not None:
+            self._http_client.close()
+        self._http_client = None
+        self._http_async_client = None
+        self._clients.clear()
+
+
+# 创建全局实例
+llm_registry = LLMRegistry()
+
+def get_llm(model: str = DEFAULT_MODEL, temperature: float = 0.0, **kwargs: Any) -> ChatOpenAI:
+    """获取共享LLM客户端的便捷函数"""
+    return llm_registry.get_llm(model, temperature, **kwargs)
@@ -0,0 +1,183 @@
+# log_manager.py
+"""
+结构化日志模块，替代热路径上的 print：
+- 按模块设置级别：LOG_LEVEL=INFO（默认），LOG_LEVELS="graph=DEBUG,npc_filter=WARNING"
+- 惰性格式化：logger.debug("map_state: %s", map_state)，级别未启用时参数不会被格式化
+- 大对象截断：每个参数渲染后最多 LOG_MAX_ARG_CHARS 个字符
+- 回合追踪采样：trace() 在模块级别为DEBUG时总是输出，否则只在被采样的回合输出 (LOG_TRACE_SAMPLE_RATE)
+- 每条日志自动带上当前回合编号和角色ID；LOG_FORMAT=json 时每行输出一个JSON对象
+"""
+
+import os
+import sys
+import json
+import random
+import logging
+import itertools
+import contextvars
+from contextlib import contextmanager
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+ROOT_LOGGER_NAME = "trpg"
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+MAX_ARG_CHARS = int(os.getenv("LOG_MAX_ARG_CHARS", 2000))
+TRACE_SAMPLE_RATE = float(os.getenv("LOG_TRACE_SAMPLE_RATE", 0.0))
+
+# 当前回合的日志上下文: {"turn": 回合编号, "character_id": ..., "sampled": bool}
+_turn_context: contextvars.ContextVar = contextvars.ContextVar("turn_log_context", default=None)
+_turn_counter = itertools.count(1)
+_configured = False
+
+
+def _cap(value: Any) -> Any:
+    """数值保持原样以支持 %d / %.1f，其余对象转为字符串并截断"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else str(value)
+    if len(text) > MAX_ARG_CHARS:
+        return f"{text[:MAX_ARG_CHARS]}...(共{len(text)}字符)"
+    return text
+
+
+class _ContextFilter(logging.Filter):
+    """只对真正输出的日志执行：截断参数、附加回合上下文"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.args:
+            args = (record.args,) if isinstance(record.args, Mapping) else record.args
+            record.args = tuple(_cap(arg) for arg in args)
+        context = _turn_context.get()
+        record.turn = context["turn"] if context else None
+        record.character_id = context["character_id"] if context else None
+        if not hasattr(record, "fields"):
+            record.fields = {}
+        record.module_name = record.name[len(ROOT_LOGGER_NAME) + 1:] or record.name
+        return True
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        turn = f" turn={record.turn}" if record.turn else ""
+        fields = "".join(f" {k}={_cap(v)}" for k, v in record.fields.items())
+        line = f"{self.formatTime(record, '%H:%M:%S')} {record.levelname:<7} [{record.module_name}]{turn} {message}{fields}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "module": record.module_name,
+            "msg": record.getMessage(),
+        }
+        if record.turn:
+            payload["turn"] = record.turn
+            payload["character_id"] = record.character_id
+        payload.update({k: _cap(v) for k, v in record.fields.items()})
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def _parse_module_levels(spec: str) -> Dict[str, int]:
+    levels = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        module, level = item.split("=", 1)
+        level_value = logging.getLevelName(level.strip().upper())
+        if isinstance(level_value, int):
+            levels[module.strip()] = level_value
+    return levels
+
+
+def configure_logging(force: bool = False):
+    """初始化日志输出（只执行一次），可重复调用"""
+    global _configured
+    if _configured and not force:
+        return
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(_ContextFilter())
+    handler.setFormatter(_JsonFormatter() if os.getenv("LOG_FORMAT", "text").lower() == "json" else _TextFormatter())
+    root.addHandler(handler)
+    root.propagate = False
+    root.setLevel(logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper()))
+    for module, level in _parse_module_levels(os.getenv("LOG_LEVELS", "")).items():
+        logging.getLogger(f"{ROOT_LOGGER_NAME}.{module}").setLevel(level)
+    _configured = True
+
+
+class ModuleLogger:
+    """
+    模块日志器。额外的关键字参数作为结构化字段输出：
+    logger.info("[Orchestrator] 事件已触发", event_id=3)
+    """
+    def __init__(self, module: str):
+        self.module = module
+        self._logger = logging.getLogger(f"{ROOT_LOGGER_NAME}.{module}")
+
+    def is_enabled_for(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level: int, msg: str, args: tuple, fields: Dict[str, Any], exc_info=False):
+        self._logger.log(level, msg, *args, extra={"fields": fields}, exc_info=exc_info, stacklevel=3)
+
+    def debug(self, msg: str, *args, **fields):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, msg, args, fields)
+
+    def info(self, msg: str, *args, **fields):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, msg, args, fields)
+
+    def warning(self, msg: str, *args, exc_info=False, **fields):
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, msg, args, fields, exc_info=exc_info)
+
+    def error(self, msg: str, *args, exc_info=False, **fields):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, args, fields, exc_info=exc_info)
+
+    def trace(self, msg: str, *args, **fields):
+        """整回合的详细追踪（完整状态、提示词上下文、LLM原始回应等）"""
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._log(TRACE if self._logger.isEnabledFor(TRACE) else logging.DEBUG, msg, args, fields)
+            return
+        context = _turn_context.get()
+        if context and context["sampled"]:
+            # 被采样的回合绕过级别检查直接交给处理器
+            record = self._logger.makeRecord(
+                self._logger.name, TRACE, "(trace)", 0, msg, args, None, extra={"fields": fields}
+            )
+            self._logger.handle(record)
+
+
+def get_logger(module: str) -> ModuleLogger:
+    configure_logging()
+    return ModuleLogger(module)
+
+
+@contextmanager
+def turn_logging(character_id: str, sampled: Optional[bool] = None):
+    """标记一个回合的日志上下文；回合内的 trace() 是否输出由采样决定"""
+    if sampled is None:
+        sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    token = _turn_context.set({"turn": next(_turn_counter), "character_id": character_id, "sampled": sampled})
+    try:
+        yield
+    finally:
+        try:
+            _turn_context.reset(token)
+        except ValueError:
+            # 流式响应的生成器可能在其他上下文中被关闭
+            _turn_context.set(None)
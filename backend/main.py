@@ -1,5 +1,6 @@
 # main.py
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
@@ -13,6 +14,14 @@ from background import background_router
 from character import character_router
 from redis_manager import redis_manager, save_world_state
 from databaseManager import db_manager
+from event_engine import event_engine
+from scenario_catalog import scenario_catalog
+from map_graph import map_graph
+from prompt_layout import npc_prompt_cache
+from llm_registry import llm_registry
+from llm_cache import llm_cache
+from metrics import metrics
+from memory_compression import memory_compression_worker
 from player_action_parser import add_websocket_connection, remove_websocket_connection
 
 load_dotenv()
@@ -37,6 +46,13 @@ async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时执行
     redis_manager.initialize()
+    # 剧本静态内容在启动时一次性读入内存，事件随后编译
+    scenario_catalog.load()
+    event_engine.load()
+    # 预热共享的LLM连接池
+    await llm_registry.warmup()
+    # NPC记忆压缩在后台执行，不占用回合
+    await memory_compression_worker.start()
     # --- 新增：加载世界状态到Redis ---
     if redis_manager.is_connected():
         initial_world_state = db_manager.get_initial_world_state()
@@ -45,7 +61,11 @@ async def lifespan(app: FastAPI):
     
     yield
     # 关闭时执行
+    await memory_compression_worker.stop()
+    await llm_registry.aclose()
+    await redis_manager.aclose()
     redis_manager.close()
+    db_manager.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -78,6 +98,34 @@ def health_check():
     redis_status = "connected" if redis_manager.is_connected() else "disconnected"
     return {"status": "healthy", "redis": redis_status}
 
+@app.get("/llm_cache/stats")
+def llm_cache_stats():
+    """LLM响应缓存的命中/未命中统计"""
+    return llm_cache.get_stats()
+
+@app.post("/scenario/reload")
+def reload_scenario():
+    """剧本内容修改后重新加载剧本目录和事件，并清空LLM响应缓存"""
+    event_engine.reload()
+    map_graph.invalidate()
+    npc_prompt_cache.invalidate()
+    return {"status": "success"}
+
+@app.get("/memory_compression/stats")
+def memory_compression_stats():
+    """后台记忆压缩队列的状态"""
+    return memory_compression_worker.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    """Prometheus 文本格式的回合/节点/依赖耗时指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/metrics/summary")
+def metrics_summary():
+    """按节点和依赖汇总的 p50/p95/p99 (毫秒)，便于直接查看"""
+    return metrics.snapshot()
+
 @app.websocket("/ws/dice")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
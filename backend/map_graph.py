@@ -0,0 +1,173 @@
+# map_graph.py
+"""
+地图连通图服务：把剧本中的初始连通关系（maps.accessible_locations）和
+Redis map_state 中由事件修改过的 accessible_maps 合并成一张邻接表，缓存在进程内。
+- 一次 MGET 读取所有地图的 map_state，之后的邻接、路径和可达性查询都是内存操作
+- Redis中显式保存的空列表表示"该地图已无出口"，同样被缓存，不会触发反复重新初始化
+- 路径和可达性查询的结果（包括"不可达"）随快照一起缓存
+- 可访问性变更（update_map_accessibility 等）会调用 invalidate()，回合写回改变了出口时同样失效；
+  多进程部署时其他进程的修改最多在 MAP_GRAPH_TTL 秒（默认60）后生效
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from scenario_catalog import scenario_catalog
+from log_manager import get_logger
+
+logger = get_logger("map_graph")
+
+
+class _GraphSnapshot:
+    """某一时刻的邻接表，以及基于它计算出的路径/可达性缓存"""
+    def __init__(self, adjacency: Dict[int, List[int]]):
+        self.adjacency = adjacency
+        self.loaded_at = time.monotonic()
+        self.paths: Dict[tuple, Optional[List[int]]] = {}
+        self.reachable: Dict[int, Set[int]] = {}
+
+
+class MapGraph:
+    def __init__(self):
+        self.ttl = float(os.getenv("MAP_GRAPH_TTL", 60))
+        self._snapshot: Optional[_GraphSnapshot] = None
+        # 每次 invalidate() 加一：重新加载开始后快照被失效时，加载结果已过时，不再保存
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    # --- 加载 ---
+    def _map_state_keys(self, map_ids: List[int]) -> List[str]:
+        from redis_manager import MAP_STATE_KEY_PREFIX
+        return [f"{MAP_STATE_KEY_PREFIX}{map_id}" for map_id in map_ids]
+
+    def _build_adjacency(self, map_ids: List[int], raw_states: List[Optional[str]]) -> Dict[int, List[int]]:
+        adjacency = {}
+        for map_id, raw in zip(map_ids, raw_states):
+            accessible = None
+            if raw:
+                try:
+                    accessible = json.loads(raw).get("accessible_maps")
+                except (json.JSONDecodeError, AttributeError):
+                    logger.warning("地图%s的map_state格式错误，使用剧本设定", map_id)
+            if accessible is None:
+                accessible = scenario_catalog.static_accessible_maps(map_id)
+            adjacency[map_id] = [int(target) for target in accessible]
+        return adjacency
+
+    def _is_fresh(self, snapshot: Optional[_GraphSnapshot]) -> bool:
+        return snapshot is not None and time.monotonic() - snapshot.loaded_at < self.ttl
+
+    def _store_snapshot(self, generation: int, map_ids: List[int], raw_states: List[Optional[str]]) -> _GraphSnapshot:
+        """用加载到的 map_state 生成快照；加载期间调用过 invalidate() 时只返回给本次查询，不替换缓存"""
+        raw_states = list(raw_states) + [None] * (len(map_ids) - len(raw_states))
+        snapshot = _GraphSnapshot(self._build_adjacency(map_ids, raw_states))
+        if generation == self._generation:
+            self._snapshot = snapshot
+            logger.debug("地图连通图已加载: %s", snapshot.adjacency)
+        else:
+            logger.debug("地图连通图在加载期间被失效，本次结果不缓存")
+        return snapshot
+
+    def _adjacency_snapshot(self) -> _GraphSnapshot:
+        snapshot = self._snapshot
+        if self._is_fresh(snapshot):
+            return snapshot
+        with self._lock:
+            if self._is_fresh(self._snapshot):
+                return self._snapshot
+            from redis_manager import get_redis_client
+            generation = self._generation
+            map_ids = [map_data['id'] for map_data in scenario_catalog.maps()]
+            redis_client = get_redis_client()
+            raw_states = redis_client.mget(self._map_state_keys(map_ids)) if redis_client and map_ids else []
+            return self._store_snapshot(generation, map_ids, raw_states)
+
+    async def _aadjacency_snapshot(self) -> _GraphSnapshot:
+        snapshot = self._snapshot
+        if self._is_fresh(snapshot):
+            return snapshot
+        from redis_manager import get_async_redis_client
+        generation = self._generation
+        map_ids = [map_data['id'] for map_data in scenario_catalog.maps()]
+        redis_client = get_async_redis_client()
+        raw_states = await redis_client.mget(self._map_state_keys(map_ids)) if redis_client and map_ids else []
+        return self._store_snapshot(generation, map_ids, raw_states)
+
+    def invalidate(self):
+        """地图可访问性或剧本内容变化后调用，下次查询时重新加载"""
+        self._generation += 1
+        self._snapshot = None
+
+    def observe_map_state(self, map_id: int, map_state: dict):
+        """map_state 被整体写回时调用：其中的出口与缓存的邻接表不一致时使快照失效"""
+        snapshot = self._snapshot
+        accessible = map_state.get("accessible_maps")
+        if snapshot is None or accessible is None or map_id not in snapshot.adjacency:
+            return
+        if [int(target) for target in accessible] != snapshot.adjacency[map_id]:
+            logger.debug("地图%s的出口已随回合写回改变，连通图将重新加载", map_id)
+            self.invalidate()
+
+    # --- 查询 ---
+    def neighbors(self, map_id: int) -> List[int]:
+        """从该地图可以直接前往的地图"""
+        return list(self._adjacency_snapshot().adjacency.get(map_id, []))
+
+    async def aneighbors(self, map_id: int) -> List[int]:
+        """neighbors 的异步版本（快照过期时用异步客户端重新加载）"""
+        return list((await self._aadjacency_snapshot()).adjacency.get(map_id, []))
+
+    def shortest_path(self, from_map_id: int, to_map_id: int) -> Optional[List[int]]:
+        """最短路径（包含起点和终点）；不可达返回 None"""
+        snapshot = self._adjacency_snapshot()
+        key = (from_map_id, to_map_id)
+        if key not in snapshot.paths:
+            snapshot.paths[key] = self._bfs_path(snapshot.adjacency, from_map_id, to_map_id)
+        path = snapshot.paths[key]
+        return list(path) if path is not None else None
+
+    def reachable(self, from_map_id: int) -> Set[int]:
+        """从该地图出发经任意步数可以到达的地图（不含起点，除非存在回路）"""
+        snapshot = self._adjacency_snapshot()
+        if from_map_id not in snapshot.reachable:
+            seen = set()
+            queue = deque(snapshot.adjacency.get(from_map_id, []))
+            while queue:
+                map_id = queue.popleft()
+                if map_id in seen:
+                    continue
+                seen.add(map_id)
+                queue.extend(snapshot.adjacency.get(map_id, []))
+            snapshot.reachable[from_map_id] = seen
+        return set(snapshot.reachable[from_map_id])
+
+    def is_reachable(self, from_map_id: int, to_map_id: int) -> bool:
+        return to_map_id in self.reachable(from_map_id)
+
+    @staticmethod
+    def _bfs_path(adjacency: Dict[int, List[int]], from_map_id: int, to_map_id: int) -> Optional[List[int]]:
+        if from_map_id == to_map_id:
+            return [from_map_id]
+        previous = {from_map_id: None}
+        queue = deque([from_map_id])
+        while queue:
+            map_id = queue.popleft()
+            for next_id in adjacency.get(map_id, []):
+                if next_id in previous:
+                    continue
+                previous[next_id] = map_id
+                if next_id == to_map_id:
+                    path = [next_id]
+                    while previous[path[-1]] is not None:
+                        path.append(previous[path[-1]])
+                    return path[::-1]
+                queue.append(next_id)
+        return None
+
+
+# 创建全局实例
+map_graph = MapGraph()
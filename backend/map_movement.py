@@ -4,56 +4,33 @@
 import json
 from typing import Dict, Any, Optional
 from databaseManager import db_manager
+from scenario_catalog import scenario_catalog
 from redis_manager import (
-    get_session_state, save_session_state,
-    get_map_state, save_map_state,
+    get_session_state, save_session_state, update_session_fields,
+    save_map_state,
     get_character_sheet, save_character_sheet,
-    get_map_accessibility, update_map_accessibility
+    initial_session_from_sheet
 )
+from map_graph import map_graph
+from log_manager import get_logger
+
+logger = get_logger("map_movement")
 
 class MapMovementManager:
     def __init__(self):
         self.db_manager = db_manager
     
     def get_accessible_maps(self, current_map_id: int) -> list:
-        """获取当前地图可访问的其他地图（优先使用Redis中的动态状态）"""
+        """获取当前地图可访问的其他地图（优先使用Redis中的动态状态，由地图连通图服务缓存）"""
         try:
-            # 优先从Redis获取动态可访问性
-            redis_accessible = get_map_accessibility(current_map_id)
-            if redis_accessible:
-                print(f"从Redis获取地图{current_map_id}的可访问性: {redis_accessible}")
-                return redis_accessible
-            
-            # 如果Redis中没有，从数据库获取并初始化
-            result = self.db_manager.execute_query(
-                "SELECT accessible_locations FROM maps WHERE id = ?",
-                (current_map_id,)
-            )
-            if result and result[0].get('accessible_locations'):
-                accessible = json.loads(result[0]['accessible_locations'])
-                # 保存到Redis
-                from redis_manager import save_map_accessibility
-                save_map_accessibility(current_map_id, accessible)
-                print(f"从数据库初始化地图{current_map_id}的可访问性: {accessible}")
-                return accessible
-            return []
+            return map_graph.neighbors(current_map_id)
         except Exception as e:
-            print(f"获取可访问地图失败: {e}")
+            logger.warning("获取可访问地图失败: %s", e)
             return []
     
     def get_map_info(self, map_id: int) -> Optional[Dict[str, Any]]:
-        """获取地图信息"""
-        try:
-            result = self.db_manager.execute_query(
-                "SELECT * FROM maps WHERE id = ?",
-                (map_id,)
-            )
-            if result:
-                return result[0]
-            return None
-        except Exception as e:
-            print(f"获取地图信息失败: {e}")
-            return None
+        """获取地图信息（剧本目录中查找）"""
+        return scenario_catalog.get_map(map_id)
     
     def can_move_to_map(self, character_id: str, target_map_id: int) -> bool:
         """检查角色是否可以移动到目标地图"""
@@ -66,13 +43,13 @@ class MapMovementManager:
             accessible_maps = self.get_accessible_maps(current_location_id)
             can_move = target_map_id in accessible_maps
             
-            print(f"角色 {character_id} 从地图{current_location_id}移动到地图{target_map_id}: {'✅ 允许' if can_move else '❌ 禁止'}")
-            print(f"地图{current_location_id}的可访问地图: {accessible_maps}")
+            logger.debug("角色 %s 从地图%s移动到地图%s: %s", character_id, current_location_id, target_map_id, '✅ 允许' if can_move else '❌ 禁止')
+            logger.debug("地图%s的可访问地图: %s", current_location_id, accessible_maps)
             
             return can_move
             
         except Exception as e:
-            print(f"检查移动权限失败: {e}")
+            logger.warning("检查移动权限失败: %s", e)
             return False
     
     def move_character_to_map(self, character_id: str, target_map_id: int) -> bool:
@@ -80,13 +57,13 @@ class MapMovementManager:
         try:
             # 检查移动权限
             if not self.can_move_to_map(character_id, target_map_id):
-                print(f"角色 {character_id} 无法移动到地图 {target_map_id}")
+                logger.info("角色 %s 无法移动到地图 %s", character_id, target_map_id)
                 return False
             
             # 获取目标地图信息
             target_map = self.get_map_info(target_map_id)
             if not target_map:
-                print(f"目标地图 {target_map_id} 不存在")
+                logger.warning("目标地图 %s 不存在", target_map_id)
                 return False
             
             # 更新数据库中的位置
@@ -94,20 +71,18 @@ class MapMovementManager:
             self.db_manager.execute_query(update_query, (target_map_id, character_id))
             
             # 更新Redis中的session_state
-            session_state = get_session_state(character_id)
-            session_state['current_map_id'] = target_map_id
-            save_session_state(character_id, session_state)
+            update_session_fields(character_id, {'current_map_id': target_map_id})
             
             # 加载新地图的状态到Redis
             new_map_state = self._load_map_state_to_redis(target_map_id)
             if new_map_state:
                 save_map_state(target_map_id, new_map_state)
             
-            print(f"角色 {character_id} 成功移动到地图 {target_map_id}: {target_map.get('map_name', '未知地图')}")
+            logger.info("角色 %s 成功移动到地图 %s: %s", character_id, target_map_id, target_map.get('map_name', '未知地图'))
             return True
             
         except Exception as e:
-            print(f"移动角色失败: {e}")
+            logger.error("移动角色失败: %s", e)
             return False
     
     def _load_map_state_to_redis(self, map_id: int) -> Dict[str, Any]:
@@ -124,11 +99,8 @@ class MapMovementManager:
             self._initialize_npc_memories_for_map(map_id, npc_ids)
             self._initialize_npc_session_states_for_map(map_id, npc_ids)
             
-            # 获取地图上的可交互对象
-            objects = self.db_manager.execute_query(
-                "SELECT object_id, object_name, current_state FROM interactable_objects WHERE map_id = ?",
-                (map_id,)
-            )
+            # 获取地图上的可交互对象（初始状态来自剧本目录）
+            objects = scenario_catalog.objects_on_map(map_id)
             objects_state = {}
             for obj in objects:
                 obj_id = str(obj['object_id'])
@@ -147,7 +119,7 @@ class MapMovementManager:
             return map_state
             
         except Exception as e:
-            print(f"加载地图状态到Redis失败: {e}")
+            logger.warning("加载地图状态到Redis失败: %s", e)
             return {"npcs": [], "objects": {}, "accessible_maps": []}
     
     def get_movement_description(self, character_id: str, target_map_id: int) -> str:
@@ -165,7 +137,7 @@ class MapMovementManager:
             return f"你移动到了地图{target_map_id}"
             
         except Exception as e:
-            print(f"获取移动描述失败: {e}")
+            logger.warning("获取移动描述失败: %s", e)
             return "你移动到了新的地点"
     
     def _initialize_npc_memories_for_map(self, map_id: int, npc_ids: list):
@@ -182,74 +154,74 @@ class MapMovementManager:
                 }
                 return map_names.get(map_id, f'地图{map_id}')
             
+            # 先找出还没有记忆的NPC，再批量读取它们的角色卡
+            npcs_without_memories = []
             for npc_id in npc_ids:
                 try:
-                    # 检查NPC是否已有记忆
-                    existing_memories = memory_manager.get_npc_memories(npc_id, limit=1)
-                    if not existing_memories:
-                        # 获取NPC信息
-                        npc_sheet = self.db_manager.get_character_data(npc_id)
-                        if npc_sheet:
-                            npc_name = npc_sheet.get('info', {}).get('name', npc_id)
-                            map_name = get_map_name(map_id)
-                            
-                            # 为NPC创建初始记忆
-                            initial_memory = f"我是{npc_name}，正在{map_name}。"
-                            
-                            memory_manager.add_npc_memory(
-                                character_id=npc_id,
-                                memory_text=initial_memory,
-                                context={
-                                    "initialization": True,
-                                    "map_id": map_id,
-                                    "npc_name": npc_name,
-                                    "map_name": map_name
-                                }
-                            )
-                            print(f"为新地图{map_id}的NPC {npc_id} 创建了初始记忆")
-                        else:
-                            print(f"警告：无法获取NPC {npc_id} 的完整数据")
+                    if memory_manager.get_npc_memories(npc_id, limit=1):
+                        logger.debug("NPC %s 已有记忆，跳过初始化", npc_id)
+                    else:
+                        npcs_without_memories.append(npc_id)
+                except Exception as e:
+                    logger.warning("检查NPC %s 记忆时出错: %s", npc_id, e)
+            npc_sheets = self.db_manager.get_character_data_many(npcs_without_memories)
+            
+            for npc_id in npcs_without_memories:
+                try:
+                    npc_sheet = npc_sheets.get(npc_id)
+                    if npc_sheet:
+                        npc_name = npc_sheet.get('info', {}).get('name', npc_id)
+                        map_name = get_map_name(map_id)
+                        
+                        # 为NPC创建初始记忆
+                        initial_memory = f"我是{npc_name}，正在{map_name}。"
+                        
+                        memory_manager.add_npc_memory(
+                            character_id=npc_id,
+                            memory_text=initial_memory,
+                            context={
+                                "initialization": True,
+                                "map_id": map_id,
+                                "npc_name": npc_name,
+                                "map_name": map_name
+                            }
+                        )
+                        logger.debug("为新地图%s的NPC %s 创建了初始记忆", map_id, npc_id)
                     else:
-                        print(f"NPC {npc_id} 已有记忆，跳过初始化")
+                        logger.warning("无法获取NPC %s 的完整数据", npc_id)
                 except Exception as e:
-                    print(f"初始化NPC {npc_id} 记忆时出错: {e}")
+                    logger.warning("初始化NPC %s 记忆时出错: %s", npc_id, e)
                     
         except Exception as e:
-            print(f"初始化地图{map_id}的NPC记忆时出错: {e}")
+            logger.warning("初始化地图%s的NPC记忆时出错: %s", map_id, e)
 
     def _initialize_npc_session_states_for_map(self, map_id: int, npc_ids: list):
         """为新地图的NPC初始化session_state"""
         try:
+            # 检查NPC是否已有session_state，只为没有的NPC批量读取角色卡
+            npcs_without_session = []
             for npc_id in npc_ids:
+                if get_session_state(npc_id):
+                    logger.debug("NPC %s 已有session_state，跳过创建", npc_id)
+                else:
+                    npcs_without_session.append(npc_id)
+            npc_sheets = self.db_manager.get_character_data_many(npcs_without_session)
+            
+            for npc_id in npcs_without_session:
                 try:
-                    # 检查NPC是否已有session_state
-                    existing_session = get_session_state(npc_id)
-                    if not existing_session:
-                        # 获取NPC的完整数据
-                        npc_sheet = self.db_manager.get_character_data(npc_id)
-                        if npc_sheet:
-                            # 确保NPC的完整数据保存到Redis
-                            save_character_sheet(npc_id, npc_sheet)
-                            
-                            npc_derived = npc_sheet.get('derived_attributes', {})
-                            npc_session = {
-                                "hp": npc_derived.get("hit_points", 10),
-                                "sanity": npc_derived.get("sanity", 50),
-                                "mp": npc_derived.get("magic_points", 10),
-                                "current_map_id": npc_sheet.get('info', {}).get('current_location_id', map_id),
-                                "current_vehicle_id": npc_sheet.get('info', {}).get('current_vehicle_id', None),
-                            }
-                            save_session_state(npc_id, npc_session)
-                            print(f"为新地图{map_id}的NPC {npc_id} 创建了session_state")
-                        else:
-                            print(f"警告：无法获取NPC {npc_id} 的完整数据")
+                    npc_sheet = npc_sheets.get(npc_id)
+                    if npc_sheet:
+                        # 确保NPC的完整数据保存到Redis
+                        save_character_sheet(npc_id, npc_sheet)
+                        save_session_state(npc_id, initial_session_from_sheet(npc_sheet, map_id))
+                        logger.debug("为新地图%s的NPC %s 创建了session_state", map_id, npc_id)
                     else:
-                        print(f"NPC {npc_id} 已有session_state，跳过创建")
+                        logger.warning("无法获取NPC %s 的完整数据", npc_id)
                 except Exception as e:
-                    print(f"初始化NPC {npc_id} session_state时出错: {e}")
+                    logger.warning("初始化NPC %s session_state时出错: %s", npc_id, e)
                     
         except Exception as e:
-            print(f"初始化地图{map_id}的NPC session_state时出错: {e}")
+            logger.warning("初始化地图%s的NPC session_state时出错: %s", map_id, e)
 
 
 # 创建全局实例
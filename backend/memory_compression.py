@@ -0,0 +1,181 @@
+# memory_compression.py
+"""
+NPC记忆压缩的后台队列：
+短期记忆达到阈值时只提交一个压缩任务，由后台工作协程在请求路径之外执行
+（读取最旧的记忆 -> LLM压缩 -> 写入ChromaDB -> 裁剪Redis列表）。
+- 工作协程数量：MEMORY_COMPRESSION_WORKERS（默认2）
+- 同一NPC在队列中或执行中时不会重复提交
+- LLM失败时按指数退避重试 MEMORY_COMPRESSION_RETRIES 次，仍失败则使用回退摘要
+- 任务本身失败（读取批次、写入ChromaDB等）时按指数退避重新入队，连续失败超过
+  MEMORY_COMPRESSION_RETRIES 次后放弃，等该NPC下次提交再试；只有成功后才会检查是否需要继续压缩
+- 工作协程未启动时（例如独立脚本）由调用方同步压缩
+"""
+
+import os
+import asyncio
+from typing import Optional, Set, List, Dict
+
+from metrics import metrics
+from log_manager import get_logger
+
+logger = get_logger("memory_compression")
+
+
+class MemoryCompressionWorker:
+    def __init__(self):
+        self.worker_count = max(1, int(os.getenv("MEMORY_COMPRESSION_WORKERS", 2)))
+        self.max_retries = max(0, int(os.getenv("MEMORY_COMPRESSION_RETRIES", 2)))
+        self.retry_delay = float(os.getenv("MEMORY_COMPRESSION_RETRY_DELAY", 1.0))
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        # 已排队、正在压缩或等待重试的NPC
+        self._pending: Set[str] = set()
+        # NPC -> 连续失败次数 / 等待中的重试
+        self._failures: Dict[str, int] = {}
+        self._retry_handles: Dict[str, asyncio.TimerHandle] = {}
+
+    def is_running(self) -> bool:
+        return bool(self._workers) and self._loop is not None and not self._loop.is_closed()
+
+    async def start(self):
+        """在应用启动时调用，创建工作协程"""
+        if self.is_running():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._pending.clear()
+        self._failures.clear()
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"memory-compression-{i}")
+            for i in range(self.worker_count)
+        ]
+        logger.info("记忆压缩后台任务已启动，工作协程数: %d", self.worker_count)
+
+    async def stop(self, timeout: float = 30.0):
+        """在应用关闭时调用：等待队列中的任务完成（最多 timeout 秒），然后停止工作协程"""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("记忆压缩队列未能在 %.0f 秒内清空，剩余 %d 个任务被放弃", timeout, self._queue.qsize())
+        for handle in self._retry_handles.values():
+            handle.cancel()
+        self._retry_handles.clear()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._loop = None
+        self._pending.clear()
+        self._failures.clear()
+        logger.info("记忆压缩后台任务已停止")
+
+    def submit(self, manager, character_id: str) -> bool:
+        """
+        提交NPC的压缩任务；返回 False 表示后台任务未运行，调用方应同步压缩。
+        同一NPC已在队列中或正在压缩时直接忽略。
+        """
+        if not self.is_running():
+            return False
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._enqueue(manager, character_id)
+        else:
+            self._loop.call_soon_threadsafe(self._enqueue, manager, character_id)
+        return True
+
+    def _enqueue(self, manager, character_id: str):
+        if character_id in self._pending:
+            logger.debug("NPC %s 的压缩任务已在队列中，跳过", character_id)
+            return
+        self._pending.add(character_id)
+        self._queue.put_nowait((manager, character_id))
+        logger.debug("NPC %s 的压缩任务已入队，队列长度: %d", character_id, self._queue.qsize())
+
+    async def _worker(self, index: int):
+        while True:
+            manager, character_id = await self._queue.get()
+            succeeded = False
+            try:
+                with metrics.background.time("memory_compress"):
+                    await self._run_job(manager, character_id)
+                succeeded = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("NPC %s 的记忆压缩任务失败: %s", character_id, e, exc_info=True)
+            finally:
+                self._queue.task_done()
+            if not succeeded:
+                self._schedule_retry(manager, character_id)
+                continue
+            self._failures.pop(character_id, None)
+            self._pending.discard(character_id)
+            # 压缩期间又积累了足够多的记忆时继续压缩
+            try:
+                if await asyncio.to_thread(manager.needs_compression, character_id):
+                    self._enqueue(manager, character_id)
+            except Exception as e:
+                logger.warning("检查记忆压缩失败: %s", e)
+
+    def _schedule_retry(self, manager, character_id: str):
+        """失败的任务按指数退避重新入队；等待期间NPC仍视为已排队，新的提交会被忽略"""
+        failures = self._failures.get(character_id, 0) + 1
+        if failures > self.max_retries:
+            self._failures.pop(character_id, None)
+            self._pending.discard(character_id)
+            logger.error("NPC %s 的记忆压缩任务连续失败%d次，已放弃，等待下次提交", character_id, failures)
+            return
+        self._failures[character_id] = failures
+        delay = self.retry_delay * (2 ** failures)
+        logger.warning("NPC %s 的记忆压缩任务将在%.1f秒后重试（第%d次）", character_id, delay, failures)
+        self._retry_handles[character_id] = self._loop.call_later(delay, self._retry, manager, character_id)
+
+    def _retry(self, manager, character_id: str):
+        self._retry_handles.pop(character_id, None)
+        self._pending.discard(character_id)
+        self._enqueue(manager, character_id)
+
+    async def _run_job(self, manager, character_id: str):
+        batch = await asyncio.to_thread(manager.load_compression_batch, character_id)
+        if not batch:
+            return
+        memory_texts, batch_size = batch
+        combined_text = "\n".join(memory_texts)
+
+        compressed_memory = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                compressed_memory = await manager.acompress_with_llm(combined_text, character_id)
+                break
+            except Exception as e:
+                if attempt < self.max_retries:
+                    delay = self.retry_delay * (2 ** attempt)
+                    logger.warning("NPC %s 的LLM记忆压缩失败（第%d次），%.1f秒后重试: %s", character_id, attempt + 1, delay, e)
+                    await asyncio.sleep(delay)
+                else:
+                    logger.warning("NPC %s 的LLM记忆压缩重试%d次后仍失败: %s", character_id, self.max_retries, e)
+        if not compressed_memory:
+            compressed_memory = manager.fallback_summary(combined_text, character_id)
+            logger.info("使用回退压缩: %s...", compressed_memory[:100])
+
+        await asyncio.to_thread(manager.store_compressed_memory, character_id, compressed_memory,
+                                len(memory_texts), batch_size)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.is_running(),
+            "workers": len(self._workers),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "pending_npcs": len(self._pending),
+            "retrying_npcs": len(self._retry_handles),
+        }
+
+
+# 创建全局实例
+memory_compression_worker = MemoryCompressionWorker()
@@ -3,16 +3,28 @@
 import chromadb
 import json
 import os
+import asyncio
 import redis
+import redis.asyncio
 from typing import Dict, Any, List, Optional
 from datetime import datetime
 import uuid
 
+from metrics import metrics
+from log_manager import get_logger
+from memory_compression import memory_compression_worker
+
+logger = get_logger("memory_manager")
+
+# 短期记忆达到该数量时，把最旧的一批压缩为一条长期记忆
+COMPRESSION_THRESHOLD = 20
+COMPRESSION_BATCH_SIZE = 10
+
 class ChromaMemoryManager:
     def __init__(self, persist_directory: str = None, redis_client: redis.Redis = None):
         if persist_directory is None:
             current_dir = os.path.dirname(os.path.abspath(__file__))
-            persist_directory = os.path.join(current_dir, "..", "chroma_db")
+            persist_directory = os.getenv("CHROMA_PERSIST_DIRECTORY") or os.path.join(current_dir, "..", "chroma_db")
         
         # 确保目录存在
         os.makedirs(persist_directory, exist_ok=True)
@@ -28,9 +40,11 @@ class ChromaMemoryManager:
         
         # 初始化Redis客户端
         self.redis_client = redis_client or redis.Redis(host='localhost', port=6379, db=0)
+        # 异步版本优先使用 redis_manager 的共享连接池，在首次使用时获取
+        self._fallback_async_redis_client: Optional[redis.asyncio.Redis] = None
         
-        print(f"ChromaDB记忆管理器初始化完成，数据目录: {persist_directory}")
-        print("Redis短期记忆管理已启用")
+        logger.info("ChromaDB记忆管理器初始化完成，数据目录: %s", persist_directory)
+        logger.info("Redis短期记忆管理已启用")
     
     def add_npc_memory(self, 
                        character_id: str, 
@@ -49,7 +63,7 @@ class ChromaMemoryManager:
         """
         memory_id = str(uuid.uuid4())
         
-        print(f"为NPC {character_id} 添加了新记忆: {memory_text[:50]}...")
+        logger.debug("为NPC %s 添加了新记忆: %s...", character_id, memory_text[:50])
         
         # 只添加到Redis短期记忆，不直接添加到ChromaDB
         # 只有当短期记忆达到20条时，才会压缩到ChromaDB
@@ -57,6 +71,46 @@ class ChromaMemoryManager:
         
         return memory_id
     
+    async def aadd_npc_memory(self, 
+                              character_id: str, 
+                              memory_text: str, 
+                              context: Dict[str, Any] = None) -> str:
+        """add_npc_memory 的异步版本（LangGraph节点使用）"""
+        memory_id = str(uuid.uuid4())
+        
+        logger.debug("为NPC %s 添加了新记忆: %s...", character_id, memory_text[:50])
+        
+        try:
+            redis_client = self._async_redis()
+            redis_key = f"short_term_memory:{character_id}"
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.lpush(redis_key, json.dumps(self._short_term_entry(memory_text, context), ensure_ascii=False))
+            pipe.llen(redis_key)
+            _, memory_count = await pipe.execute()
+            
+            if memory_count >= COMPRESSION_THRESHOLD:
+                if memory_compression_worker.submit(self, character_id):
+                    logger.info("NPC %s 短期记忆达到 %s 条，已提交后台压缩", character_id, memory_count)
+                else:
+                    logger.info("NPC %s 短期记忆达到 %s 条，开始压缩...", character_id, memory_count)
+                    await asyncio.to_thread(self._compress_old_memories, character_id)
+            else:
+                logger.debug("NPC %s 短期记忆数量: %s/%s", character_id, memory_count, COMPRESSION_THRESHOLD)
+                
+        except Exception as e:
+            logger.warning("添加短期记忆失败: %s", e)
+        
+        return memory_id
+    
+    def _async_redis(self) -> redis.asyncio.Redis:
+        from redis_manager import get_async_redis_client
+        redis_client = get_async_redis_client()
+        if redis_client:
+            return redis_client
+        if self._fallback_async_redis_client is None:
+            self._fallback_async_redis_client = redis.asyncio.Redis(host='localhost', port=6379, db=0)
+        return self._fallback_async_redis_client
+    
     def get_npc_memories(self, 
                          character_id: str, 
                          limit: int = 5,
@@ -74,17 +128,19 @@ class ChromaMemoryManager:
         """
         if query_text:
             # 语义搜索
-            results = self.npc_memories.query(
-                query_texts=[query_text],
-                n_results=limit,
-                where={"character_id": character_id}
-            )
+            with metrics.track_dependency("chroma", "query"):
+                results = self.npc_memories.query(
+                    query_texts=[query_text],
+                    n_results=limit,
+                    where={"character_id": character_id}
+                )
         else:
             # 获取最近的记忆
-            results = self.npc_memories.get(
-                where={"character_id": character_id},
-                limit=limit
-            )
+            with metrics.track_dependency("chroma", "get"):
+                results = self.npc_memories.get(
+                    where={"character_id": character_id},
+                    limit=limit
+                )
         
         memories = []
         if results and 'metadatas' in results:
@@ -99,14 +155,17 @@ class ChromaMemoryManager:
         
         return memories
     
+    def _short_term_entry(self, memory_text: str, context: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "content": memory_text,
+            "context": context
+        }
+    
     def _add_to_short_term_memory(self, character_id: str, memory_text: str, context: Dict[str, Any]):
         """添加记忆到Redis短期记忆"""
         try:
-            memory_data = {
-                "timestamp": datetime.now().isoformat(),
-                "content": memory_text,
-                "context": context
-            }
+            memory_data = self._short_term_entry(memory_text, context)
             
             # 使用LPUSH添加到短期记忆列表左侧（最新）
             # 设置ensure_ascii=False，确保中文字符正常显示
@@ -117,171 +176,224 @@ class ChromaMemoryManager:
             self._check_and_compress_memories(character_id)
             
         except Exception as e:
-            print(f"添加短期记忆失败: {e}")
+            logger.warning("添加短期记忆失败: %s", e)
     
+    def needs_compression(self, character_id: str) -> bool:
+        """短期记忆是否达到压缩阈值"""
+        return self.redis_client.llen(f"short_term_memory:{character_id}") >= COMPRESSION_THRESHOLD
+
     def _check_and_compress_memories(self, character_id: str):
-        """检查并压缩短期记忆"""
+        """检查短期记忆数量，达到阈值时提交后台压缩任务（后台任务未运行时同步压缩）"""
         try:
             redis_key = f"short_term_memory:{character_id}"
             memory_count = self.redis_client.llen(redis_key)
             
-            if memory_count >= 20:
-                print(f"NPC {character_id} 短期记忆达到 {memory_count} 条，开始压缩...")
-                self._compress_old_memories(character_id)
+            if memory_count >= COMPRESSION_THRESHOLD:
+                if memory_compression_worker.submit(self, character_id):
+                    logger.info("NPC %s 短期记忆达到 %s 条，已提交后台压缩", character_id, memory_count)
+                else:
+                    logger.info("NPC %s 短期记忆达到 %s 条，开始压缩...", character_id, memory_count)
+                    self._compress_old_memories(character_id)
             else:
-                print(f"NPC {character_id} 短期记忆数量: {memory_count}/20")
+                logger.debug("NPC %s 短期记忆数量: %s/%s", character_id, memory_count, COMPRESSION_THRESHOLD)
                 
         except Exception as e:
-            print(f"检查记忆压缩失败: {e}")
+            logger.warning("检查记忆压缩失败: %s", e)
+    
+    def load_compression_batch(self, character_id: str):
+        """
+        读取最旧的一批短期记忆（列表右侧）
+        
+        Returns:
+            (记忆文本列表, 读取的条目数)，没有可压缩的记忆时返回 None
+        """
+        redis_key = f"short_term_memory:{character_id}"
+        old_memories = self.redis_client.lrange(redis_key, -COMPRESSION_BATCH_SIZE, -1)
+        
+        if not old_memories:
+            return None
+        
+        # 解析记忆数据
+        memory_texts = []
+        for memory_json in old_memories:
+            try:
+                memory_data = json.loads(memory_json)
+                memory_texts.append(memory_data.get('content', ''))
+            except:
+                continue
+        
+        if not memory_texts:
+            return None
+        return memory_texts, len(old_memories)
+    
+    def store_compressed_memory(self, character_id: str, compressed_memory: str, original_count: int, batch_size: int):
+        """将压缩结果写入ChromaDB长期记忆，并从短期记忆中删除已压缩的条目"""
+        compression_context = {
+            "source": "compression", 
+            "original_count": original_count,
+            "compression_type": "automatic"
+        }
+        
+        with metrics.track_dependency("chroma", "add"):
+            self.npc_memories.add(
+                documents=[compressed_memory],
+                metadatas=[{
+                    "character_id": character_id,
+                    "timestamp": datetime.now().isoformat(),
+                    "context": json.dumps(compression_context, ensure_ascii=False)
+                }],
+                ids=[f"compressed_{character_id}_{datetime.now().timestamp()}"]
+            )
+        
+        # 只删除列表右侧已压缩的条目；压缩期间新增的记忆在左侧，不受影响
+        self.redis_client.ltrim(f"short_term_memory:{character_id}", 0, -batch_size - 1)
+        
+        logger.info("NPC %s 的记忆压缩完成，生成了1条长期记忆", character_id)
     
     def _compress_old_memories(self, character_id: str):
-        """压缩最旧的10条记忆为长期记忆"""
+        """同步压缩最旧的10条记忆为长期记忆（后台任务未运行时使用）"""
         try:
-            redis_key = f"short_term_memory:{character_id}"
-            
-            # 提取最旧的10条记忆（列表右侧）
-            old_memories = self.redis_client.lrange(redis_key, -10, -1)
-            
-            if not old_memories:
-                return
-            
-            # 解析记忆数据
-            memory_texts = []
-            for memory_json in old_memories:
-                try:
-                    memory_data = json.loads(memory_json)
-                    memory_texts.append(memory_data.get('content', ''))
-                except:
-                    continue
-            
-            if not memory_texts:
+            batch = self.load_compression_batch(character_id)
+            if not batch:
                 return
+            memory_texts, batch_size = batch
             
-            # 拼接记忆文本
-            combined_text = "\n".join(memory_texts)
-            
-            # 使用LLM压缩记忆（这里需要异步调用）
-            compressed_memory = self._compress_with_llm(combined_text, character_id)
+            # 使用LLM压缩记忆
+            compressed_memory = self._compress_with_llm("\n".join(memory_texts), character_id)
             
             if compressed_memory:
-                # 添加到ChromaDB长期记忆
-                compression_context = {
-                    "source": "compression", 
-                    "original_count": len(memory_texts),
-                    "compression_type": "automatic"
-                }
-                
-                self.npc_memories.add(
-                    documents=[compressed_memory],
-                    metadatas=[{
-                        "character_id": character_id,
-                        "timestamp": datetime.now().isoformat(),
-                        "context": json.dumps(compression_context, ensure_ascii=False)
-                    }],
-                    ids=[f"compressed_{character_id}_{datetime.now().timestamp()}"]
-                )
-                
-                # 删除已压缩的旧记忆，保留最新的10条
-                self.redis_client.ltrim(redis_key, 0, 9)
-                
-                print(f"NPC {character_id} 的记忆压缩完成，生成了1条长期记忆")
+                self.store_compressed_memory(character_id, compressed_memory, len(memory_texts), batch_size)
                 
         except Exception as e:
-            print(f"压缩记忆失败: {e}")
+            logger.warning("压缩记忆失败: %s", e)
     
+    def _compression_messages(self, memory_texts: str, character_id: str):
+        from langchain_core.messages import SystemMessage, HumanMessage
+        
+        system_prompt = f"""
+            你是一个记忆压缩专家。你的任务是将NPC {character_id} 的多个短期记忆压缩成一条简洁的长期记忆。
 
+            压缩要求：
+            1. 保留关键信息和情感
+            2. 去除重复内容
+            3. 用简洁的语言概括
+            4. 保持记忆的连贯性
+            5. 长度控制在100-200字以内
+            
+            请直接返回压缩后的记忆内容，不要添加任何解释或格式。"""
+
+        human_prompt = f"请压缩以下记忆：\n\n{memory_texts}"
+        
+        return [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=human_prompt)
+        ]
+    
+    def fallback_summary(self, memory_texts: str, character_id: str) -> str:
+        """LLM不可用时的简单压缩"""
+        return f"NPC {character_id} 的长期记忆摘要：{memory_texts[:200]}..."
     
     def _compress_with_llm(self, memory_texts: str, character_id: str) -> str:
         """使用LLM压缩记忆文本为长期记忆"""
         try:
-            from langchain_openai import ChatOpenAI
-            from langchain_core.messages import SystemMessage, HumanMessage
-            
-            llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.1)
-            
-            system_prompt = f"""
-                你是一个记忆压缩专家。你的任务是将NPC {character_id} 的多个短期记忆压缩成一条简洁的长期记忆。
-
-                压缩要求：
-                1. 保留关键信息和情感
-                2. 去除重复内容
-                3. 用简洁的语言概括
-                4. 保持记忆的连贯性
-                5. 长度控制在100-200字以内
-                
-                请直接返回压缩后的记忆内容，不要添加任何解释或格式。"""
-
-            human_prompt = f"请压缩以下记忆：\n\n{memory_texts}"
-            
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=human_prompt)
-            ]
+            from llm_registry import get_llm
             
-            response = llm.invoke(messages)
+            llm = get_llm(temperature=0.1)
+            response = llm.invoke(self._compression_messages(memory_texts, character_id),
+                                  config={"metadata": {"llm_operation": "memory_compress"}})
             compressed_memory = response.content.strip()
             
-            print(f"LLM记忆压缩完成，原文长度: {len(memory_texts)}，压缩后长度: {len(compressed_memory)}")
+            logger.info("LLM记忆压缩完成，原文长度: %s，压缩后长度: %s", len(memory_texts), len(compressed_memory))
             return compressed_memory
             
         except Exception as e:
-            print(f"LLM记忆压缩失败: {e}")
+            logger.warning("LLM记忆压缩失败: %s", e)
             # 如果LLM失败，回退到简单压缩
-            fallback = f"NPC {character_id} 的长期记忆摘要：{memory_texts[:200]}..."
-            print(f"使用回退压缩: {fallback[:100]}...")
+            fallback = self.fallback_summary(memory_texts, character_id)
+            logger.info("使用回退压缩: %s...", fallback[:100])
             return fallback
     
-    def get_npc_memories_for_context(self, character_id: str, limit: int = 5) -> Dict[str, Any]:
-        """获取NPC的短期记忆和长期记忆，用于NPC Loop"""
-        try:
-            # 获取短期记忆（Redis）
-            redis_key = f"short_term_memory:{character_id}"
-            short_term_memories = []
-            
-            # 获取最近的短期记忆（最多10条）
-            short_term_data = self.redis_client.lrange(redis_key, 0, 9)
-            for memory_json in short_term_data:
-                try:
-                    memory_data = json.loads(memory_json)
-                    short_term_memories.append({
-                        "content": memory_data.get('content', ''),
-                        "timestamp": memory_data.get('timestamp', '')
-                    })
-                except:
-                    continue
-            
-            # 获取长期记忆（ChromaDB，基于相似度搜索）
-            long_term_memories = []
-            if short_term_memories:
-                # 使用最新的短期记忆作为查询文本
-                latest_memory = short_term_memories[0]['content']
+    async def acompress_with_llm(self, memory_texts: str, character_id: str) -> str:
+        """异步LLM压缩（后台任务使用）；失败时抛出异常，由调用方重试或回退"""
+        from llm_registry import get_llm
+        
+        llm = get_llm(temperature=0.1)
+        response = await llm.ainvoke(self._compression_messages(memory_texts, character_id),
+                                     config={"metadata": {"llm_operation": "memory_compress"}})
+        compressed_memory = response.content.strip()
+        if not compressed_memory:
+            raise ValueError("LLM返回了空的压缩结果")
+        
+        logger.info("LLM记忆压缩完成，原文长度: %s，压缩后长度: %s", len(memory_texts), len(compressed_memory))
+        return compressed_memory
+    
+    def _parse_short_term_memories(self, short_term_data: List[Any]) -> List[Dict[str, Any]]:
+        short_term_memories = []
+        for memory_json in short_term_data:
+            try:
+                memory_data = json.loads(memory_json)
+                short_term_memories.append({
+                    "content": memory_data.get('content', ''),
+                    "timestamp": memory_data.get('timestamp', '')
+                })
+            except:
+                continue
+        return short_term_memories
+    
+    def _query_long_term_memories(self, character_id: str, short_term_memories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """获取长期记忆（ChromaDB，基于相似度搜索）"""
+        long_term_memories = []
+        if short_term_memories:
+            # 使用最新的短期记忆作为查询文本
+            latest_memory = short_term_memories[0]['content']
+            with metrics.track_dependency("chroma", "query"):
                 long_term_results = self.npc_memories.query(
                     query_texts=[latest_memory],
                     n_results=3,
                     where={"character_id": character_id}
                 )
-                
-                if long_term_results and 'metadatas' in long_term_results:
-                    for i, metadata in enumerate(long_term_results['metadatas'][0]):
-                        long_term_memories.append({
-                            "content": long_term_results['documents'][0][i],
-                            "timestamp": metadata.get('timestamp', ''),
-                            "similarity": long_term_results['distances'][0][i] if 'distances' in long_term_results else 0
-                        })
             
-            return {
-                "short_term": short_term_memories,
-                "long_term": long_term_memories,
-                "total_short_term": len(short_term_memories),
-                "total_long_term": len(long_term_memories)
-            }
+            if long_term_results and 'metadatas' in long_term_results:
+                for i, metadata in enumerate(long_term_results['metadatas'][0]):
+                    long_term_memories.append({
+                        "content": long_term_results['documents'][0][i],
+                        "timestamp": metadata.get('timestamp', ''),
+                        "similarity": long_term_results['distances'][0][i] if 'distances' in long_term_results else 0
+                    })
+        return long_term_memories
+    
+    def _memory_context(self, short_term_memories: List[Dict[str, Any]], long_term_memories: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            "short_term": short_term_memories,
+            "long_term": long_term_memories,
+            "total_short_term": len(short_term_memories),
+            "total_long_term": len(long_term_memories)
+        }
+    
+    def get_npc_memories_for_context(self, character_id: str, limit: int = 5) -> Dict[str, Any]:
+        """获取NPC的短期记忆和长期记忆，用于NPC Loop"""
+        try:
+            # 获取最近的短期记忆（Redis，最多10条）
+            short_term_data = self.redis_client.lrange(f"short_term_memory:{character_id}", 0, 9)
+            short_term_memories = self._parse_short_term_memories(short_term_data)
+            long_term_memories = self._query_long_term_memories(character_id, short_term_memories)
+            return self._memory_context(short_term_memories, long_term_memories)
             
         except Exception as e:
-            print(f"获取NPC记忆上下文失败: {e}")
-            return {"short_term": [], "long_term": [], "total_short_term": 0, "total_long_term": 0}
-    
-
+            logger.warning("获取NPC记忆上下文失败: %s", e)
+            return self._memory_context([], [])
     
+    async def aget_npc_memories_for_context(self, character_id: str, limit: int = 5) -> Dict[str, Any]:
+        """get_npc_memories_for_context 的异步版本：Redis走异步连接池，ChromaDB查询在线程中执行"""
+        try:
+            short_term_data = await self._async_redis().lrange(f"short_term_memory:{character_id}", 0, 9)
+            short_term_memories = self._parse_short_term_memories(short_term_data)
+            long_term_memories = await asyncio.to_thread(self._query_long_term_memories, character_id, short_term_memories)
+            return self._memory_context(short_term_memories, long_term_memories)
+            
+        except Exception as e:
+            logger.warning("获取NPC记忆上下文失败: %s", e)
+            return self._memory_context([], [])
 
 
 # 创建全局实例
@@ -290,5 +402,5 @@ try:
     from redis_manager import redis_client
     memory_manager = ChromaMemoryManager(redis_client=redis_client)
 except ImportError:
-    print("警告：无法导入redis_client，使用默认Redis连接")
+    logger.warning("无法导入redis_client，使用默认Redis连接")
     memory_manager = ChromaMemoryManager()
@@ -0,0 +1,410 @@
+# metrics.py
+"""
+回合流水线的耗时指标，以 Prometheus 文本格式在 /metrics 导出：
+- 每个LangGraph节点、每类外部依赖 (LLM / Redis / SQLite / Chroma)、每类后台任务的直方图和调用/错误计数
+- 最近一段窗口内的 p50 / p95 / p99 (summary)，用于在压测时发现回归
+- 每类LLM调用的提示词token数 (summary)：服务商返回的输入token数，未返回时用 tiktoken 计数
+- 提示词前缀缓存：system消息（静态前缀 + 半静态块）在缓存有效期内是否出现过（本地估算的命中率），
+  以及模型服务商返回的缓存命中token数（OpenAI usage 中的 cached_tokens）
+不依赖 prometheus_client；所有记录操作线程安全（SQLite/Chroma 调用可能在线程池中执行）。
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import functools
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from prompt_budget import count_message_tokens
+from log_manager import get_logger
+
+logger = get_logger("metrics")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+# 计算分位数时保留的最近样本数
+QUANTILE_WINDOW = int(os.getenv("METRICS_QUANTILE_WINDOW", 2048))
+# 估算前缀命中时假设的服务商缓存有效期（秒）和记录的前缀数量上限
+PROMPT_PREFIX_CACHE_TTL = float(os.getenv("PROMPT_PREFIX_CACHE_TTL", 300))
+PROMPT_PREFIX_CACHE_SIZE = int(os.getenv("PROMPT_PREFIX_CACHE_SIZE", 1024))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _quantile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class _Series:
+    """单个标签组合的直方图累计值 + 最近样本窗口"""
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self.window = deque(maxlen=QUANTILE_WINDOW)
+
+
+class LatencyMetric:
+    """耗时指标族：导出为 <name>_seconds (histogram)、<name>_latency_seconds (summary)、
+    <name>_calls_total 与 <name>_errors_total (counter)"""
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, _Series] = {}
+        self._lock = threading.Lock()
+
+    def _get_series(self, label_values: Tuple[str, ...]) -> _Series:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = _Series(self.buckets)
+        return series
+
+    def observe(self, seconds: float, *label_values: str, error: bool = False):
+        with self._lock:
+            series = self._get_series(tuple(label_values))
+            series.count += 1
+            series.sum += seconds
+            series.window.append(seconds)
+            if error:
+                series.errors += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series.bucket_counts[i] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    @contextmanager
+    def time(self, *label_values: str):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(time.perf_counter() - start, *label_values, error=error)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """JSON友好的概要：每个标签组合的调用数、错误数、平均值和分位数(ms)"""
+        result = {}
+        with self._lock:
+            items = [(k, s.count, s.errors, s.sum, sorted(s.window)) for k, s in self._series.items()]
+        for label_values, count, errors, total, window in items:
+            key = "/".join(label_values) or "all"
+            result[key] = {
+                "count": count, "errors": errors,
+                "avg_ms": round(total / count * 1000, 2) if count else 0.0,
+                **{f"p{int(q * 100)}_ms": round(_quantile(window, q) * 1000, 2) for q in QUANTILES},
+                "max_ms": round(window[-1] * 1000, 2) if window else 0.0,
+            }
+        return result
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [
+                (tuple(zip(self.label_names, k)), list(s.bucket_counts), s.count, s.sum, s.errors, sorted(s.window))
+                for k, s in sorted(self._series.items())
+            ]
+        lines = [f"# HELP {self.name}_seconds {self.help_text}", f"# TYPE {self.name}_seconds histogram"]
+        for labels, bucket_counts, count, total, _, _ in items:
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_seconds_bucket{_format_labels(labels, (('le', repr(bound)),))} {bucket_count}")
+            lines.append(f"{self.name}_seconds_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_seconds_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_seconds_count{_format_labels(labels)} {count}")
+
+        lines += [f"# HELP {self.name}_latency_seconds {self.help_text} (最近{QUANTILE_WINDOW}次的分位数)",
+                  f"# TYPE {self.name}_latency_seconds summary"]
+        for labels, _, count, total, _, window in items:
+            for q in QUANTILES:
+                lines.append(f"{self.name}_latency_seconds{_format_labels(labels, (('quantile', str(q)),))} {_quantile(window, q)}")
+            lines.append(f"{self.name}_latency_seconds_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_latency_seconds_count{_format_labels(labels)} {count}")
+
+        for suffix, index, text in (("calls_total", 2, "调用次数"), ("errors_total", 4, "失败次数")):
+            lines += [f"# HELP {self.name}_{suffix} {text}", f"# TYPE {self.name}_{suffix} counter"]
+            for item in items:
+                lines.append(f"{self.name}_{suffix}{_format_labels(item[0])} {item[index]}")
+        return lines
+
+
+class ValueMetric:
+    """非耗时的数值分布（例如提示词token数）：导出为 <name> (summary) 与 <name>_max (gauge)"""
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._series: Dict[Tuple, _Series] = {}
+        self._max: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        key = tuple(label_values)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(())
+            series.count += 1
+            series.sum += value
+            series.window.append(value)
+            self._max[key] = max(self._max.get(key, value), value)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self._max.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        with self._lock:
+            items = [(k, s.count, s.sum, sorted(s.window), self._max[k]) for k, s in self._series.items()]
+        for label_values, count, total, window, maximum in items:
+            result["/".join(label_values) or "all"] = {
+                "count": count, "avg": round(total / count, 1) if count else 0.0, "max": maximum,
+                **{f"p{int(q * 100)}": _quantile(window, q) for q in QUANTILES}
+            }
+        return result
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(tuple(zip(self.label_names, k)), s.count, s.sum, sorted(s.window), self._max[k])
+                     for k, s in sorted(self._series.items())]
+        lines = [f"# HELP {self.name} {self.help_text} (最近{QUANTILE_WINDOW}次的分位数)", f"# TYPE {self.name} summary"]
+        for labels, count, total, window, _ in items:
+            for q in QUANTILES:
+                lines.append(f"{self.name}{_format_labels(labels, (('quantile', str(q)),))} {_quantile(window, q)}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        lines += [f"# HELP {self.name}_max {self.help_text} (最大值)", f"# TYPE {self.name}_max gauge"]
+        for labels, _, _, _, maximum in items:
+            lines.append(f"{self.name}_max{_format_labels(labels)} {maximum}")
+        return lines
+
+
+class PrefixCacheMetric:
+    """
+    提示词前缀缓存的命中情况：
+    - observe_prefix: 同一前缀在 PROMPT_PREFIX_CACHE_TTL 秒内出现过记为命中，用于在没有真实模型时评估提示词布局
+    - observe_usage: 模型服务商实际报告的输入token数和其中命中缓存的token数
+    """
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._prefix: Dict[str, List[int]] = {}
+        self._usage: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+
+    def observe_prefix(self, operation: str, prefix: str) -> bool:
+        fingerprint = hashlib.sha1(f"{operation}\0{prefix}".encode("utf-8")).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            last_seen = self._seen.pop(fingerprint, None)
+            hit = last_seen is not None and now - last_seen < PROMPT_PREFIX_CACHE_TTL
+            self._seen[fingerprint] = now
+            while len(self._seen) > PROMPT_PREFIX_CACHE_SIZE:
+                self._seen.popitem(last=False)
+            counts = self._prefix.setdefault(operation, [0, 0])
+            counts[0 if hit else 1] += 1
+        return hit
+
+    def reset(self):
+        """清空计数；已见过的前缀仍保留，与服务商缓存的行为一致"""
+        with self._lock:
+            self._prefix.clear()
+            self._usage.clear()
+
+    def observe_usage(self, operation: str, input_tokens: int, cached_tokens: int):
+        with self._lock:
+            usage = self._usage.setdefault(operation, [0, 0])
+            usage[0] += input_tokens
+            usage[1] += cached_tokens
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        with self._lock:
+            prefix = {k: list(v) for k, v in self._prefix.items()}
+            usage = {k: list(v) for k, v in self._usage.items()}
+        for operation in sorted(set(prefix) | set(usage)):
+            hits, misses = prefix.get(operation, [0, 0])
+            input_tokens, cached_tokens = usage.get(operation, [0, 0])
+            result[operation] = {
+                "prefix_hits": hits, "prefix_misses": misses,
+                "prefix_hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+                "input_tokens": input_tokens, "cached_tokens": cached_tokens,
+                "cached_token_ratio": round(cached_tokens / input_tokens, 3) if input_tokens else 0.0,
+            }
+        return result
+
+    def render(self) -> List[str]:
+        with self._lock:
+            prefix = sorted(self._prefix.items())
+            usage = sorted(self._usage.items())
+        lines = [f"# HELP {self.name}_prefix_total {self.help_text} (本地估算: system消息前缀是否在缓存有效期内出现过)",
+                 f"# TYPE {self.name}_prefix_total counter"]
+        for operation, (hits, misses) in prefix:
+            lines.append(f"{self.name}_prefix_total{_format_labels((('operation', operation), ('result', 'hit')))} {hits}")
+            lines.append(f"{self.name}_prefix_total{_format_labels((('operation', operation), ('result', 'miss')))} {misses}")
+        lines += [f"# HELP {self.name}_input_tokens_total 模型服务商报告的输入token数", f"# TYPE {self.name}_input_tokens_total counter"]
+        for operation, (input_tokens, _) in usage:
+            lines.append(f"{self.name}_input_tokens_total{_format_labels((('operation', operation),))} {input_tokens}")
+        lines += [f"# HELP {self.name}_cached_tokens_total 模型服务商报告的命中前缀缓存的输入token数",
+                  f"# TYPE {self.name}_cached_tokens_total counter"]
+        for operation, (_, cached_tokens) in usage:
+            lines.append(f"{self.name}_cached_tokens_total{_format_labels((('operation', operation),))} {cached_tokens}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.turns = LatencyMetric("trpg_turn", "完整回合耗时", ("endpoint",))
+        self.nodes = LatencyMetric("trpg_node", "LangGraph节点耗时", ("node",))
+        self.dependencies = LatencyMetric("trpg_dependency", "外部依赖调用耗时", ("dependency", "operation"))
+        self.background = LatencyMetric("trpg_background_job", "后台任务耗时", ("job",))
+        self.prompt_tokens = ValueMetric("trpg_prompt_tokens", "LLM调用的提示词token数", ("operation",))
+        self.prompt_cache = PrefixCacheMetric("trpg_prompt", "提示词前缀缓存命中次数")
+
+    def track_dependency(self, dependency: str, operation: str):
+        """with metrics.track_dependency("sqlite", "select"): ..."""
+        return self.dependencies.time(dependency, operation)
+
+    def _all(self):
+        return (self.turns, self.nodes, self.dependencies, self.background, self.prompt_tokens, self.prompt_cache)
+
+    def reset(self):
+        """清空所有指标（基准测试在预热之后调用）"""
+        for metric in self._all():
+            metric.reset()
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._all():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "turns": self.turns.snapshot(),
+            "nodes": self.nodes.snapshot(),
+            "dependencies": self.dependencies.snapshot(),
+            "background": self.background.snapshot(),
+            "prompt_tokens": self.prompt_tokens.snapshot(),
+            "prompt_cache": self.prompt_cache.snapshot(),
+        }
+
+
+# 创建全局实例
+metrics = Metrics()
+
+def instrument_node(node_name: str, node_func):
+    """包装LangGraph异步节点，记录其耗时"""
+    @functools.wraps(node_func)
+    async def wrapper(state):
+        with metrics.nodes.time(node_name):
+            return await node_func(state)
+    return wrapper
+
+
+def _provider_cache_usage(response) -> Optional[Tuple[int, int]]:
+    """从LLM响应中取出 (输入token数, 命中缓存的token数)；服务商未返回用量时为 None"""
+    for generations in getattr(response, 'generations', None) or []:
+        for generation in generations:
+            usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+            if usage:
+                details = usage.get('input_token_details') or {}
+                return usage.get('input_tokens', 0), details.get('cache_read', 0) or 0
+    token_usage = (getattr(response, 'llm_output', None) or {}).get('token_usage') or {}
+    if token_usage.get('prompt_tokens'):
+        details = token_usage.get('prompt_tokens_details') or {}
+        return token_usage['prompt_tokens'], details.get('cached_tokens', 0) or 0
+    return None
+
+
+def _observe_counted_prompt_tokens(operation: str, message_lists: List[List[Any]]):
+    """服务商未返回用量时用 tiktoken 计数（较慢，在线程池中执行）"""
+    for message_list in message_lists:
+        metrics.prompt_tokens.observe(count_message_tokens(message_list), operation)
+
+
+class LLMMetricsCallbackHandler(BaseCallbackHandler):
+    """
+    记录每次LLM调用的耗时；operation 取自调用元数据中的 llm_operation，缺省为模型名。
+    提示词token数优先使用服务商返回的用量，没有时才在线程池中用 tiktoken 计数，不在事件循环上做分词。
+    """
+    run_inline = True
+
+    def __init__(self):
+        self._starts: Dict[Any, Tuple[float, str, List[List[Any]]]] = {}
+
+    def _start(self, run_id, metadata: Optional[Dict[str, Any]], message_lists: List[List[Any]] = ()):
+        metadata = metadata or {}
+        operation = metadata.get("llm_operation") or metadata.get("ls_model_name") or "chat"
+        self._starts[run_id] = (time.perf_counter(), operation, list(message_lists))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata, messages)
+        operation = self._starts[run_id][1]
+        for message_list in messages:
+            prefix_hit = False
+            if message_list and getattr(message_list[0], 'type', None) == 'system':
+                prefix_hit = metrics.prompt_cache.observe_prefix(operation, message_list[0].content)
+            logger.debug("[Prompt] %s 前缀%s", operation, "命中" if prefix_hit else "未命中")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata)
+
+    def _finish(self, run_id, error: bool):
+        started = self._starts.pop(run_id, None)
+        if started:
+            start, operation, _ = started
+            metrics.dependencies.observe(time.perf_counter() - start, "llm", operation, error=error)
+
+    def _observe_prompt_tokens(self, operation: str, message_lists: List[List[Any]], usage: Optional[Tuple[int, int]]):
+        if usage and usage[0]:
+            metrics.prompt_tokens.observe(usage[0], operation)
+            return
+        if not message_lists:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            _observe_counted_prompt_tokens(operation, message_lists)
+            return
+        loop.run_in_executor(None, _observe_counted_prompt_tokens, operation, message_lists)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._starts.get(run_id)
+        usage = _provider_cache_usage(response)
+        if started:
+            _, operation, message_lists = started
+            if usage:
+                metrics.prompt_cache.observe_usage(operation, *usage)
+            self._observe_prompt_tokens(operation, message_lists, usage)
+        self._finish(run_id, error=False)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=True)
+
+
+llm_metrics_handler = LLMMetricsCallbackHandler()
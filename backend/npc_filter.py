@@ -5,24 +5,42 @@ NPC筛选器：智能筛选需要反应的NPC
 """
 
 from typing import List, Dict, Any, Optional
+import os
 import json
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
+from llm_registry import get_llm
+from llm_cache import cached_ainvoke, is_json
+from prompt_budget import truncate_text
+from log_manager import get_logger
+
+logger = get_logger("npc_filter")
+
+# 筛选只需要判断相关性，初始知识和扮演须知各截取开头这么多token
+NPC_SELECTION_FIELD_TOKENS = int(os.getenv("NPC_SELECTION_FIELD_TOKENS", 80))
+
+def describe_npcs_for_selection(available_npcs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """筛选提示词中使用的NPC信息（长文本字段按 NPC_SELECTION_FIELD_TOKENS 截断）"""
+    return [
+        {
+            "id": npc.get('id', ''),
+            "name": npc.get('name', ''),
+            "profession": npc.get('profession', ''),
+            "status": npc.get('status', ''),
+            "current_goal": npc.get('current_goal', ''),
+            "initial_knowledge": truncate_text(npc.get('initial_knowledge') or '', NPC_SELECTION_FIELD_TOKENS),
+            "roleplay_guidelines": truncate_text(npc.get('roleplay_guidelines') or '', NPC_SELECTION_FIELD_TOKENS)
+        }
+        for npc in available_npcs
+    ]
 
 class NPCFilter:
-    def __init__(self):
-        self.llm = None
-    
     def _get_llm(self):
-        """延迟初始化LLM"""
-        if self.llm is None:
-            try:
-                self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.1)
-                print("[NPC筛选器] LLM初始化成功")
-            except Exception as e:
-                print(f"[NPC筛选器] LLM初始化失败: {e}")
-                return None
-        return self.llm
+        """每次从注册表获取客户端（注册表负责缓存），避免持有关闭或重建后失效的连接池"""
+        try:
+            return get_llm(temperature=0.1)
+        except Exception as e:
+            logger.warning("[NPC筛选器] LLM初始化失败: %s", e)
+            return None
     
     async def filter_npcs_by_relevance(
         self, 
@@ -65,18 +83,7 @@ class NPCFilter:
         """使用LLM智能筛选NPC，考虑多样性"""
         
         # 构建NPC信息
-        npc_info_list = []
-        for npc in available_npcs:
-            npc_info = {
-                "id": npc.get('id', ''),
-                "name": npc.get('name', ''),
-                "profession": npc.get('profession', ''),
-                "status": npc.get('status', ''),
-                "current_goal": npc.get('current_goal', ''),
-                "initial_knowledge": npc.get('initial_knowledge', ''),
-                "roleplay_guidelines": npc.get('roleplay_guidelines', '')
-            }
-            npc_info_list.append(npc_info)
+        npc_info_list = describe_npcs_for_selection(available_npcs)
         
         # 构建最近激活NPC信息
         recent_info = ""
@@ -90,7 +97,7 @@ class NPCFilter:
         玩家行动: {json.dumps(player_action, ensure_ascii=False)}
         
         可用NPC列表:
-        {json.dumps(npc_info_list, ensure_ascii=False, indent=2)}
+        {json.dumps(npc_info_list, ensure_ascii=False)}
         {recent_info}
         
         筛选标准（按优先级排序）:
@@ -121,7 +128,7 @@ class NPCFilter:
         try:
             llm = self._get_llm()
             if not llm:
-                print("[NPC筛选器] LLM不可用，返回所有NPC")
+                logger.warning("[NPC筛选器] LLM不可用，返回所有NPC")
                 return available_npcs
             
             messages = [
@@ -129,20 +136,20 @@ class NPCFilter:
                 HumanMessage(content="请筛选最相关的NPC")
             ]
             
-            response = await llm.ainvoke(messages)
-            result = json.loads(response.content)
+            content = await cached_ainvoke("npc_filter", llm, messages, is_cacheable=is_json)
+            result = json.loads(content)
             
             # 根据筛选结果返回NPC
             selected_ids = result.get('selected_npc_ids', [])
             selected_npcs = [npc for npc in available_npcs if npc.get('id') in selected_ids]
             
-            print(f"[NPC筛选器] 从{len(available_npcs)}个NPC中筛选出{len(selected_npcs)}个")
-            print(f"[NPC筛选器] 选择理由: {result.get('reasoning', '无')}")
+            logger.info("[NPC筛选器] 从%s个NPC中筛选出%s个", len(available_npcs), len(selected_npcs))
+            logger.debug("[NPC筛选器] 选择理由: %s", result.get('reasoning', '无'))
             
             return selected_npcs
             
         except Exception as e:
-            print(f"[NPC筛选器] LLM筛选失败: {e}，返回所有NPC")
+            logger.warning("[NPC筛选器] LLM筛选失败: %s，返回所有NPC", e)
             return available_npcs
     
 
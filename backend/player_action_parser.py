@@ -5,13 +5,17 @@ import json
 import asyncio
 import websockets
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 import random
 
 # 导入您项目中的模块
 from databaseManager import db_manager, get_character_data, get_attribute_by_name
 from character_state import get_current_character_id, is_character_loaded
+from llm_registry import get_llm
+from llm_cache import cached_ainvoke, is_json
+from log_manager import get_logger
+
+logger = get_logger("player_action_parser")
 
 # 加载环境变量
 load_dotenv()
@@ -44,94 +48,235 @@ def broadcast_dice_result_sync(dice_data):
                 # 确保在正确的事件循环中发送
                 asyncio.run_coroutine_threadsafe(ws.send_text(message), _loop)
             except Exception as e:
-                print(f"发送骰子结果失败: {e}")
+                logger.warning("发送骰子结果失败: %s", e)
                 websocket_connections.discard(ws)
 
-# --- 核心功能: 意图解析 (全新) ---
+# --- 快速路径: 基于规则的意图解析 ---
+# 只处理"[主语/情态词] + 指令动词 + 目标名称"这种能无歧义确定的 移动/检查/拿取/使用 指令：
+# 指令动词必须位于句首（单字动词如 看/用/去 出现在句中不算），动词之后只能是一个物品或地图名称，
+# 其余任何成分（多个动作、修饰语、对话、技能检定线索）都交给LLM判断。
+FAST_PATH_INTENT_VERBS = {
+    "inspect": ["检查", "调查", "查看", "搜查", "搜索", "看看", "看"],
+    "take": ["获取", "拿起", "捡起", "拿走", "拿", "捡"],
+    "use": ["使用", "用"],
+    "move": ["前往", "回到", "走到", "去往", "去", "回"],
+}
+# 动词按长度从长到短匹配，"查看" 不会被当作 "看"
+_FAST_PATH_VERBS = sorted(
+    ((verb, intent) for intent, verbs in FAST_PATH_INTENT_VERBS.items() for verb in verbs),
+    key=lambda item: -len(item[0])
+)
+# 出现这些线索时需要LLM判断：对话主题、技能检定（如"观察挂坠"）、特殊指令
+FAST_PATH_DEFER_KEYWORDS = [
+    "问", "说", "聊", "告诉", "尝试", "试图", "检定", "观察", "仔细", "回忆",
+    "帮", "不管", "抛下", "丢下", "上车", "离开", "？", "?",
+]
+FAST_PATH_SUBJECT_PREFIXES = ["我们", "我要", "我想", "我先", "我", "要", "想", "先"]
+FAST_PATH_OBJECT_PREFIXES = ["一下", "一眼", "这个", "那个"]
+FAST_PATH_TRAILING_CHARS = "吧了。，！,.! "
+FAST_PATH_MAX_INPUT_LENGTH = 20
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv("FAST_PARSE_MIN_CONFIDENCE", 0.85))
+
+def _strip_prefixes(text: str, prefixes: list) -> str:
+    stripped = True
+    while stripped:
+        stripped = False
+        for prefix in prefixes:
+            if text.startswith(prefix):
+                text, stripped = text[len(prefix):], True
+                break
+    return text
+
+def _split_leading_verb(text: str):
+    """返回 (意图, 动词之后的目标部分)；句首不是指令动词时返回 (None, None)"""
+    text = _strip_prefixes(text, FAST_PATH_SUBJECT_PREFIXES)
+    for verb, intent in _FAST_PATH_VERBS:
+        if text.startswith(verb):
+            target = _strip_prefixes(text[len(verb):], FAST_PATH_OBJECT_PREFIXES)
+            return intent, target.rstrip(FAST_PATH_TRAILING_CHARS)
+    return None, None
+
+def _entity_aliases(name: str) -> list:
+    """实体名称及其常用简称：'艾米利亚·韦伯' -> 艾米利亚/韦伯，'古老的金币式挂坠' -> 挂坠"""
+    aliases = [name]
+    if "·" in name:
+        aliases += [part for part in name.split("·") if len(part) >= 2]
+    for sep in ("的", "式"):
+        if sep in name:
+            tail = name.rsplit(sep, 1)[-1]
+            if len(tail) >= 2:
+                aliases.append(tail)
+    return aliases
+
+def _match_strength(name: str, target: str) -> float:
+    """1.0: 目标部分就是名称或简称；0.9: 目标部分是名称中的一段（至少两个字）"""
+    if target in _entity_aliases(name):
+        return 1.0
+    if len(target) >= 2 and target in name:
+        return 0.9
+    return 0.0
 
-async def parse_player_action(player_input: str, available_npcs: list = [], available_objects: list = []) -> dict:
+def _best_match(candidates: list, target: str):
+    """返回 (匹配强度, 候选)；出现同等强度的多个候选时视为有歧义，返回 (0.0, None)"""
+    scored = [(_match_strength(name, target), payload) for name, payload in candidates if name]
+    scored = [item for item in scored if item[0] > 0]
+    if not scored:
+        return 0.0, None
+    best = max(strength for strength, _ in scored)
+    winners = [payload for strength, payload in scored if strength == best]
+    if len(winners) > 1:
+        return 0.0, None
+    return best, winners[0]
+
+def fast_parse_player_action(player_input: str, available_objects: list = [], available_maps: list = []) -> dict:
     """
-    将玩家的自然语言输入解析为结构化的意图JSON。
+    基于句首指令动词和实体名称的本地意图解析。
+    返回与LLM解析相同结构的结果并附带 confidence；无法可靠判断时返回 None。
     """
-    print("--- 玩家意图解析器开始 ---")
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    text = (player_input or "").strip()
+    if not text or len(text) > FAST_PATH_MAX_INPUT_LENGTH:
+        return None
+    if any(keyword in text for keyword in FAST_PATH_DEFER_KEYWORDS):
+        return None
+
+    intent, target = _split_leading_verb(text)
+    if not target:
+        return None
+
+    if intent == "move":
+        strength, target_map = _best_match([(m.get('map_name'), m) for m in available_maps], target)
+        if not target_map:
+            return None
+        return {"intent": "move", "target": target_map['map_name'], "target_location_id": target_map['id'], "confidence": strength}
+
+    strength, target_object = _best_match([(o.get('object_name'), o) for o in available_objects], target)
+    if not target_object:
+        return None
+    return {"intent": intent, "target": target_object['object_name'], "confidence": strength}
+
+def rule_parse_player_action(player_input: str, available_objects: list = [], available_maps: list = []) -> dict:
+    """置信度达到 FAST_PATH_MIN_CONFIDENCE 时返回规则解析的意图（不含 confidence，与LLM解析的结构一致），否则返回 None"""
+    fast_action = fast_parse_player_action(player_input, available_objects, available_maps)
+    if not fast_action or fast_action.pop('confidence') < FAST_PATH_MIN_CONFIDENCE:
+        return None
+    return fast_action
+
+# --- 核心功能: 意图解析 (全新) ---
+
+def get_available_maps(current_map_id: int) -> list:
+    """移动意图可选的目标地图：当前地图可以直接前往的地图"""
+    from map_graph import map_graph
+    return _maps_info(map_graph.neighbors(current_map_id))
+
+async def aget_available_maps(current_map_id: int) -> list:
+    """get_available_maps 的异步版本"""
+    from map_graph import map_graph
+    return _maps_info(await map_graph.aneighbors(current_map_id))
+
+def _maps_info(map_ids: list) -> list:
+    from scenario_catalog import scenario_catalog
+    return [map_info for map_info in (scenario_catalog.get_map(map_id) for map_id in map_ids) if map_info]
+
+# 意图解析规则中与当前地图无关的部分（指令、技能列表、解析规则和示例），逐字节固定，
+# 放在提示词开头以便命中模型服务商的前缀缓存；可用目标列表由 build_intent_targets 生成并放在其后
+INTENT_RULES = """
+# 1. 可用指令 (intent) 列表:
+- inspect: 观察、检查、搜寻 (关键词: 看, 检查, 调查, 搜)
+- talk: 对话 (关键词: 问, 说, 聊, 告诉)
+- take: 拿取 (关键词: 拿, 捡, 获取)
+- use: 使用 (关键词: 用, 使用)
+- use_skill: 明确意图使用某项能力 (关键词: 尝试, 试图, 我要检定[技能名])
+- move: 移动 (关键词: 走, 前往, 回到, 去)
+- leave_woman: (特殊指令) 抛下艾米利亚离开
+- help_woman: (特殊指令) 帮助艾米利亚
+
+# 2. 可用技能列表：
+- 核心属性: strength(力量), constitution(体质), size(体型), dexterity(敏捷), appearance(外貌), intelligence(智力), power(意志), education(教育), luck(幸运)
+- 衍生属性: sanity(理智), magic_points(魔法值), interest_points(兴趣点), hit_points(生命值), move_rate(移动率), damage_bonus(伤害加值), build(体格), professional_points(职业点)
+- 战斗技能: fighting(格斗), firearms(枪械), dodge(闪避)
+- 技术技能: mechanics(机械维修), drive(驾驶), stealth(潜行), investigate(调查), sleight_of_hand(妙手), electronics(电子学)
+- 知识技能: history(历史), science(科学), medicine(医学), occult(神秘学), library_use(图书馆使用), art(艺术)
+- 社交技能: persuade(说服), psychology(心理学)
+- 财富等级: credit_rating(富有程度)
+
+# 3. 解析规则:
+- 'intent' 必须是上述指令之一。
+- 'target' 必须是最后列出的可用NPC ID、物品名称、技能名称或特殊目标名称之一。
+- 'topic' 仅在 'intent' 为 'talk' 时提取谈话主题。
+- 当玩家输入较明确是特殊指令时，忽略所有其他指令，直接返回特殊指令。
+
+# 4. 示例:
+玩家输入: "艾米利亚，你爷爷是做什么的？"
+JSON: {"intent": "talk", "target": "amelia_weber", "topic": "祖父"}
+
+玩家输入: "我开车走了，不管她了。"
+JSON: {"intent": "leave_woman"}
+
+玩家输入："上车避雨吧"
+JSON: {"intent": "take_amelia_in_car"}
 
+玩家输入："我要尝试回忆附近有什么地方"
+JSON: {"intent": "use_skill", "skill_check_request": ["intelligence"]}
+
+玩家输入："我想仔细观察这个挂坠"
+JSON: {"intent": "use_skill", "skill_check_request": ["occult"]}
+
+玩家输入："我要回阿卡姆"
+JSON: {"intent": "move", "target": "阿卡姆", "target_location_id": 3}
+"""
+
+INTENT_PARSER_PREFIX = f"""你是一个COC跑团的指令解析器。根据玩家输入，分析其核心意图，并生成结构化的JSON响应。
+{INTENT_RULES}
+严格只返回JSON对象。
+"""
+
+def build_intent_targets(available_npcs: list, available_objects: list, available_maps: list) -> str:
+    """当前地图上的可用目标列表（随地图变化）"""
     npc_list_str = ", ".join([f"'{n.get('name', '未知NPC')}' (id: {n.get('id', 'unknown')})" for n in available_npcs])
     object_list_str = ", ".join([f"'{o.get('object_name', '未知物品')}' (id: {o.get('object_id', 'unknown')})" for o in available_objects])
-    
-    # 获取地图信息用于移动意图解析
-    from map_movement import map_movement_manager
-    maps_info = []
-    for map_id in range(1, 4):  # 假设有3个地图
-        map_info = map_movement_manager.get_map_info(map_id)
-        if map_info:
-            maps_info.append(f"'{map_info['map_name']}' (ID: {map_id})")
-    maps_list_str = ", ".join(maps_info)
-
-    system_prompt = f"""
-    你是一个COC跑团的指令解析器。根据玩家输入，分析其核心意图，并生成结构化的JSON响应。
-
-    # 1. 可用指令 (intent) 列表:
-    - inspect: 观察、检查、搜寻 (关键词: 看, 检查, 调查, 搜)
-    - talk: 对话 (关键词: 问, 说, 聊, 告诉)
-    - take: 拿取 (关键词: 拿, 捡, 获取)
-    - use: 使用 (关键词: 用, 使用)
-    - use_skill: 明确意图使用某项能力 (关键词: 尝试, 试图, 我要检定[技能名])
-    - move: 移动 (关键词: 走, 前往, 回到, 去)
-    - leave_woman: (特殊指令) 抛下艾米利亚离开
-    - help_woman: (特殊指令) 帮助艾米利亚
-
-    # 2. 可用目标 (target) 列表:
-    - NPC: [{npc_list_str}]
-    - 物品: [{object_list_str}]
-    - 地图: [{maps_list_str}]
-
-    # 3. 可用技能列表：
-    - 核心属性: strength(力量), constitution(体质), size(体型), dexterity(敏捷), appearance(外貌), intelligence(智力), power(意志), education(教育), luck(幸运)
-    - 衍生属性: sanity(理智), magic_points(魔法值), interest_points(兴趣点), hit_points(生命值), move_rate(移动率), damage_bonus(伤害加值), build(体格), professional_points(职业点)
-    - 战斗技能: fighting(格斗), firearms(枪械), dodge(闪避)
-    - 技术技能: mechanics(机械维修), drive(驾驶), stealth(潜行), investigate(调查), sleight_of_hand(妙手), electronics(电子学)
-    - 知识技能: history(历史), science(科学), medicine(医学), occult(神秘学), library_use(图书馆使用), art(艺术)
-    - 社交技能: persuade(说服), psychology(心理学)
-    - 财富等级: credit_rating(富有程度)
-
-    # 4. 解析规则:
-    - 'intent' 必须是上述列表之一。
-    - 'target' 必须是可用的NPC ID、物品名称、技能名称或特殊目标名称之一。
-    - 'topic' 仅在 'intent' 为 'talk' 时提取谈话主题。
-    - 当玩家输入较明确是特殊指令时，忽略所有其他指令，直接返回特殊指令。
-
-    # 4. 示例:
-    玩家输入: "艾米利亚，你爷爷是做什么的？"
-    JSON: {{"intent": "talk", "target": "amelia_weber", "topic": "祖父"}}
-    
-    玩家输入: "我开车走了，不管她了。"
-    JSON: {{"intent": "leave_woman"}}
-    
-    玩家输入："上车避雨吧"
-    JSON: {{"intent": "take_amelia_in_car"}}
-    
-    玩家输入："我要尝试回忆附近有什么地方"
-    JSON: {{"intent": "use_skill", "skill_check_request": ["intelligence"]}}
-    
-    玩家输入："我想仔细观察这个挂坠"
-    JSON: {{"intent": "use_skill", "skill_check_request": ["occult"]}}
-    
-    玩家输入："我要回阿卡姆"
-    JSON: {{"intent": "move", "target": "阿卡姆", "target_location_id": 3}}
-    
-    严格只返回JSON对象。
+    maps_list_str = ", ".join([f"'{m['map_name']}' (ID: {m['id']})" for m in available_maps])
+
+    return f"""
+# 5. 可用目标 (target) 列表:
+- NPC: [{npc_list_str}]
+- 物品: [{object_list_str}]
+- 地图: [{maps_list_str}]
+"""
+
+def build_intent_rules(available_npcs: list, available_objects: list, available_maps: list) -> str:
+    """意图解析的规则说明（静态规则 + 可用目标），供回合规划器使用"""
+    return INTENT_RULES + build_intent_targets(available_npcs, available_objects, available_maps)
+
+async def parse_player_action(player_input: str, available_npcs: list = [], available_objects: list = [],
+                              current_map_id: int = 1) -> dict:
+    """
+    将玩家的自然语言输入解析为结构化的意图JSON。
+    简单指令先走本地规则解析，只有置信度不足或存在歧义时才调用LLM。
     """
+    logger.debug("--- 玩家意图解析器开始 ---")
+
+    # 获取地图信息用于移动意图解析
+    available_maps = await aget_available_maps(current_map_id)
+
+    fast_action = rule_parse_player_action(player_input, available_objects, available_maps)
+    if fast_action:
+        logger.info("玩家意图解析结果(规则): %s", fast_action)
+        return fast_action
+
+    llm = get_llm(temperature=0)
+
+    # 静态前缀在前，当前地图的可用目标在后，玩家输入单独作为用户消息
+    system_prompt = INTENT_PARSER_PREFIX + build_intent_targets(available_npcs, available_objects, available_maps)
     
     messages = [SystemMessage(content=system_prompt), HumanMessage(content=player_input)]
-    response = await llm.ainvoke(messages)
+    content = await cached_ainvoke("intent_parse", llm, messages, is_cacheable=is_json)
     
     try:
-        parsed_action = json.loads(response.content)
-        print(f"玩家意图解析结果: {parsed_action}")
+        parsed_action = json.loads(content)
+        logger.info("玩家意图解析结果: %s", parsed_action)
         return parsed_action
     except json.JSONDecodeError:
-        print(f"JSON解析错误: {response.content}")
+        logger.warning("JSON解析错误: %s", content)
         return {"intent": "unknown", "raw_text": player_input}
 
 # --- 辅助功能: 技能检定 (从skillCheck.py保留并改造) ---
@@ -166,14 +311,14 @@ def _check_skill_logic(character_data: dict, skill_name: str, hard_level: int) -
     """私有函数：执行技能检定的核心逻辑"""
     skill_value = get_attribute_by_name(character_data, skill_name)
     if skill_value is None:
-        print(f"警告：未找到技能或属性 '{skill_name}'，使用默认值0")
+        logger.warning("未找到技能或属性 '%s'，使用默认值0", skill_name)
         skill_value = 0
     
     threshold = _get_skill_check_threshold(skill_value, hard_level)
     dice_roll = _roll_d100()
     is_success = dice_roll <= threshold
     
-    print(f"检定 {skill_name}: 技能值={skill_value}, 难度={hard_level}, 掷骰: {dice_roll} / 阈值: {threshold}")
+    logger.info("检定 %s: 技能值=%s, 难度=%s, 掷骰: %s / 阈值: %s", skill_name, skill_value, hard_level, dice_roll, threshold)
     
     return {
         'skill_name': skill_name,
@@ -204,12 +349,12 @@ def check_skill_directly(character_id: str, skill_id: int, difficulty: int = 1):
         try:
             broadcast_dice_result_sync(result)
         except Exception as e:
-            print(f"推送骰子结果失败: {e}")
+            logger.warning("推送骰子结果失败: %s", e)
         
         return result
         
     except Exception as e:
-        print(f"直接技能检定失败: {e}")
+        logger.error("直接技能检定失败: %s", e)
         return {"success": False, "error": str(e)}
 
 def generate_result_description(skill_check_result: dict) -> str:
@@ -0,0 +1,155 @@
+# prompt_budget.py
+"""
+提示词的token预算：
+- count_tokens: 使用 tiktoken 计数（PROMPT_TOKENIZER 指定编码，默认 o200k_base）；
+  tiktoken 未安装或编码文件无法加载时退回估算（中日韩字符按1个token，其余约4个字符1个token）
+- PromptSection / fit_sections: 每个片段有自己的上限和优先级，超出总预算时从优先级最低的片段开始裁剪，
+  列表类片段按整行裁剪（keep="head" 保留开头，keep="tail" 保留结尾）
+每次LLM调用的实际提示词token数由 metrics.LLMMetricsCallbackHandler 记录到 trpg_prompt_tokens。
+"""
+
+import os
+import re
+from typing import List, Dict, Any, Optional, Tuple
+
+from log_manager import get_logger
+
+logger = get_logger("prompt_budget")
+
+TRUNCATION_MARK = "…(已省略)"
+
+_CJK_RE = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """延迟加载 tiktoken 编码；失败时只记录一次警告并使用估算"""
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return _encoding
+    _encoding_loaded = True
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding(os.getenv("PROMPT_TOKENIZER", "o200k_base"))
+    except Exception as e:
+        logger.warning("tiktoken 不可用，提示词token数使用估算值: %s", e)
+        _encoding = None
+    return _encoding
+
+
+def _estimate_tokens(text: str) -> int:
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return _estimate_tokens(text)
+
+
+def count_message_tokens(messages: List[Any]) -> int:
+    """LangChain 消息列表的token数（每条消息另加约4个token的格式开销）"""
+    total = 0
+    for message in messages:
+        content = getattr(message, 'content', message)
+        total += count_tokens(content if isinstance(content, str) else str(content)) + 4
+    return total
+
+
+def truncate_text(text: str, max_tokens: int, keep: str = "head") -> str:
+    """把单段文本裁剪到 max_tokens 以内"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - count_tokens(TRUNCATION_MARK))
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        kept = tokens[:budget] if keep == "head" else tokens[len(tokens) - budget:]
+        kept_text = encoding.decode(kept)
+    else:
+        # 估算模式下按字符逐步累加
+        chars = text if keep == "head" else text[::-1]
+        used, end = 0, 0
+        for end, char in enumerate(chars):
+            used += 1 if _CJK_RE.match(char) else 0.25
+            if used > budget:
+                break
+        else:
+            end = len(chars)
+        kept_text = chars[:end] if keep == "head" else chars[:end][::-1]
+    return kept_text + TRUNCATION_MARK if keep == "head" else TRUNCATION_MARK + kept_text
+
+
+def truncate_lines(text: str, max_tokens: int, keep: str = "head") -> str:
+    """按整行裁剪；保留的第一行（或最后一行）本身超长时再按token截断"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = text.splitlines(keepends=True)
+    if keep == "tail":
+        lines.reverse()
+    kept, used = [], 0
+    for line in lines:
+        line_tokens = count_tokens(line)
+        if used + line_tokens > max_tokens:
+            if not kept:
+                kept.append(truncate_text(line, max_tokens, keep))
+            break
+        kept.append(line)
+        used += line_tokens
+    if keep == "tail":
+        kept.reverse()
+    return "".join(kept)
+
+
+class PromptSection:
+    """提示词中的一个片段：max_tokens 为单独上限，priority 越大越晚被裁剪"""
+    def __init__(self, name: str, text: str, max_tokens: Optional[int] = None, priority: int = 0,
+                 keep: str = "head"):
+        self.name = name
+        self.text = text or ""
+        self.max_tokens = max_tokens
+        self.priority = priority
+        self.keep = keep
+
+
+def fit_sections(sections: List[PromptSection], total_tokens: int) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    按预算裁剪各片段，返回 (与 sections 顺序一致的文本, 报告)。
+    报告包含最终token数和被裁剪的片段名，供日志使用。
+    """
+    texts, tokens, trimmed = [], [], []
+    for section in sections:
+        text = section.text
+        if section.max_tokens is not None:
+            limited = truncate_lines(text, section.max_tokens, section.keep)
+            if limited != text:
+                trimmed.append(section.name)
+            text = limited
+        texts.append(text)
+        tokens.append(count_tokens(text))
+
+    # 超出总预算时，按优先级从低到高（同优先级从后往前）依次压缩
+    order = sorted(range(len(sections)), key=lambda i: (sections[i].priority, -i))
+    for index in order:
+        overflow = sum(tokens) - total_tokens
+        if overflow <= 0:
+            break
+        if not tokens[index]:
+            continue
+        texts[index] = truncate_lines(texts[index], max(0, tokens[index] - overflow), sections[index].keep)
+        tokens[index] = count_tokens(texts[index])
+        if sections[index].name not in trimmed:
+            trimmed.append(sections[index].name)
+
+    report = {"tokens": sum(tokens), "trimmed": trimmed}
+    if trimmed:
+        logger.debug("提示词超出预算(%d tokens)，已裁剪: %s", total_tokens, trimmed)
+    return texts, report
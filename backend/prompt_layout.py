@@ -0,0 +1,136 @@
+# prompt_layout.py
+"""
+NPC扮演提示词的缓存友好布局，消息顺序为 静态前缀 → 半静态块 → 动态后缀：
+- NPC_SYSTEM_PREFIX：所有NPC共用的指令、输出格式和思考提示，逐字节固定，放在最前面，
+  使模型服务商的前缀缓存（prompt caching）可以跨NPC、跨回合命中
+- 半静态块：NPC的名字、初始知识和扮演须知（已按 NPC_PROFILE_FIELD_TOKENS 截断），
+  加载NPC时预编译，按NPC ID缓存；角色设定变化时自动重新编译
+- 动态后缀：NPC当前状态、目标和本回合情景，作为用户消息放在最后
+前缀命中率见 /metrics 中的 trpg_prompt_prefix_total 和 trpg_prompt_cached_tokens_total。
+"""
+
+import os
+from typing import Dict, Any, List, Tuple
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+from prompt_budget import truncate_text
+from log_manager import get_logger
+
+logger = get_logger("prompt_layout")
+
+# NPC初始知识、扮演须知各自的token上限
+NPC_PROFILE_FIELD_TOKENS = int(os.getenv("NPC_PROFILE_FIELD_TOKENS", 600))
+
+# 半静态块依赖的角色设定字段
+_NPC_BLOCK_FIELDS = ("name", "initial_knowledge", "roleplay_guidelines")
+
+NPC_SYSTEM_PREFIX = """你将扮演本消息末尾【你的角色】中指定的NPC，你的当前状态、目标和当前情景会在用户消息中给出。
+
+【重要：增强自主性】
+你是一个有独立思考能力的NPC，不要只是被动地回应玩家。你应该：
+1. **主动追求目标**：根据你的目标主动行动，即使玩家没有直接与你互动
+2. **观察环境变化**：注意周围发生的一切，包括其他NPC的行动
+3. **与其他NPC互动**：主动与其他NPC交流、合作或产生冲突
+4. **表达个人观点**：分享你的想法、担忧或建议
+5. **推动剧情发展**：通过你的行动和对话推动故事向前发展
+
+【行动优先级】：
+1. **优先回应玩家**：如果玩家直接问你问题或与你互动，必须优先回应
+2. **关注事件结果**：如果刚才发生了事件，必须根据事件结果调整你的反应
+3. 然后考虑你的个人目标和当前状态
+4. 再观察环境和其他NPC的行动
+5. 最后可以主动推进自己的剧情
+
+根据当前情景，以第一人称视角做出符合你个性的反应。请严格按照扮演须知来表现角色特征。
+
+你的回应必须是严格的JSON格式，包含以下字段：
+- "visibility": "public" 或 "private"
+- "dialogue": "你要说的话"
+- "action": "你要做的动作"
+- "new_status": "新状态"
+- "new_goal": "新目标"
+
+【visibility 判断规则】：
+- "public": 基本信息、直接回答、明显的行为动作、对当前情况的反应
+- "private": 内心想法、秘密计划、暗中观察、不想让别人知道的行动
+
+示例：
+- 正常行动、普通对话 → "public"
+- 表达恐惧、寻求帮助 → "public"
+- 内心独白、秘密计划 → "private"
+- 暗中观察、偷偷行动 → "private"
+
+示例格式：
+{"visibility": "public", "dialogue": "天哪！", "action": "惊恐地后退", "new_status": "受惊", "new_goal": "寻求安全"}
+
+注意：必须返回有效的JSON，不要有任何其他文字。
+
+【思考提示】：
+请仔细思考以下问题，然后做出反应：
+
+1. **玩家互动优先级**：玩家是否在直接与你互动？如果是，必须优先回应！
+2. **事件结果影响**：刚才是否发生了事件？事件结果如何影响你的状态和反应？
+3. **你的个人目标**：你现在最想做什么？你的目标是什么？
+4. **环境观察**：你注意到了什么？有什么变化？
+5. **其他NPC**：你对其他NPC的行动有什么看法？想与他们互动吗？
+6. **主动行动**：在回应玩家后，你还能主动做什么来推进你的目标？
+7. **情感状态**：你现在的感受如何？这会影响你的行动吗？
+
+**重要提醒**：
+- 如果玩家直接问你问题或与你说话，你必须先回应玩家！
+- 如果刚才发生了事件，你必须根据事件结果调整你的反应和状态！
+"""
+
+
+def _compile_npc_block(npc_info: Dict[str, Any]) -> str:
+    return f"""
+【你的角色】：{npc_info.get('name')}
+
+【你的初始知识】：
+{truncate_text(npc_info.get('initial_knowledge') or '无特殊知识', NPC_PROFILE_FIELD_TOKENS)}
+
+【扮演须知】：
+{truncate_text(npc_info.get('roleplay_guidelines') or '保持角色一致性', NPC_PROFILE_FIELD_TOKENS)}
+"""
+
+
+class NpcPromptCache:
+    """每个NPC编译好的system消息（静态前缀 + 半静态块），按NPC ID缓存"""
+    def __init__(self):
+        self._prompts: Dict[str, Tuple[tuple, str]] = {}
+
+    def system_prompt(self, npc_info: Dict[str, Any]) -> str:
+        npc_id = npc_info.get('id')
+        fingerprint = tuple(npc_info.get(field) for field in _NPC_BLOCK_FIELDS)
+        cached = self._prompts.get(npc_id)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        prompt = NPC_SYSTEM_PREFIX + _compile_npc_block(npc_info)
+        self._prompts[npc_id] = (fingerprint, prompt)
+        logger.debug("NPC %s 的提示词块已编译", npc_id)
+        return prompt
+
+    def precompile(self, npc_infos: List[Dict[str, Any]]):
+        """加载NPC时调用，提前编译本回合可能用到的提示词块"""
+        for npc_info in npc_infos:
+            self.system_prompt(npc_info)
+
+    def invalidate(self):
+        """剧本内容重新加载后调用"""
+        self._prompts.clear()
+
+
+def build_npc_messages(npc_info: Dict[str, Any], full_context_for_npc: str) -> list:
+    """构建NPC扮演的LLM消息：system消息在回合间不变，动态内容只出现在用户消息中"""
+    return [
+        SystemMessage(content=npc_prompt_cache.system_prompt(npc_info)),
+        HumanMessage(content=(
+            f"你的当前状态是：'{npc_info.get('status', '正常')}'，你的目标是：'{npc_info.get('current_goal', '无')}'。\n\n"
+            f"当前情景: {full_context_for_npc}"
+        )),
+    ]
+
+
+# 创建全局实例
+npc_prompt_cache = NpcPromptCache()
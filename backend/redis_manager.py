@@ -1,15 +1,58 @@
 # redis_manager.py
 """
 Redis连接管理模块, 采用'动静分离'原则管理游戏状态
+同步函数供脚本和线程中的代码使用；以 a 开头的异步版本 (aget_session_state 等) 基于 redis.asyncio，
+所有协程共享一个连接池，供LangGraph节点使用，避免Redis往返阻塞事件循环。
+回合处理期间在 turn_cache() 作用域内运行，同一个键在一个回合中只从Redis读取一次。
 """
 import redis
+import redis.asyncio
 import os
 import json
+import asyncio
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Optional, Dict, Any, List
 
+from metrics import metrics
+from log_manager import get_logger
+
+logger = get_logger("redis_manager")
+
+class InstrumentedRedis(redis.Redis):
+    """记录每条命令耗时的Redis客户端；pipeline 按一次往返整体计时"""
+    def execute_command(self, *args, **options):
+        with metrics.track_dependency("redis", str(args[0]).lower()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with metrics.track_dependency("redis", "pipeline"):
+            return super().execute(raise_on_error)
+
+class AsyncInstrumentedRedis(redis.asyncio.Redis):
+    """异步版本的 InstrumentedRedis"""
+    async def execute_command(self, *args, **options):
+        with metrics.track_dependency("redis", str(args[0]).lower()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncInstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class AsyncInstrumentedPipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        with metrics.track_dependency("redis", "pipeline"):
+            return await super().execute(raise_on_error)
+
 class RedisManager:
     def __init__(self):
         self._client: Optional[redis.Redis] = None
+        self._async_client: Optional[redis.asyncio.Redis] = None
+        self._async_pool: Optional[redis.asyncio.ConnectionPool] = None
         self._is_connected = False
     
     def initialize(self, host: str = None, port: int = None, db: int = None):
@@ -18,17 +61,27 @@ class RedisManager:
             redis_port = port or int(os.getenv("REDIS_PORT", 6379))
             redis_db = db or int(os.getenv("REDIS_DB", 0))
             
-            self._client = redis.Redis(host=redis_host, port=redis_port, db=redis_db, decode_responses=True)
+            self._client = InstrumentedRedis(host=redis_host, port=redis_port, db=redis_db, decode_responses=True)
             self._client.ping()
+            # 异步客户端共享一个连接池，连接在首次使用时按需建立
+            self._async_pool = redis.asyncio.ConnectionPool(
+                host=redis_host, port=redis_port, db=redis_db, decode_responses=True,
+                max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+            )
+            self._async_client = AsyncInstrumentedRedis(connection_pool=self._async_pool)
             self._is_connected = True
-            print(f"✅ Redis连接成功！主机: {redis_host}:{redis_port}, 数据库: {redis_db}")
+            logger.info("✅ Redis连接成功！主机: %s:%s, 数据库: %s", redis_host, redis_port, redis_db)
         except Exception as e:
-            print(f"❌ Redis连接失败: {e}")
+            logger.error("❌ Redis连接失败: %s", e)
             self._client = None
+            self._async_client = None
             self._is_connected = False
     
     def get_client(self) -> Optional[redis.Redis]:
         return self._client if self._is_connected else None
+
+    def get_async_client(self) -> Optional[redis.asyncio.Redis]:
+        return self._async_client if self._is_connected else None
     
     def is_connected(self) -> bool:
         return self._is_connected
@@ -36,13 +89,23 @@ class RedisManager:
     def close(self):
         if self._client:
             self._client.close()
-            print("Redis连接已关闭。")
+            logger.info("Redis连接已关闭。")
+
+    async def aclose(self):
+        if self._async_client:
+            await self._async_client.aclose()
+            await self._async_pool.disconnect()
+            self._async_client = None
+            logger.info("Redis异步连接池已关闭。")
 
 # --- 全局实例和便捷函数 ---
 redis_manager = RedisManager()
 def get_redis_client() -> Optional[redis.Redis]:
     return redis_manager.get_client()
 
+def get_async_redis_client() -> Optional[redis.asyncio.Redis]:
+    return redis_manager.get_async_client()
+
 # --- 键名常量 ---
 WORLD_STATE_KEY = "world_state"
 MAP_STATE_KEY_PREFIX = "map_state:" # 新增
@@ -51,16 +114,108 @@ SESSION_KEY_PREFIX = "session_state:"
 CONVERSATION_KEY_PREFIX = "conversation_history:"
 COMPLETED_EVENTS_KEY_PREFIX = "completed_events:"
 
+# --- 0. 回合内读缓存 ---
+# 一个回合内同一个键只读取一次：turn_cache() 作用域内所有 get_/aget_ 函数先查缓存，
+# save_/asave_ 函数写Redis的同时更新缓存；缓存保存的是原始JSON字符串，调用方修改返回的字典不会影响缓存。
+# 子任务和 asyncio.to_thread 会复制上下文，因此共享同一个回合缓存。
+class _TurnCache:
+    def __init__(self):
+        self.values: Dict[str, Optional[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+_turn_cache: contextvars.ContextVar = contextvars.ContextVar("redis_turn_cache", default=None)
+
+@contextmanager
+def turn_cache():
+    """标记一个回合的Redis读缓存作用域，退出时丢弃缓存"""
+    cache = _TurnCache()
+    token = _turn_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        logger.debug("回合Redis缓存: 命中 %d, 未命中 %d", cache.hits, cache.misses)
+        try:
+            _turn_cache.reset(token)
+        except ValueError:
+            # 流式响应的生成器可能在其他上下文中被关闭
+            _turn_cache.set(None)
+
+def _cache_lookup(key: str):
+    """返回 (是否命中, 值)"""
+    cache = _turn_cache.get()
+    if cache is not None and key in cache.values:
+        cache.hits += 1
+        return True, cache.values[key]
+    return False, None
+
+def _cache_put(key: str, data: Optional[str]):
+    cache = _turn_cache.get()
+    if cache is not None:
+        cache.values[key] = data
+
+def _cache_miss(key: str, data: Optional[str]):
+    cache = _turn_cache.get()
+    if cache is not None:
+        cache.misses += 1
+        cache.values[key] = data
+
+def _cached_get(redis_client, key: str) -> Optional[str]:
+    hit, data = _cache_lookup(key)
+    if hit: return data
+    data = redis_client.get(key)
+    _cache_miss(key, data)
+    return data
+
+def _split_cached(keys: List[str]):
+    """返回 (缓存中已有的值, 需要从Redis读取的键)"""
+    results = {}
+    missing = []
+    for key in keys:
+        hit, data = _cache_lookup(key)
+        if hit:
+            results[key] = data
+        elif key not in missing:
+            missing.append(key)
+    return results, missing
+
+def _store_fetched(results: Dict[str, Optional[str]], missing: List[str], values: List[Optional[str]]):
+    for key, data in zip(missing, values):
+        _cache_miss(key, data)
+        results[key] = data
+
+def _cached_mget(redis_client, keys: List[str]) -> List[Optional[str]]:
+    """只为缓存中没有的键发出一次 MGET"""
+    results, missing = _split_cached(keys)
+    if missing:
+        _store_fetched(results, missing, redis_client.mget(missing))
+    return [results[key] for key in keys]
+
+async def _acached_get(redis_client, key: str) -> Optional[str]:
+    hit, data = _cache_lookup(key)
+    if hit: return data
+    data = await redis_client.get(key)
+    _cache_miss(key, data)
+    return data
+
+async def _acached_mget(redis_client, keys: List[str]) -> List[Optional[str]]:
+    results, missing = _split_cached(keys)
+    if missing:
+        _store_fetched(results, missing, await redis_client.mget(missing))
+    return [results[key] for key in keys]
+
 # --- 1. 世界状态管理 ---
 def save_world_state(state: Dict[str, Any]):
     redis_client = get_redis_client()
     if not redis_client: return
-    redis_client.set(WORLD_STATE_KEY, json.dumps(state, ensure_ascii=False))
+    data = json.dumps(state, ensure_ascii=False)
+    redis_client.set(WORLD_STATE_KEY, data)
+    _cache_put(WORLD_STATE_KEY, data)
 
 def get_world_state() -> Dict[str, Any]:
     redis_client = get_redis_client()
     if not redis_client: return {}
-    data = redis_client.get(WORLD_STATE_KEY)
+    data = _cached_get(redis_client, WORLD_STATE_KEY)
     return json.loads(data) if data else {}
 
 # --- 2. 地图状态管理 ---
@@ -68,39 +223,32 @@ def save_map_state(map_id: int, map_data: Dict[str, Any]):
     redis_client = get_redis_client()
     if not redis_client: return
     key = f"{MAP_STATE_KEY_PREFIX}{map_id}"
-    redis_client.setex(key, 86400, json.dumps(map_data, ensure_ascii=False))
+    data = json.dumps(map_data, ensure_ascii=False)
+    redis_client.setex(key, 86400, data)
+    _cache_put(key, data)
 
 def get_map_state(map_id: int) -> Dict[str, Any]:
     redis_client = get_redis_client()
-    if not redis_client: return {"npcs": [], "objects": {}, "accessible_maps": []}
+    if not redis_client: return _default_map_state(map_id)
     key = f"{MAP_STATE_KEY_PREFIX}{map_id}"
-    data = redis_client.get(key)
-    return json.loads(data) if data else {"npcs": [], "objects": {}, "accessible_maps": []}
+    data = _cached_get(redis_client, key)
+    return json.loads(data) if data else _default_map_state(map_id)
 
 # --- 2.1. 地图可访问性管理 (集成到map_state中) ---
 def get_map_accessibility(map_id: int) -> List[int]:
-    """从map_state中获取地图的可访问性信息"""
-    map_state = get_map_state(map_id)
-    accessible_maps = map_state.get("accessible_maps", [])
-    
-    # 如果Redis中没有数据，尝试从数据库重新初始化
-    if not accessible_maps:
-        print(f"地图{map_id}的Redis中没有可访问性数据，尝试重新初始化...")
-        initialize_map_accessibility_from_db(map_id)
-        # 重新获取
-        map_state = get_map_state(map_id)
-        accessible_maps = map_state.get("accessible_maps", [])
-    
-    return accessible_maps
+    """地图当前可前往的地图（Redis中的动态状态优先，否则为剧本设定），由地图连通图服务缓存"""
+    from map_graph import map_graph
+    return map_graph.neighbors(map_id)
 
 def update_map_accessibility(map_id: int, target_map_id: int, is_accessible: bool):
     """更新特定地图的可访问性"""
+    from map_graph import map_graph
     redis_client = get_redis_client()
     if not redis_client: return
     
-    # 获取当前地图状态
+    # 以连通图中的当前状态为基础修改，map_state中尚未保存可访问性时不会丢失剧本设定的出口
     map_state = get_map_state(map_id)
-    current_accessible = map_state.get("accessible_maps", [])
+    current_accessible = map_graph.neighbors(map_id)
     
     if is_accessible and target_map_id not in current_accessible:
         current_accessible.append(target_map_id)
@@ -110,98 +258,474 @@ def update_map_accessibility(map_id: int, target_map_id: int, is_accessible: boo
     # 更新map_state中的可访问性
     map_state["accessible_maps"] = current_accessible
     save_map_state(map_id, map_state)
+    map_graph.invalidate()
     
-    print(f"地图{map_id}到地图{target_map_id}的可访问性已更新为: {is_accessible}")
+    logger.info("地图%s到地图%s的可访问性已更新为: %s", map_id, target_map_id, is_accessible)
 
 def initialize_map_accessibility_from_db(map_id: int = None):
-    """从数据库初始化指定地图的可访问性到map_state，如果不指定则初始化所有地图"""
+    """从剧本目录初始化指定地图的可访问性到map_state，如果不指定则初始化所有地图"""
     try:
-        from databaseManager import db_manager
+        from scenario_catalog import scenario_catalog
         
-        if map_id is not None:
-            # 只初始化指定地图
-            maps_data = db_manager.execute_query("SELECT id, accessible_locations FROM maps WHERE id = ?", (map_id,))
-        else:
-            # 初始化所有地图
-            maps_data = db_manager.execute_query("SELECT id, accessible_locations FROM maps ORDER BY id")
+        map_ids = [map_id] if map_id is not None else [map_data['id'] for map_data in scenario_catalog.maps()]
         
-        for map_data in maps_data:
-            current_map_id = map_data['id']
-            accessible_locations = map_data.get('accessible_locations')
-            
-            if accessible_locations:
-                try:
-                    accessible_list = json.loads(accessible_locations)
-                    # 获取现有map_state或创建新的
-                    map_state = get_map_state(current_map_id)
-                    map_state["accessible_maps"] = accessible_list
-                    save_map_state(current_map_id, map_state)
-                    print(f"地图{current_map_id}的可访问性已初始化到map_state: {accessible_list}")
-                except json.JSONDecodeError:
-                    print(f"地图{current_map_id}的可访问性数据格式错误: {accessible_locations}")
-            else:
-                map_state = get_map_state(current_map_id)
-                map_state["accessible_maps"] = []
-                save_map_state(current_map_id, map_state)
-                print(f"地图{current_map_id}的可访问性已初始化为空列表")
+        for current_map_id in map_ids:
+            if scenario_catalog.get_map(current_map_id) is None:
+                continue
+            accessible_list = scenario_catalog.static_accessible_maps(current_map_id)
+            # 获取现有map_state或创建新的
+            map_state = get_map_state(current_map_id)
+            map_state["accessible_maps"] = accessible_list
+            save_map_state(current_map_id, map_state)
+            logger.debug("地图%s的可访问性已初始化到map_state: %s", current_map_id, accessible_list)
+        
+        from map_graph import map_graph
+        map_graph.invalidate()
                 
     except Exception as e:
-        print(f"初始化地图可访问性失败: {e}")
+        logger.warning("初始化地图可访问性失败: %s", e)
 
 # --- 3. 角色静态数据 (Character Sheet) ---
 def save_character_sheet(character_id: str, sheet_data: Dict[str, Any]):
     redis_client = get_redis_client()
     if not redis_client: return
     key = f"{SHEET_KEY_PREFIX}{character_id}"
-    redis_client.setex(key, 86400, json.dumps(sheet_data, ensure_ascii=False))
+    data = json.dumps(sheet_data, ensure_ascii=False)
+    redis_client.setex(key, 86400, data)
+    _cache_put(key, data)
 
 def get_character_sheet(character_id: str) -> Dict[str, Any]:
     redis_client = get_redis_client()
     if not redis_client: return {}
     key = f"{SHEET_KEY_PREFIX}{character_id}"
-    data = redis_client.get(key)
+    data = _cached_get(redis_client, key)
     return json.loads(data) if data else {}
 
 # --- 4. 角色动态数据 (Session State) ---
+# session_state 以Hash保存，每个字段的值是JSON编码（数值仍是整数文本，可直接 HINCRBY），读取时按字段解码还原类型。
+# 回合缓存中保存的是整个 session 的JSON。
+def _encode_session(session_data: Dict[str, Any]) -> Dict[str, str]:
+    return {field: json.dumps(value, ensure_ascii=False) for field, value in session_data.items()}
+
+def _decode_session_field(value: str) -> Any:
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def _decode_session(fields: Dict[str, str]) -> Dict[str, Any]:
+    return {field: _decode_session_field(value) for field, value in (fields or {}).items()}
+
+def _session_cache_value(session_data: Dict[str, Any]) -> Optional[str]:
+    return json.dumps(session_data, ensure_ascii=False) if session_data else None
+
+def _queue_session_replace(pipe, key: str, session_data: Dict[str, Any]):
+    """整体替换一个 session（在调用方的事务中执行），只用于把旧版本的JSON字符串转换为Hash"""
+    pipe.delete(key)
+    if session_data:
+        pipe.hset(key, mapping=_encode_session(session_data))
+        pipe.expire(key, 86400)
+
+def _queue_session_write(pipe, key: str, session_data: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+    """
+    相对 previous（之前读取到的 session）只写入变化的部分：改变或新增的字段 HSET，被删除的字段 HDEL。
+    未改变的字段不写，其他请求对这些字段的并发 HINCRBY/HSET 不会被覆盖。
+    previous 为 None 表示键仍是旧版本的JSON字符串，整体替换。
+    """
+    if previous is None:
+        _queue_session_replace(pipe, key, session_data)
+        return
+    encoded, previous_encoded = _encode_session(session_data), _encode_session(previous)
+    removed = [field for field in previous_encoded if field not in encoded]
+    changed = {field: value for field, value in encoded.items() if previous_encoded.get(field) != value}
+    if removed:
+        pipe.hdel(key, *removed)
+    if changed:
+        pipe.hset(key, mapping=changed)
+    if encoded:
+        pipe.expire(key, 86400)
+
+def _session_baseline(redis_client, key: str) -> Optional[Dict[str, Any]]:
+    """写回 session 时比较的基准：本回合已读取的值（回合缓存），没有时从Redis读取；旧格式的键返回 None"""
+    hit, data = _cache_lookup(key)
+    if hit: return _decode(data, {})
+    try:
+        return _decode_session(redis_client.hgetall(key))
+    except redis.ResponseError:
+        return None
+
+async def _asession_baseline(redis_client, key: str) -> Optional[Dict[str, Any]]:
+    hit, data = _cache_lookup(key)
+    if hit: return _decode(data, {})
+    try:
+        return _decode_session(await redis_client.hgetall(key))
+    except redis.ResponseError:
+        return None
+
+def _migrate_legacy_session(redis_client, key: str) -> Dict[str, Any]:
+    """读取旧版本以JSON字符串保存的 session 并立即转换为Hash，之后的按字段写入不会遇到类型错误"""
+    session = _decode(redis_client.get(key), {})
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_session_replace(pipe, key, session)
+    pipe.execute()
+    return session
+
+async def _amigrate_legacy_session(redis_client, key: str) -> Dict[str, Any]:
+    session = _decode(await redis_client.get(key), {})
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_session_replace(pipe, key, session)
+    await pipe.execute()
+    return session
+
+def _fetch_session(redis_client, key: str) -> Dict[str, Any]:
+    try:
+        return _decode_session(redis_client.hgetall(key))
+    except redis.ResponseError:
+        return _migrate_legacy_session(redis_client, key)
+
 def save_session_state(character_id: str, session_data: Dict[str, Any]):
     redis_client = get_redis_client()
     if not redis_client: return
     key = f"{SESSION_KEY_PREFIX}{character_id}"
-    redis_client.setex(key, 86400, json.dumps(session_data, ensure_ascii=False))
+    previous = _session_baseline(redis_client, key)
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_session_write(pipe, key, session_data, previous)
+    pipe.execute()
+    _cache_put(key, _session_cache_value(session_data))
 
 def get_session_state(character_id: str) -> Dict[str, Any]:
     redis_client = get_redis_client()
     if not redis_client: return {}
     key = f"{SESSION_KEY_PREFIX}{character_id}"
-    data = redis_client.get(key)
-    return json.loads(data) if data else {}
+    hit, data = _cache_lookup(key)
+    if hit: return _decode(data, {})
+    session = _fetch_session(redis_client, key)
+    _cache_miss(key, _session_cache_value(session))
+    return session
+
+def update_session_fields(character_id: str, fields: Dict[str, Any]):
+    """只修改 session 的部分字段（HSET），不会覆盖其他写入方对其余字段的修改"""
+    redis_client = get_redis_client()
+    if not redis_client or not fields: return
+    key = f"{SESSION_KEY_PREFIX}{character_id}"
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(key, mapping=_encode_session(fields))
+    pipe.expire(key, 86400)
+    pipe.hgetall(key)
+    try:
+        session = _decode_session(pipe.execute()[-1])
+    except redis.ResponseError:
+        session = {**_decode(redis_client.get(key), {}), **fields}
+        save_session_state(character_id, session)
+        return
+    _cache_put(key, _session_cache_value(session))
 
 # --- 5. 对话历史 & 已完成事件 ---
-def get_conversation_history(character_id: str) -> List[Dict[str, str]]:
+# 对话历史以Redis列表保存，每条消息一个JSON元素：回合结束时只 RPUSH 本回合新增的消息，
+# 回合开始时只读取最近 CONVERSATION_HISTORY_WINDOW 条，单回合的开销不随会话长度增长。
+# 列表最多保留 CONVERSATION_HISTORY_MAX_LENGTH 条（0 表示不限制）。列表不经过回合缓存。
+CONVERSATION_HISTORY_WINDOW = int(os.getenv("CONVERSATION_HISTORY_WINDOW", 10))
+CONVERSATION_HISTORY_MAX_LENGTH = int(os.getenv("CONVERSATION_HISTORY_MAX_LENGTH", 1000))
+
+def _history_range(limit: Optional[int]) -> tuple:
+    return (-limit, -1) if limit else (0, -1)
+
+def _decode_history(entries: List[str]) -> List[Dict[str, str]]:
+    return [json.loads(entry) for entry in entries or []]
+
+def _queue_history_append(pipe, key: str, messages: List[Dict[str, str]]):
+    if not messages: return
+    pipe.rpush(key, *[json.dumps(message, ensure_ascii=False) for message in messages])
+    if CONVERSATION_HISTORY_MAX_LENGTH > 0:
+        pipe.ltrim(key, -CONVERSATION_HISTORY_MAX_LENGTH, -1)
+    pipe.expire(key, 86400)
+
+def _queue_history_replace(pipe, key: str, history: List[Dict[str, str]]):
+    pipe.delete(key)
+    _queue_history_append(pipe, key, history)
+
+def _history_tail(history: List[Dict[str, str]], limit: Optional[int]) -> List[Dict[str, str]]:
+    return history[-limit:] if limit else history
+
+def _migrate_legacy_history(redis_client, key: str, limit: Optional[int]) -> List[Dict[str, str]]:
+    """旧版本把整个对话历史保存为一个JSON字符串：读出后转换为列表"""
+    history = _decode(redis_client.get(key), [])
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_history_replace(pipe, key, history)
+    pipe.execute()
+    logger.info("对话历史 %s 已转换为列表格式，共 %d 条", key, len(history))
+    return _history_tail(history, limit)
+
+def get_conversation_history(character_id: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
+    """读取对话历史；limit 为最近的条数，None 表示全部"""
     redis_client = get_redis_client()
     if not redis_client: return []
     key = f"{CONVERSATION_KEY_PREFIX}{character_id}"
-    data = redis_client.get(key)
-    return json.loads(data) if data else []
+    try:
+        return _decode_history(redis_client.lrange(key, *_history_range(limit)))
+    except redis.ResponseError:
+        return _migrate_legacy_history(redis_client, key, limit)
+
+def append_conversation_messages(character_id: str, messages: List[Dict[str, str]]):
+    """在对话历史末尾追加消息"""
+    redis_client = get_redis_client()
+    if not redis_client or not messages: return
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_history_append(pipe, f"{CONVERSATION_KEY_PREFIX}{character_id}", messages)
+    pipe.execute()
 
 def save_conversation_history(character_id: str, history: List[Dict[str, str]]):
+    """整体替换对话历史"""
     redis_client = get_redis_client()
     if not redis_client: return
-    key = f"{CONVERSATION_KEY_PREFIX}{character_id}"
-    redis_client.setex(key, 86400, json.dumps(history, ensure_ascii=False))
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_history_replace(pipe, f"{CONVERSATION_KEY_PREFIX}{character_id}", history)
+    pipe.execute()
 
 def get_completed_event_ids(character_id: str) -> List[int]:
     redis_client = get_redis_client()
     if not redis_client: return []
     key = f"{COMPLETED_EVENTS_KEY_PREFIX}{character_id}"
-    data = redis_client.get(key)
+    data = _cached_get(redis_client, key)
     return json.loads(data) if data else []
 
 def save_completed_event_ids(character_id: str, event_ids: List[int]):
     redis_client = get_redis_client()
     if not redis_client: return
     key = f"{COMPLETED_EVENTS_KEY_PREFIX}{character_id}"
-    redis_client.setex(key, 86400, json.dumps(event_ids))
+    data = json.dumps(event_ids)
+    redis_client.setex(key, 86400, data)
+    _cache_put(key, data)
+
+# --- 5.1 回合快照：一次往返读取、一次事务写回 ---
+# 记录每个角色上一回合所在的地图，用于在同一次 MGET 中预取地图状态。
+# 只保留最近 TURN_MAP_ID_CACHE_SIZE 个角色；被淘汰的角色下一回合按地图1预取，换了地图时多一次 GET
+TURN_MAP_ID_CACHE_SIZE = int(os.getenv("TURN_MAP_ID_CACHE_SIZE", 10000))
+_last_turn_map_ids: "OrderedDict[str, int]" = OrderedDict()
+
+def _guess_turn_map_id(character_id: str) -> int:
+    return _last_turn_map_ids.get(character_id, 1)
+
+def _remember_turn_map_id(character_id: str, map_id: int):
+    _last_turn_map_ids.pop(character_id, None)
+    _last_turn_map_ids[character_id] = map_id
+    while len(_last_turn_map_ids) > TURN_MAP_ID_CACHE_SIZE:
+        _last_turn_map_ids.popitem(last=False)
+
+def _default_map_state(map_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Redis中没有 map_state 时（未初始化或TTL过期）的默认值。
+    accessible_maps 取剧本设定的出口：空列表表示"已无出口"，不能用作缺省值，否则写回后地图会永久失去出口。
+    """
+    map_state = {"npcs": [], "objects": {}}
+    if map_id is not None:
+        from scenario_catalog import scenario_catalog
+        map_state["accessible_maps"] = scenario_catalog.static_accessible_maps(map_id)
+    return map_state
+
+def _decode(data: Optional[str], default: Any) -> Any:
+    return json.loads(data) if data else default
+
+def _empty_turn_snapshot() -> Dict[str, Any]:
+    return {
+        "character_sheet": {}, "session_state": {}, "world_state": {},
+        "map_state": _default_map_state(), "conversation_history": [], "completed_events": []
+    }
+
+def _turn_snapshot_keys(character_id: str, map_id: int) -> List[str]:
+    """回合快照中以字符串保存的键（session 是Hash、对话历史是列表，单独读取）"""
+    return [
+        f"{SHEET_KEY_PREFIX}{character_id}",
+        WORLD_STATE_KEY,
+        f"{MAP_STATE_KEY_PREFIX}{map_id}",
+        f"{COMPLETED_EVENTS_KEY_PREFIX}{character_id}",
+    ]
+
+def _queue_turn_snapshot_read(pipe, missing: List[str], session_key: Optional[str], history_key: str):
+    """字符串键用 MGET，session Hash 用 HGETALL，对话历史用 LRANGE 读取最近几条，放在同一个pipeline中一次往返"""
+    if missing: pipe.mget(missing)
+    if session_key: pipe.hgetall(session_key)
+    pipe.lrange(history_key, -CONVERSATION_HISTORY_WINDOW, -1)
+
+def _session_from_reply(reply: Any) -> Optional[Dict[str, Any]]:
+    """HGETALL 的回复；键是旧版本的JSON字符串时返回 None，由调用方改用 GET 读取"""
+    return None if isinstance(reply, Exception) else _decode_session(reply)
+
+def _build_turn_snapshot(results: Dict[str, Optional[str]], keys: List[str], session_state: Dict[str, Any],
+                         map_id: int, map_data: Optional[str], history: List[Dict[str, str]]) -> Dict[str, Any]:
+    sheet, world, _, completed = [results[key] for key in keys]
+    return {
+        "character_sheet": _decode(sheet, {}),
+        "session_state": session_state,
+        "world_state": _decode(world, {}),
+        "map_state": _decode(map_data, None) or _default_map_state(map_id),
+        "conversation_history": history,
+        "completed_events": _decode(completed, []),
+    }
+
+def load_turn_snapshot(character_id: str) -> Dict[str, Any]:
+    """
+    用一次往返读取一个回合所需的全部状态: 角色卡、会话、世界、地图、对话历史、已完成事件。
+    地图键依赖会话中的 current_map_id，这里按上一回合的地图预取；
+    只有角色在回合之外换了地图时，才需要额外一次 GET。
+    """
+    redis_client = get_redis_client()
+    if not redis_client:
+        return _empty_turn_snapshot()
+
+    guessed_map_id = _guess_turn_map_id(character_id)
+    keys = _turn_snapshot_keys(character_id, guessed_map_id)
+    session_key = f"{SESSION_KEY_PREFIX}{character_id}"
+    history_key = f"{CONVERSATION_KEY_PREFIX}{character_id}"
+    results, missing = _split_cached(keys)
+    session_hit, session_data = _cache_lookup(session_key)
+    pipe = redis_client.pipeline(transaction=False)
+    _queue_turn_snapshot_read(pipe, missing, None if session_hit else session_key, history_key)
+    replies = pipe.execute(raise_on_error=False)
+    if missing:
+        _store_fetched(results, missing, replies.pop(0))
+    if not session_hit:
+        session = _session_from_reply(replies.pop(0))
+        if session is None:
+            session = _migrate_legacy_session(redis_client, session_key)
+        session_data = _session_cache_value(session)
+        _cache_miss(session_key, session_data)
+    history_reply = replies.pop(0)
+    if isinstance(history_reply, Exception):
+        history = _migrate_legacy_history(redis_client, history_key, CONVERSATION_HISTORY_WINDOW)
+    else:
+        history = _decode_history(history_reply)
+
+    session_state = _decode(session_data, {})
+    current_map_id = session_state.get('current_map_id', 1)
+    map_data = results[keys[2]]
+    if current_map_id != guessed_map_id:
+        map_data = _cached_get(redis_client, f"{MAP_STATE_KEY_PREFIX}{current_map_id}")
+    _remember_turn_map_id(character_id, current_map_id)
+
+    return _build_turn_snapshot(results, keys, session_state, current_map_id, map_data, history)
+
+# 世界状态和地图状态是所有角色共享的键，两个角色的回合可能同时修改它们。
+# 写回时只应用本回合相对读取时（回合缓存中的值）的修改：字典逐键递归比较，其他值整体替换，
+# 在 WATCH 之后读取最新值、合并修改并在同一个事务中写回；其间键被其他回合修改时重试。
+_REMOVED = object()
+
+class _NestedPatch:
+    """两边都是字典的键：只应用子键的修改；目标中该键已不是字典时整体写入 value"""
+    def __init__(self, patch: Dict[str, Any], value: Dict[str, Any]):
+        self.patch = patch
+        self.value = value
+
+def _dict_patch(previous: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    """返回把 previous 变成 current 的修改 {键: 新值}，被删除的键对应 _REMOVED"""
+    patch = {key: _REMOVED for key in previous if key not in current}
+    for key, value in current.items():
+        old = previous.get(key, _REMOVED)
+        if isinstance(old, dict) and isinstance(value, dict):
+            nested = _dict_patch(old, value)
+            if nested:
+                patch[key] = _NestedPatch(nested, value)
+        elif old is _REMOVED or old != value:
+            patch[key] = value
+    return patch
+
+def _apply_patch(target: Dict[str, Any], patch: Dict[str, Any]) -> Dict[str, Any]:
+    for key, value in patch.items():
+        if value is _REMOVED:
+            target.pop(key, None)
+        elif isinstance(value, _NestedPatch):
+            child = target.get(key)
+            target[key] = _apply_patch(child, value.patch) if isinstance(child, dict) else value.value
+        else:
+            target[key] = value
+    return target
+
+def _shared_state_patches(world_state: Dict[str, Any], map_id: int, map_state: Dict[str, Any]) -> Dict[str, tuple]:
+    """
+    返回 {键: (本回合的值, 修改)}，没有修改的键不写回。
+    不在回合缓存中（没有读取基准）的键修改为 None，整体写入。
+    """
+    patches = {}
+    for key, value in ((WORLD_STATE_KEY, world_state), (f"{MAP_STATE_KEY_PREFIX}{map_id}", map_state)):
+        # JSON往返一次，键和值的类型与从Redis读取的基准一致
+        value = json.loads(json.dumps(value, ensure_ascii=False))
+        hit, data = _cache_lookup(key)
+        if not hit:
+            patches[key] = (value, None)
+            continue
+        patch = _dict_patch(_decode(data, {}), value)
+        if patch:
+            patches[key] = (value, patch)
+    return patches
+
+def _merge_shared_state(patches: Dict[str, tuple], current: Dict[str, Optional[str]], map_id: int) -> Dict[str, str]:
+    """把本回合的修改应用到 WATCH 之后读取的最新值上，返回要写入的JSON"""
+    merged = {}
+    for key, (value, patch) in patches.items():
+        if patch is not None:
+            default = {} if key == WORLD_STATE_KEY else _default_map_state(map_id)
+            value = _apply_patch(_decode(current.get(key), None) or default, patch)
+        merged[key] = json.dumps(value, ensure_ascii=False)
+    return merged
+
+def _queue_turn_snapshot_write(pipe, character_id: str, shared_values: Dict[str, str],
+                               session_state: Dict[str, Any],
+                               new_messages: List[Dict[str, str]],
+                               completed_event_ids: List[int],
+                               previous_session: Optional[Dict[str, Any]]) -> Dict[str, Optional[str]]:
+    """
+    把回合结束后的全部状态加入事务（共享状态只写合并后有修改的键，对话历史只追加本回合的新消息，
+    session 只写本回合改变的字段），返回写入后应放入回合缓存的值
+    """
+    values = {
+        **shared_values,
+        f"{COMPLETED_EVENTS_KEY_PREFIX}{character_id}": json.dumps(completed_event_ids),
+    }
+    for key, data in values.items():
+        if key == WORLD_STATE_KEY:
+            pipe.set(key, data)
+        else:
+            pipe.setex(key, 86400, data)
+    _queue_history_append(pipe, f"{CONVERSATION_KEY_PREFIX}{character_id}", new_messages)
+    session_key = f"{SESSION_KEY_PREFIX}{character_id}"
+    _queue_session_write(pipe, session_key, session_state, previous_session)
+    values[session_key] = _session_cache_value(session_state)
+    return values
+
+def _observe_turn_snapshot(character_id: str, map_id: int, map_state: Dict[str, Any], values: Dict[str, Optional[str]]):
+    """写回成功后更新回合缓存、上一回合的地图和地图连通图（使用合并后的地图状态）"""
+    for key, data in values.items():
+        _cache_put(key, data)
+    _remember_turn_map_id(character_id, map_id)
+    map_key = f"{MAP_STATE_KEY_PREFIX}{map_id}"
+    if map_key in values:
+        map_state = json.loads(values[map_key])
+    from map_graph import map_graph
+    map_graph.observe_map_state(map_id, map_state)
+
+def save_turn_snapshot(character_id: str, world_state: Dict[str, Any], map_id: int, map_state: Dict[str, Any],
+                       session_state: Dict[str, Any], new_messages: List[Dict[str, str]],
+                       completed_event_ids: List[int]):
+    """在一个 MULTI/EXEC 事务中写回回合结束后的全部状态，保证写回的原子性"""
+    redis_client = get_redis_client()
+    if not redis_client: return
+    previous_session = _session_baseline(redis_client, f"{SESSION_KEY_PREFIX}{character_id}")
+    patches = _shared_state_patches(world_state, map_id, map_state)
+    while True:
+        with redis_client.pipeline(transaction=True) as pipe:
+            try:
+                current = {}
+                if patches:
+                    pipe.watch(*patches)
+                    current = dict(zip(patches, pipe.mget(list(patches))))
+                    pipe.multi()
+                values = _queue_turn_snapshot_write(pipe, character_id, _merge_shared_state(patches, current, map_id),
+                                                    session_state, new_messages, completed_event_ids, previous_session)
+                pipe.execute()
+                break
+            except redis.WatchError:
+                logger.debug("共享状态 %s 在写回前被其他回合修改，重新合并", list(patches))
+    _observe_turn_snapshot(character_id, map_id, map_state, values)
 
 # --- 6. 核心逻辑函数 ---
 def get_pending_check_event_id(character_id: str) -> Optional[int]:
@@ -217,81 +741,406 @@ def save_pending_check_event_id(character_id: str, event_id: Optional[int]):
         del session["pending_check_event_id"]
     save_session_state(character_id, session)
 
-def apply_state_changes(player_character_id: str, state_changes: List[Dict[str, Any]]):
-    redis_client = get_redis_client()
-    if not redis_client or not state_changes: return
+STATE_CHANGE_ATTRIBUTE_FIELDS = { 10: "sanity", 11: "mp", 13: "hp" }
 
-    mapping = { 10: "sanity", 11: "mp", 13: "hp" }
-    
+def initial_session_from_sheet(sheet: Dict[str, Any], default_map_id: int = 1) -> Dict[str, Any]:
+    """根据角色卡生成初始 session_state"""
+    derived_attrs = sheet.get('derived_attributes', {})
+    return {
+        "hp": derived_attrs.get("hit_points", 10),
+        "sanity": derived_attrs.get("sanity", 50),
+        "mp": derived_attrs.get("magic_points", 10),
+        "current_map_id": sheet.get('info', {}).get('current_location_id', default_map_id),
+        "current_vehicle_id": sheet.get('info', {}).get('current_vehicle_id', None),
+    }
+
+def _state_change_targets(player_character_id: str, state_changes: List[Dict[str, Any]]) -> List[str]:
+    """按出现顺序返回状态变更涉及的角色ID（去重）"""
+    targets = []
     for change in state_changes:
         target_key = change.get("target")
         if not target_key: continue
+        target_id = player_character_id if target_key == "player" else target_key
+        if target_id not in targets:
+            targets.append(target_id)
+    return targets
+
+def _session_target_types(types: List[str], targets: List[str]):
+    """根据 TYPE 的结果区分：不存在的 session 和旧版本以JSON字符串保存的 session"""
+    uninitialized = [target_id for target_id, key_type in zip(targets, types) if key_type == "none"]
+    legacy = [target_id for target_id, key_type in zip(targets, types) if key_type == "string"]
+    return uninitialized, legacy
 
+def _initial_sessions(uninitialized: List[str], sheets: Dict[str, Dict[str, Any]]):
+    """返回 (新建的 session, 无法加载角色数据而跳过的角色)"""
+    new_sessions, skipped = {}, set()
+    for target_id in uninitialized:
+        if sheets.get(target_id):
+            new_sessions[target_id] = initial_session_from_sheet(sheets[target_id])
+        else:
+            logger.error("无法为 target '%s' 加载角色数据，跳过状态变更。", target_id)
+            skipped.add(target_id)
+    return new_sessions, skipped
+
+def _queue_state_changes(pipe, player_character_id: str, state_changes: List[Dict[str, Any]],
+                         new_sessions: Dict[str, Dict[str, Any]], legacy_sessions: Dict[str, Dict[str, Any]],
+                         skipped: set) -> List[tuple]:
+    """
+    把状态变更加入事务：属性增减用 HINCRBY，set_state 用 HSET，每个字段的修改都是原子的。
+    新建的 session 用 HSETNX 写入初始值，不会覆盖并发写入方已创建的字段；旧格式的 session 先整体转换为Hash。
+    最后读回被修改的 session 写入回合缓存。
+    返回与事务回复一一对应的 [(角色ID, 字段, 操作)]，操作为 None 的回复不需要处理。
+    """
+    ops = []
+    for target_id, session in legacy_sessions.items():
+        key = f"{SESSION_KEY_PREFIX}{target_id}"
+        _queue_session_replace(pipe, key, session)
+        ops.extend([(target_id, None, None)] * (3 if session else 1))
+    for target_id, session in new_sessions.items():
+        key = f"{SESSION_KEY_PREFIX}{target_id}"
+        for field, value in _encode_session(session).items():
+            pipe.hsetnx(key, field, value)
+            ops.append((target_id, field, None))
+
+    changed_targets = []
+    for change in state_changes:
+        target_key = change.get("target")
+        if not target_key: continue
         target_id = player_character_id if target_key == "player" else target_key
-        
-        session = get_session_state(target_id)
+        if target_id in skipped: continue
+        key = f"{SESSION_KEY_PREFIX}{target_id}"
+
+        field_name = STATE_CHANGE_ATTRIBUTE_FIELDS.get(change.get("attribute_id")) if "change" in change else None
+        if field_name:
+            delta = int(change["change"])
+            pipe.hincrby(key, field_name, delta)
+            ops.append((target_id, field_name, ("incr", delta)))
+
+        for field, value in (change.get("set_state") or {}).items():
+            pipe.hset(key, field, json.dumps(value, ensure_ascii=False))
+            ops.append((target_id, field, ("set", value)))
+
+        if target_id not in changed_targets:
+            changed_targets.append(target_id)
+
+    for target_id in set(changed_targets) | set(new_sessions):
+        key = f"{SESSION_KEY_PREFIX}{target_id}"
+        pipe.expire(key, 86400)
+        ops.append((target_id, None, None))
+        pipe.hgetall(key)
+        ops.append((target_id, None, ("session", None)))
+    return ops
 
-        if not session:
-            print(f"为目标 {target_id} 初始化 session_state...")
+def _collect_state_changes(ops: List[tuple], replies: List[Any]) -> Dict[str, Dict[str, Any]]:
+    """处理事务回复，返回 {角色ID: {被修改的字段: 新值}}"""
+    changed = {}
+    for (target_id, field, op), reply in zip(ops, replies):
+        if op is None: continue
+        kind, value = op
+        if isinstance(reply, Exception):
+            logger.warning("角色 %s 的状态 %s 更新失败: %s", target_id, field, reply)
+            continue
+        if kind == "session":
+            _cache_put(f"{SESSION_KEY_PREFIX}{target_id}", _session_cache_value(_decode_session(reply)))
+        elif kind == "incr":
+            changed.setdefault(target_id, {})[field] = int(reply)
+            logger.info("角色 %s 的 %s 变化 %+d，现为 %s", target_id, field, value, reply)
+        else:
+            changed.setdefault(target_id, {})[field] = value
+            logger.debug("角色 %s 的状态 %s 已设置为 %s", target_id, field, value)
+    return changed
+
+def apply_state_changes(player_character_id: str, state_changes: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    在一个 MULTI/EXEC 事务中应用状态变更，返回 {角色ID: {被修改的字段: 新值}}。
+    调用方手中的 session 副本可以据此合并，避免回合结束写回时覆盖这些修改。
+    """
+    redis_client = get_redis_client()
+    if not redis_client or not state_changes: return {}
+
+    targets = _state_change_targets(player_character_id, state_changes)
+    pipe = redis_client.pipeline(transaction=False)
+    for target_id in targets:
+        pipe.type(f"{SESSION_KEY_PREFIX}{target_id}")
+    uninitialized, legacy = _session_target_types(pipe.execute(), targets)
+
+    # 没有 session_state 的目标从角色卡初始化；Redis中也没有角色卡的从数据库批量读取
+    sheets = {}
+    if uninitialized:
+        logger.debug("为目标 %s 初始化 session_state...", uninitialized)
+        sheets = {target_id: get_character_sheet(target_id) for target_id in uninitialized}
+        missing_sheets = [target_id for target_id, sheet in sheets.items() if not sheet]
+        if missing_sheets:
             from databaseManager import db_manager
-            sheet = get_character_sheet(target_id)
-            if not sheet:
-                sheet = db_manager.get_character_data(target_id)
-                if not sheet:
-                    print(f"错误: 无法为 target '{target_id}' 加载角色数据，跳过状态变更。")
-                    continue
+            for target_id, sheet in db_manager.get_character_data_many(missing_sheets).items():
                 save_character_sheet(target_id, sheet)
+                sheets[target_id] = sheet
+    new_sessions, skipped = _initial_sessions(uninitialized, sheets)
+    legacy_sessions = {target_id: _decode(redis_client.get(f"{SESSION_KEY_PREFIX}{target_id}"), {}) for target_id in legacy}
 
-            derived_attrs = sheet.get('derived_attributes', {})
-            session = {
-                "hp": derived_attrs.get("hit_points", 10),
-                "sanity": derived_attrs.get("sanity", 50),
-                "mp": derived_attrs.get("magic_points", 10),
-                "current_map_id": sheet.get('info', {}).get('current_location_id', 1),
-                "current_vehicle_id": sheet.get('info', {}).get('current_vehicle_id', None),
-            }
-
-        if "attribute_id" in change and "change" in change:
-            attr_id = change["attribute_id"]
-            if attr_id in mapping:
-                field_name = mapping[attr_id]
-                current_value = int(session.get(field_name, 0))
-                new_value = current_value + int(change["change"])
-                session[field_name] = new_value
-                print(f"角色 {target_id} 的 {field_name} 从 {current_value} 变为 {new_value}")
-
-        if "set_state" in change:
-            for key, value in change["set_state"].items():
-                # 确保 None 值能正确保存
-                if value is None:
-                    session[key] = None
-                    print(f"角色 {target_id} 的状态 {key} 已设置为 None")
-                else:
-                    session[key] = value
-                    print(f"角色 {target_id} 的状态 {key} 已设置为 {value}")
-        
-        save_session_state(target_id, session)
+    pipe = redis_client.pipeline(transaction=True)
+    ops = _queue_state_changes(pipe, player_character_id, state_changes, new_sessions, legacy_sessions, skipped)
+    return _collect_state_changes(ops, pipe.execute(raise_on_error=False))
+
+def _accessibility_modifications(change: Dict[str, Any]) -> List[tuple]:
+    """解析 modify_location_accessible，返回 [(from_map, to_map, is_accessible), ...]"""
+    if "modify_location_accessible" not in change:
+        return []
+    modification = change["modify_location_accessible"]
+    if not isinstance(modification, list):
+        logger.warning("modify_location_accessible 格式错误，应为列表: %s", modification)
+        return []
+    modifications = []
+    for mod in modification:
+        if isinstance(mod, dict) and "from_map" in mod and "to_map" in mod and "action" in mod:
+            # action 为 "add" 或 "remove"
+            modifications.append((mod["from_map"], mod["to_map"], mod["action"] == "add"))
+    return modifications
 
 def apply_map_state_changes(map_state_changes: List[Dict[str, Any]]):
     """应用地图状态变更（包括地图可访问性）"""
     if not map_state_changes: return
     
     for change in map_state_changes:
-        if "modify_location_accessible" in change:
-            # 处理地图可访问性变更
-            modification = change["modify_location_accessible"]
-            if isinstance(modification, list):
-                for mod in modification:
-                    if isinstance(mod, dict) and "from_map" in mod and "to_map" in mod and "action" in mod:
-                        from_map = mod["from_map"]
-                        to_map = mod["to_map"]
-                        action = mod["action"]  # "add" 或 "remove"
-                        
-                        is_accessible = (action == "add")
-                        update_map_accessibility(from_map, to_map, is_accessible)
-                        print(f"事件影响：地图{from_map}到地图{to_map}的可访问性已{'增加' if is_accessible else '移除'}")
-            else:
-                print(f"modify_location_accessible 格式错误，应为列表: {modification}")
+        # 处理地图可访问性变更
+        for from_map, to_map, is_accessible in _accessibility_modifications(change):
+            update_map_accessibility(from_map, to_map, is_accessible)
+            logger.info("事件影响：地图%s到地图%s的可访问性已%s", from_map, to_map, '增加' if is_accessible else '移除')
         
         # 可以添加更多地图状态变更的处理逻辑
-        print(f"应用地图状态变更: {change}")
+        logger.debug("应用地图状态变更: %s", change)
+
+
+# --- 7. 异步版本（LangGraph节点使用，共享连接池） ---
+async def aget_world_state() -> Dict[str, Any]:
+    redis_client = get_async_redis_client()
+    if not redis_client: return {}
+    return _decode(await _acached_get(redis_client, WORLD_STATE_KEY), {})
+
+async def asave_world_state(state: Dict[str, Any]):
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+    data = json.dumps(state, ensure_ascii=False)
+    await redis_client.set(WORLD_STATE_KEY, data)
+    _cache_put(WORLD_STATE_KEY, data)
+
+async def aget_map_state(map_id: int) -> Dict[str, Any]:
+    redis_client = get_async_redis_client()
+    if not redis_client: return _default_map_state(map_id)
+    return _decode(await _acached_get(redis_client, f"{MAP_STATE_KEY_PREFIX}{map_id}"), None) or _default_map_state(map_id)
+
+async def asave_map_state(map_id: int, map_data: Dict[str, Any]):
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+    key = f"{MAP_STATE_KEY_PREFIX}{map_id}"
+    data = json.dumps(map_data, ensure_ascii=False)
+    await redis_client.setex(key, 86400, data)
+    _cache_put(key, data)
+
+async def aget_character_sheet(character_id: str) -> Dict[str, Any]:
+    redis_client = get_async_redis_client()
+    if not redis_client: return {}
+    return _decode(await _acached_get(redis_client, f"{SHEET_KEY_PREFIX}{character_id}"), {})
+
+async def aget_character_sheets(character_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """用一次 MGET 读取多个角色卡；Redis中不存在的角色对应空字典"""
+    redis_client = get_async_redis_client()
+    if not redis_client or not character_ids: return {character_id: {} for character_id in character_ids}
+    values = await _acached_mget(redis_client, [f"{SHEET_KEY_PREFIX}{character_id}" for character_id in character_ids])
+    return {character_id: _decode(data, {}) for character_id, data in zip(character_ids, values)}
+
+async def asave_character_sheet(character_id: str, sheet_data: Dict[str, Any]):
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+    key = f"{SHEET_KEY_PREFIX}{character_id}"
+    data = json.dumps(sheet_data, ensure_ascii=False)
+    await redis_client.setex(key, 86400, data)
+    _cache_put(key, data)
+
+async def aget_session_state(character_id: str) -> Dict[str, Any]:
+    redis_client = get_async_redis_client()
+    if not redis_client: return {}
+    key = f"{SESSION_KEY_PREFIX}{character_id}"
+    hit, data = _cache_lookup(key)
+    if hit: return _decode(data, {})
+    try:
+        session = _decode_session(await redis_client.hgetall(key))
+    except redis.ResponseError:
+        session = await _amigrate_legacy_session(redis_client, key)
+    _cache_miss(key, _session_cache_value(session))
+    return session
+
+async def asave_session_state(character_id: str, session_data: Dict[str, Any]):
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+    key = f"{SESSION_KEY_PREFIX}{character_id}"
+    previous = await _asession_baseline(redis_client, key)
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_session_write(pipe, key, session_data, previous)
+    await pipe.execute()
+    _cache_put(key, _session_cache_value(session_data))
+
+async def _amigrate_legacy_history(redis_client, key: str, limit: Optional[int]) -> List[Dict[str, str]]:
+    history = _decode(await redis_client.get(key), [])
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_history_replace(pipe, key, history)
+    await pipe.execute()
+    logger.info("对话历史 %s 已转换为列表格式，共 %d 条", key, len(history))
+    return _history_tail(history, limit)
+
+async def aget_conversation_history(character_id: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
+    redis_client = get_async_redis_client()
+    if not redis_client: return []
+    key = f"{CONVERSATION_KEY_PREFIX}{character_id}"
+    try:
+        return _decode_history(await redis_client.lrange(key, *_history_range(limit)))
+    except redis.ResponseError:
+        return await _amigrate_legacy_history(redis_client, key, limit)
+
+async def aappend_conversation_messages(character_id: str, messages: List[Dict[str, str]]):
+    redis_client = get_async_redis_client()
+    if not redis_client or not messages: return
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_history_append(pipe, f"{CONVERSATION_KEY_PREFIX}{character_id}", messages)
+    await pipe.execute()
+
+async def asave_conversation_history(character_id: str, history: List[Dict[str, str]]):
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+    pipe = redis_client.pipeline(transaction=True)
+    _queue_history_replace(pipe, f"{CONVERSATION_KEY_PREFIX}{character_id}", history)
+    await pipe.execute()
+
+async def aget_completed_event_ids(character_id: str) -> List[int]:
+    redis_client = get_async_redis_client()
+    if not redis_client: return []
+    return _decode(await _acached_get(redis_client, f"{COMPLETED_EVENTS_KEY_PREFIX}{character_id}"), [])
+
+async def asave_completed_event_ids(character_id: str, event_ids: List[int]):
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+    key = f"{COMPLETED_EVENTS_KEY_PREFIX}{character_id}"
+    data = json.dumps(event_ids)
+    await redis_client.setex(key, 86400, data)
+    _cache_put(key, data)
+
+async def aload_turn_snapshot(character_id: str) -> Dict[str, Any]:
+    """load_turn_snapshot 的异步版本"""
+    redis_client = get_async_redis_client()
+    if not redis_client:
+        return _empty_turn_snapshot()
+
+    guessed_map_id = _guess_turn_map_id(character_id)
+    keys = _turn_snapshot_keys(character_id, guessed_map_id)
+    session_key = f"{SESSION_KEY_PREFIX}{character_id}"
+    history_key = f"{CONVERSATION_KEY_PREFIX}{character_id}"
+    results, missing = _split_cached(keys)
+    session_hit, session_data = _cache_lookup(session_key)
+    pipe = redis_client.pipeline(transaction=False)
+    _queue_turn_snapshot_read(pipe, missing, None if session_hit else session_key, history_key)
+    replies = await pipe.execute(raise_on_error=False)
+    if missing:
+        _store_fetched(results, missing, replies.pop(0))
+    if not session_hit:
+        session = _session_from_reply(replies.pop(0))
+        if session is None:
+            session = await _amigrate_legacy_session(redis_client, session_key)
+        session_data = _session_cache_value(session)
+        _cache_miss(session_key, session_data)
+    history_reply = replies.pop(0)
+    if isinstance(history_reply, Exception):
+        history = await _amigrate_legacy_history(redis_client, history_key, CONVERSATION_HISTORY_WINDOW)
+    else:
+        history = _decode_history(history_reply)
+
+    session_state = _decode(session_data, {})
+    current_map_id = session_state.get('current_map_id', 1)
+    map_data = results[keys[2]]
+    if current_map_id != guessed_map_id:
+        map_data = await _acached_get(redis_client, f"{MAP_STATE_KEY_PREFIX}{current_map_id}")
+    _remember_turn_map_id(character_id, current_map_id)
+
+    return _build_turn_snapshot(results, keys, session_state, current_map_id, map_data, history)
+
+async def asave_turn_snapshot(character_id: str, world_state: Dict[str, Any], map_id: int, map_state: Dict[str, Any],
+                              session_state: Dict[str, Any], new_messages: List[Dict[str, str]],
+                              completed_event_ids: List[int]):
+    """save_turn_snapshot 的异步版本"""
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+    previous_session = await _asession_baseline(redis_client, f"{SESSION_KEY_PREFIX}{character_id}")
+    patches = _shared_state_patches(world_state, map_id, map_state)
+    while True:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            try:
+                current = {}
+                if patches:
+                    await pipe.watch(*patches)
+                    current = dict(zip(patches, await pipe.mget(list(patches))))
+                    pipe.multi()
+                values = _queue_turn_snapshot_write(pipe, character_id, _merge_shared_state(patches, current, map_id),
+                                                    session_state, new_messages, completed_event_ids, previous_session)
+                await pipe.execute()
+                break
+            except redis.WatchError:
+                logger.debug("共享状态 %s 在写回前被其他回合修改，重新合并", list(patches))
+    _observe_turn_snapshot(character_id, map_id, map_state, values)
+
+async def aapply_state_changes(player_character_id: str, state_changes: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """apply_state_changes 的异步版本"""
+    redis_client = get_async_redis_client()
+    if not redis_client or not state_changes: return {}
+
+    targets = _state_change_targets(player_character_id, state_changes)
+    pipe = redis_client.pipeline(transaction=False)
+    for target_id in targets:
+        pipe.type(f"{SESSION_KEY_PREFIX}{target_id}")
+    uninitialized, legacy = _session_target_types(await pipe.execute(), targets)
+
+    sheets = {}
+    if uninitialized:
+        logger.debug("为目标 %s 初始化 session_state...", uninitialized)
+        sheets = await aget_character_sheets(uninitialized)
+        missing_sheets = [target_id for target_id, sheet in sheets.items() if not sheet]
+        if missing_sheets:
+            from databaseManager import db_manager
+            loaded = await asyncio.to_thread(db_manager.get_character_data_many, missing_sheets)
+            for target_id, sheet in loaded.items():
+                await asave_character_sheet(target_id, sheet)
+                sheets[target_id] = sheet
+    new_sessions, skipped = _initial_sessions(uninitialized, sheets)
+    legacy_sessions = {target_id: _decode(await redis_client.get(f"{SESSION_KEY_PREFIX}{target_id}"), {}) for target_id in legacy}
+
+    pipe = redis_client.pipeline(transaction=True)
+    ops = _queue_state_changes(pipe, player_character_id, state_changes, new_sessions, legacy_sessions, skipped)
+    return _collect_state_changes(ops, await pipe.execute(raise_on_error=False))
+
+async def aupdate_map_accessibility(map_id: int, target_map_id: int, is_accessible: bool):
+    """update_map_accessibility 的异步版本"""
+    from map_graph import map_graph
+    redis_client = get_async_redis_client()
+    if not redis_client: return
+
+    map_state = await aget_map_state(map_id)
+    current_accessible = await map_graph.aneighbors(map_id)
+
+    if is_accessible and target_map_id not in current_accessible:
+        current_accessible.append(target_map_id)
+    elif not is_accessible and target_map_id in current_accessible:
+        current_accessible.remove(target_map_id)
+
+    map_state["accessible_maps"] = current_accessible
+    await asave_map_state(map_id, map_state)
+    map_graph.invalidate()
+
+    logger.info("地图%s到地图%s的可访问性已更新为: %s", map_id, target_map_id, is_accessible)
+
+async def aapply_map_state_changes(map_state_changes: List[Dict[str, Any]]):
+    """apply_map_state_changes 的异步版本"""
+    if not map_state_changes: return
+
+    for change in map_state_changes:
+        for from_map, to_map, is_accessible in _accessibility_modifications(change):
+            await aupdate_map_accessibility(from_map, to_map, is_accessible)
+            logger.info("事件影响：地图%s到地图%s的可访问性已%s", from_map, to_map, '增加' if is_accessible else '移除')
+        logger.debug("应用地图状态变更: %s", change)
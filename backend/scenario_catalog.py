@@ -0,0 +1,132 @@
+# scenario_catalog.py
+"""
+剧本静态内容目录：启动时从 database.db 一次性读取地图、可交互物品、事件和NPC静态资料，
+按ID和地图建立索引，回合中的查找都是字典命中，不再访问SQLite。
+这些数据在游戏过程中只读；剧本内容修改后调用 reload() 重新加载。
+返回的行数据由所有调用方共享，请勿修改。
+"""
+
+import json
+import threading
+from typing import Dict, Any, List, Optional
+
+from databaseManager import db_manager
+from log_manager import get_logger
+
+logger = get_logger("scenario_catalog")
+
+# NPC资料中属于静态设定的字段；状态、目标、位置等会在游戏中变化，不放入目录
+NPC_PROFILE_FIELDS = (
+    "id", "name", "gender", "residence", "birthplace", "profession_id", "description",
+    "relationships", "initial_knowledge", "roleplay_guidelines",
+)
+
+
+def _object_key(object_id: Any) -> str:
+    """map_state 中物品ID是字符串，数据库中是整数，统一按字符串索引"""
+    return str(object_id)
+
+
+class ScenarioCatalog:
+    def __init__(self):
+        self._maps: Dict[int, Dict[str, Any]] = {}
+        self._map_links: Dict[int, List[int]] = {}
+        self._objects: Dict[str, Dict[str, Any]] = {}
+        self._objects_by_map: Dict[Any, List[Dict[str, Any]]] = {}
+        self._events: List[Dict[str, Any]] = []
+        self._events_by_id: Dict[int, Dict[str, Any]] = {}
+        self._npc_profiles: Dict[str, Dict[str, Any]] = {}
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """从数据库读取全部静态内容；新索引构建完成后一次性替换，读取方不会看到半加载的状态"""
+        with self._load_lock:
+            maps = db_manager.execute_query("SELECT * FROM maps ORDER BY id") or []
+            objects = db_manager.execute_query("SELECT * FROM interactable_objects ORDER BY object_id") or []
+            events = db_manager.execute_query("SELECT * FROM events ORDER BY event_id") or []
+            npcs = db_manager.execute_query(
+                f"SELECT {', '.join(NPC_PROFILE_FIELDS)} FROM characters WHERE if_npc = 1 ORDER BY id"
+            ) or []
+
+            map_links = {}
+            for map_row in maps:
+                try:
+                    map_links[map_row['id']] = json.loads(map_row.get('accessible_locations') or "[]")
+                except (json.JSONDecodeError, TypeError):
+                    logger.warning("地图%s的可访问性数据格式错误: %s", map_row['id'], map_row.get('accessible_locations'))
+                    map_links[map_row['id']] = []
+
+            objects_by_map = {}
+            for obj in objects:
+                objects_by_map.setdefault(obj.get('map_id'), []).append(obj)
+
+            self._maps = {map_row['id']: map_row for map_row in maps}
+            self._map_links = map_links
+            self._objects = {_object_key(obj['object_id']): obj for obj in objects}
+            self._objects_by_map = objects_by_map
+            self._events = events
+            self._events_by_id = {event['event_id']: event for event in events}
+            self._npc_profiles = {npc['id']: npc for npc in npcs}
+            self._loaded = True
+
+        logger.info("剧本目录已加载: 地图 %s, 物品 %s, 事件 %s, NPC %s",
+                    len(maps), len(objects), len(events), len(npcs))
+
+    def reload(self):
+        """剧本内容变更后重新加载"""
+        self.load()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    # --- 地图 ---
+    def get_map(self, map_id: int) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        return self._maps.get(map_id)
+
+    def maps(self) -> List[Dict[str, Any]]:
+        self._ensure_loaded()
+        return list(self._maps.values())
+
+    def static_accessible_maps(self, map_id: int) -> List[int]:
+        """剧本中设定的初始可达地图（运行时的变化保存在Redis的map_state中）"""
+        self._ensure_loaded()
+        return list(self._map_links.get(map_id, []))
+
+    # --- 可交互物品 ---
+    def get_object(self, object_id: Any) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        return self._objects.get(_object_key(object_id))
+
+    def get_object_name(self, object_id: Any) -> str:
+        obj = self.get_object(object_id)
+        return obj['object_name'] if obj else f"物品{object_id}"
+
+    def objects_on_map(self, map_id: int) -> List[Dict[str, Any]]:
+        self._ensure_loaded()
+        return list(self._objects_by_map.get(map_id, []))
+
+    # --- 事件 ---
+    def get_event(self, event_id: int) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        return self._events_by_id.get(event_id)
+
+    def events(self) -> List[Dict[str, Any]]:
+        """全部事件，按事件ID排序"""
+        self._ensure_loaded()
+        return list(self._events)
+
+    # --- NPC静态资料 ---
+    def get_npc_profile(self, npc_id: str) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        return self._npc_profiles.get(npc_id)
+
+    def npc_profiles(self) -> List[Dict[str, Any]]:
+        self._ensure_loaded()
+        return list(self._npc_profiles.values())
+
+
+# 创建全局实例
+scenario_catalog = ScenarioCatalog()
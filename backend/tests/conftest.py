@@ -0,0 +1,21 @@
+# conftest.py
+"""测试在离线替身上运行：先导入 benchmark.offline 设置离线环境变量，再导入后端模块"""
+
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark.offline  # noqa: E402,F401
+from benchmark.offline import use_database_copy  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def database_copy():
+    """每个测试使用 database.db 的副本：剧本目录等按需读取数据库时不会修改仓库中的文件（如WAL日志模式）"""
+    work_dir = use_database_copy()
+    yield
+    shutil.rmtree(work_dir, ignore_errors=True)
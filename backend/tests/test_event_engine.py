@@ -0,0 +1,115 @@
+# test_event_engine.py
+"""
+事件触发引擎（event_engine）：按 (intent, target) 建立的索引与通配键、前置事件、唯一事件和NPC状态条件。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import json
+
+from benchmark.offline import install_fake_redis
+from event_engine import ANY, EventEngine
+
+
+def _event(event_id: int, player_action=None, map_id: int = 1, if_unique: bool = False, pre_event_ids=None,
+           agent_state=None):
+    preconditions = {}
+    if player_action is not None:
+        preconditions["player_action"] = player_action
+    if agent_state is not None:
+        preconditions["agent_state"] = agent_state
+    return {
+        "event_id": event_id, "map_id": map_id, "if_unique": int(if_unique), "event_info": f"事件{event_id}",
+        "preconditions": json.dumps(preconditions, ensure_ascii=False) if preconditions else None,
+        "pre_event_ids": json.dumps(pre_event_ids) if pre_event_ids is not None else None,
+    }
+
+
+EVENTS = [
+    _event(1, {"intent": "inspect", "target": "挂坠"}),
+    _event(2, {"intent": "inspect"}),
+    _event(3, {"target": "挂坠"}),
+    _event(4),
+    _event(5, {"intent": "talk", "target": "amelia_weber"}),
+    _event(6, {"intent": "inspect", "target": "挂坠"}, map_id=2),
+    _event(7, {"intent": "inspect", "target": ["挂坠", "金币"]}),
+]
+
+
+def _engine(events=EVENTS) -> EventEngine:
+    engine = EventEngine()
+    engine.load(events)
+    return engine
+
+
+def _event_ids(events) -> list:
+    return [event["event_id"] for event in events]
+
+
+def _state(intent=None, target=None, completed=None, session=None):
+    return {"player_action": {"intent": intent, "target": target}, "completed_events": completed or [],
+            "session_state": session or {}}
+
+
+def test_index_keys_and_wildcards():
+    engine = _engine()
+    keys = {event_id: compiled.index_key for event_id, compiled in engine._events_by_id.items()}
+
+    assert keys[1] == ("inspect", "挂坠")
+    assert keys[2] == ("inspect", ANY)
+    assert keys[3] == (ANY, "挂坠")
+    assert keys[4] == (ANY, ANY)
+    # 不可哈希的期望值退化为通配，由谓词精确判断
+    assert keys[7] == ("inspect", ANY)
+
+
+def test_lookup_combines_exact_and_wildcard_keys_in_event_order():
+    engine = _engine()
+
+    assert _event_ids(engine.candidate_events(1, _state("inspect", "挂坠"))) == [1, 2, 3, 4]
+    assert _event_ids(engine.candidate_events(1, _state("inspect", "吧台"))) == [2, 4]
+    assert _event_ids(engine.candidate_events(1, _state("take", "挂坠"))) == [3, 4]
+    assert _event_ids(engine.candidate_events(1, _state("talk", "amelia_weber"))) == [4, 5]
+    assert _event_ids(engine.candidate_events(1, {"completed_events": []})) == [4]
+    assert _event_ids(engine.candidate_events(2, _state("inspect", "挂坠"))) == [6]
+    assert engine.candidate_events(3, _state("inspect", "挂坠")) == []
+
+
+def test_unhashable_requirement_is_matched_exactly():
+    engine = _engine()
+
+    assert _event_ids(engine.candidate_events(1, _state("inspect", ["挂坠", "金币"]))) == [2, 4, 7]
+
+
+def test_completed_unique_events_and_pre_events():
+    engine = _engine([
+        _event(1, {"intent": "inspect"}, if_unique=True),
+        _event(2, {"intent": "inspect"}, pre_event_ids=[1]),
+        # 前置事件格式错误的事件永远不会被触发
+        dict(_event(3, {"intent": "inspect"}), pre_event_ids="[1,"),
+    ])
+
+    assert _event_ids(engine.candidate_events(1, _state("inspect", "挂坠"))) == [1]
+    assert _event_ids(engine.candidate_events(1, _state("inspect", "挂坠", completed=[1]))) == [2]
+
+
+async def _agent_state_candidates(engine: EventEngine):
+    from redis_manager import asave_session_state
+    install_fake_redis()
+    await asave_session_state("amelia_weber", {"status": "警觉", "current_map_id": 1})
+    return engine.candidate_events(1, _state("talk", "amelia_weber")), \
+        await engine.acandidate_events(1, _state("talk", "amelia_weber"))
+
+
+def test_agent_state_preconditions_sync_and_async():
+    engine = _engine([
+        _event(1, {"intent": "talk"}, agent_state={"agent_id": "amelia_weber", "status": "警觉"}),
+        _event(2, {"intent": "talk"}, agent_state={"agent_id": "amelia_weber", "status": "平静"}),
+        _event(3, {"intent": "talk"}, agent_state={"agent_id": "player", "current_location_id": 1}),
+    ])
+    sync_events, async_events = asyncio.run(_agent_state_candidates(engine))
+
+    assert _event_ids(sync_events) == [1]
+    assert _event_ids(async_events) == [1]
+    player_on_map = _state("talk", "amelia_weber", session={"current_map_id": 1})
+    assert _event_ids(engine.candidate_events(1, dict(player_on_map, agent_states={}))) == [3]
@@ -0,0 +1,121 @@
+# test_llm_cache.py
+"""
+LLM响应缓存（llm_cache）：键的生成、命中/未命中、LRU淘汰和失效，在 fakeredis 上运行。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+from langchain_core.messages import HumanMessage, SystemMessage
+
+import llm_cache as llm_cache_module
+from benchmark.offline import DeterministicChatModel, install_fake_redis
+from llm_cache import CACHE_KEY_PREFIX, LRU_KEY_PREFIX, LLMResponseCache, cached_ainvoke, is_json
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """fakeredis 上的独立缓存实例；访问时间单调递增，LRU顺序不受时钟精度影响"""
+    install_fake_redis()
+    cache = LLMResponseCache()
+    cache.enabled = True
+    clock = itertools.count(1)
+    monkeypatch.setattr(llm_cache_module, "time", SimpleNamespace(time=lambda: next(clock)))
+    monkeypatch.setattr(llm_cache_module, "llm_cache", cache)
+    return cache
+
+
+def _messages(user_text: str, system_text: str = "你是一个COC跑团的指令解析器。"):
+    return [SystemMessage(content=system_text), HumanMessage(content=user_text)]
+
+
+def test_key_ignores_whitespace_but_not_content_or_parameters():
+    cache = LLMResponseCache()
+    model = SimpleNamespace(model_name="gpt-4o-mini", temperature=0)
+    key = cache.make_key("intent_parse", model, _messages("检查挂坠"))
+
+    assert key.startswith(f"{CACHE_KEY_PREFIX}intent_parse:")
+    assert cache.make_key("intent_parse", model, _messages("  检查挂坠\n", "  你是一个COC跑团的指令解析器。\n    ")) == key
+    assert cache.make_key("intent_parse", model, _messages("检查吧台")) != key
+    assert cache.make_key("npc_filter", model, _messages("检查挂坠")) != key
+    for changed in (SimpleNamespace(model_name="gpt-4o-mini", temperature=0.7), SimpleNamespace(model_name="gpt-4o", temperature=0)):
+        assert cache.make_key("intent_parse", changed, _messages("检查挂坠")) != key
+
+
+def test_cached_ainvoke_hits_after_first_call(cache):
+    model = DeterministicChatModel(responses={"intent_parse": {"intent": "inspect", "target": "挂坠"}})
+
+    async def run():
+        return [await cached_ainvoke("intent_parse", model, _messages("检查挂坠")) for _ in range(3)]
+
+    replies = asyncio.run(run())
+
+    assert len(set(replies)) == 1
+    assert model.call_counts["intent_parse"] == 1
+    assert cache.get_stats()["intent_parse"] == {"hits": 2, "misses": 1, "stores": 1, "evictions": 0, "hit_rate": 0.6667}
+
+
+def test_uncacheable_reply_is_not_stored(cache):
+    model = DeterministicChatModel(responses={"intent_parse": "不是JSON"})
+
+    async def run():
+        for _ in range(2):
+            await cached_ainvoke("intent_parse", model, _messages("检查挂坠"), is_cacheable=is_json)
+
+    asyncio.run(run())
+
+    assert model.call_counts["intent_parse"] == 2
+    assert cache.get_stats()["intent_parse"]["stores"] == 0
+
+
+def test_disabled_cache_always_calls_the_model(cache):
+    cache.enabled = False
+    model = DeterministicChatModel()
+
+    async def run():
+        for _ in range(2):
+            await cached_ainvoke("intent_parse", model, _messages("检查挂坠"))
+
+    asyncio.run(run())
+
+    assert model.call_counts["intent_parse"] == 2
+    assert cache.get_stats() == {}
+
+
+def test_lru_evicts_least_recently_used(cache):
+    from redis_manager import get_redis_client
+    cache.max_entries = 2
+    keys = [f"{CACHE_KEY_PREFIX}ns:{name}" for name in ("a", "b", "c")]
+
+    async def run():
+        await cache.aset("ns", keys[0], "A")
+        await cache.aset("ns", keys[1], "B")
+        # 访问 a 之后，最久未使用的是 b
+        assert await cache.aget("ns", keys[0]) == "A"
+        await cache.aset("ns", keys[2], "C")
+        return [await cache.aget("ns", key) for key in keys]
+
+    assert asyncio.run(run()) == ["A", None, "C"]
+    assert get_redis_client().zrange(f"{LRU_KEY_PREFIX}ns", 0, -1) == [keys[0], keys[2]]
+    assert cache.get_stats()["ns"]["evictions"] == 1
+
+
+def test_invalidate_one_namespace_or_all(cache):
+    from redis_manager import get_redis_client
+    redis_client = get_redis_client()
+
+    async def fill():
+        for namespace in ("intent_parse", "npc_filter"):
+            await cache.aset(namespace, f"{CACHE_KEY_PREFIX}{namespace}:x", "{}")
+
+    asyncio.run(fill())
+    cache.invalidate("intent_parse")
+    assert redis_client.exists(f"{CACHE_KEY_PREFIX}intent_parse:x", f"{LRU_KEY_PREFIX}intent_parse") == 0
+    assert redis_client.exists(f"{CACHE_KEY_PREFIX}npc_filter:x") == 1
+
+    cache.invalidate()
+    assert redis_client.keys(f"{CACHE_KEY_PREFIX}*") == []
+    assert redis_client.keys(f"{LRU_KEY_PREFIX}*") == []
@@ -0,0 +1,60 @@
+# test_map_graph.py
+"""
+地图连通图服务（map_graph）的缓存失效，在 fakeredis 上运行。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import json
+
+from benchmark.offline import install_fake_redis
+from map_graph import MapGraph
+
+
+def _set_exits(redis_client, map_id: int, accessible_maps: list):
+    redis_client.set(f"map_state:{map_id}", json.dumps({"npcs": [], "objects": {}, "accessible_maps": accessible_maps}))
+
+
+async def _rebuild_invalidated_midway():
+    from redis_manager import get_async_redis_client, get_redis_client
+    install_fake_redis()
+    redis_client, async_client = get_redis_client(), get_async_redis_client()
+    _set_exits(redis_client, 1, [2, 3])
+    graph = MapGraph()
+    mget = async_client.mget
+
+    async def mget_then_modify(*args, **kwargs):
+        # 读取完成后、快照保存之前，另一个请求修改了出口并使连通图失效
+        values = await mget(*args, **kwargs)
+        _set_exits(redis_client, 1, [2])
+        graph.invalidate()
+        return values
+
+    async_client.mget = mget_then_modify
+    during_rebuild = await graph.aneighbors(1)
+    cached_after = graph._snapshot
+    async_client.mget = mget
+    return during_rebuild, cached_after, await graph.aneighbors(1)
+
+
+def test_rebuild_started_before_invalidate_is_not_cached():
+    during_rebuild, cached_after, reloaded = asyncio.run(_rebuild_invalidated_midway())
+
+    assert during_rebuild == [2, 3]
+    assert cached_after is None
+    assert reloaded == [2]
+
+
+def test_observe_map_state_invalidates_changed_exits():
+    from redis_manager import get_redis_client
+    install_fake_redis()
+    _set_exits(get_redis_client(), 1, [2, 3])
+    graph = MapGraph()
+    assert graph.neighbors(1) == [2, 3]
+
+    graph.observe_map_state(1, {"accessible_maps": [2, 3]})
+    assert graph._snapshot is not None
+    _set_exits(get_redis_client(), 1, [3])
+    graph.observe_map_state(1, {"accessible_maps": [3]})
+    assert graph._snapshot is None
+    assert graph.neighbors(1) == [3]
@@ -0,0 +1,219 @@
+# test_memory_compression.py
+"""
+记忆压缩后台队列的失败路径：LLM失败时的重试与回退、任务失败时的退避重新入队与放弃，以及同一NPC的去重。
+在 fakeredis 和内存中的ChromaDB集合上运行，用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import json
+
+from benchmark.offline import (
+    DeterministicChatModel, install_fake_llm, install_fake_redis, install_local_memory_store
+)
+from memory_compression import MemoryCompressionWorker
+from memory_manager import COMPRESSION_BATCH_SIZE, COMPRESSION_THRESHOLD
+
+NPC_ID = "amelia_weber"
+RETRY_DELAY = 0.01
+MAX_RETRIES = 2
+# 测试自身的等待不经过下面记录等待时间的替身
+_sleep = asyncio.sleep
+
+
+class FailingChatModel(DeterministicChatModel):
+    """前 failures 次记忆压缩调用抛出异常"""
+    failures: int = 0
+    compress_attempts: int = 0
+
+    def _result(self, operation, messages):
+        if operation == "memory_compress":
+            self.compress_attempts += 1
+            if self.compress_attempts <= self.failures:
+                raise RuntimeError("模型服务不可用")
+        return super()._result(operation, messages)
+
+
+def _setup(model: DeterministicChatModel, npc_ids=(NPC_ID,)):
+    """返回填满短期记忆（达到压缩阈值）的 memory_manager"""
+    from memory_manager import memory_manager
+    install_fake_redis()
+    install_local_memory_store()
+    install_fake_llm(model)
+    # 内存中的ChromaDB在进程内共享，清掉之前测试写入的长期记忆
+    stored_ids = memory_manager.npc_memories.get()["ids"]
+    if stored_ids:
+        memory_manager.npc_memories.delete(ids=stored_ids)
+    for npc_id in npc_ids:
+        for i in range(COMPRESSION_THRESHOLD):
+            memory_manager.redis_client.lpush(f"short_term_memory:{npc_id}", json.dumps({"content": f"记忆{i}"}))
+    return memory_manager
+
+
+def _worker() -> MemoryCompressionWorker:
+    worker = MemoryCompressionWorker()
+    worker.retry_delay = RETRY_DELAY
+    worker.max_retries = MAX_RETRIES
+    return worker
+
+
+def _record_sleeps(monkeypatch) -> list:
+    """记录 asyncio.sleep 的等待时间（不实际等待）"""
+    delays = []
+
+    async def fake_sleep(delay, *args, **kwargs):
+        # 替身模型的延迟为 0
+        if delay:
+            delays.append(delay)
+        await _sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    return delays
+
+
+def _record_call_later(monkeypatch, worker: MemoryCompressionWorker) -> list:
+    """记录重新入队的等待时间（不实际等待）"""
+    delays = []
+    call_later = worker._loop.call_later
+
+    def fake_call_later(delay, callback, *args, **kwargs):
+        if callback == worker._retry:
+            delays.append(delay)
+            delay = 0
+        return call_later(delay, callback, *args, **kwargs)
+
+    monkeypatch.setattr(worker._loop, "call_later", fake_call_later)
+    return delays
+
+
+async def _drain(worker: MemoryCompressionWorker):
+    """等待队列清空且没有等待中的重试"""
+    while worker._queue.qsize() or worker._queue._unfinished_tasks or worker._retry_handles or worker._pending:
+        await _sleep(0.001)
+
+
+def _long_term_documents(manager):
+    return manager.npc_memories.get(where={"character_id": NPC_ID})["documents"]
+
+
+def test_llm_failures_retry_with_backoff_then_fall_back(monkeypatch):
+    model = FailingChatModel(failures=MAX_RETRIES + 5)
+    manager = _setup(model)
+    worker = _worker()
+    delays = _record_sleeps(monkeypatch)
+
+    async def run():
+        await worker.start()
+        assert worker.submit(manager, NPC_ID)
+        await _drain(worker)
+        await worker.stop()
+
+    asyncio.run(run())
+
+    assert model.compress_attempts == MAX_RETRIES + 1
+    assert delays == [RETRY_DELAY * 2 ** attempt for attempt in range(MAX_RETRIES)]
+    documents = _long_term_documents(manager)
+    assert len(documents) == 1 and documents[0].startswith(f"NPC {NPC_ID} 的长期记忆摘要")
+    assert manager.redis_client.llen(f"short_term_memory:{NPC_ID}") == COMPRESSION_THRESHOLD - COMPRESSION_BATCH_SIZE
+
+
+def test_llm_recovers_within_retries(monkeypatch):
+    model = FailingChatModel(failures=MAX_RETRIES)
+    manager = _setup(model)
+    worker = _worker()
+    delays = _record_sleeps(monkeypatch)
+
+    async def run():
+        await worker.start()
+        worker.submit(manager, NPC_ID)
+        await _drain(worker)
+        await worker.stop()
+
+    asyncio.run(run())
+
+    assert model.compress_attempts == MAX_RETRIES + 1
+    assert len(delays) == MAX_RETRIES
+    assert _long_term_documents(manager) == ["离线基准生成的记忆摘要。"]
+
+
+def test_failing_job_is_requeued_with_backoff_then_dropped(monkeypatch):
+    manager = _setup(DeterministicChatModel())
+    worker = _worker()
+    runs = []
+
+    def failing_store(character_id, *args):
+        runs.append(character_id)
+        raise RuntimeError("ChromaDB写入失败")
+
+    monkeypatch.setattr(manager, "store_compressed_memory", failing_store)
+
+    async def run():
+        await worker.start()
+        delays = _record_call_later(monkeypatch, worker)
+        worker.submit(manager, NPC_ID)
+        await _drain(worker)
+        stats = worker.stats()
+        await worker.stop()
+        return delays, stats
+
+    delays, stats = asyncio.run(run())
+
+    assert runs == [NPC_ID] * (MAX_RETRIES + 1)
+    assert delays == [RETRY_DELAY * 2 ** failures for failures in range(1, MAX_RETRIES + 1)]
+    assert stats["pending_npcs"] == 0 and stats["retrying_npcs"] == 0
+    assert worker._failures == {}
+    # 放弃后短期记忆保持原样，等下次提交再压缩
+    assert manager.redis_client.llen(f"short_term_memory:{NPC_ID}") == COMPRESSION_THRESHOLD
+
+
+def test_pending_npc_is_submitted_once():
+    model = DeterministicChatModel()
+    other_npc = "sam_kelhan"
+    manager = _setup(model, (NPC_ID, other_npc))
+    worker = _worker()
+
+    async def run():
+        await worker.start()
+        for _ in range(3):
+            worker.submit(manager, NPC_ID)
+        worker.submit(manager, other_npc)
+        queued = worker.stats()
+        await _drain(worker)
+        await worker.stop()
+        return queued
+
+    queued = asyncio.run(run())
+
+    assert queued["queued"] == 2 and queued["pending_npcs"] == 2
+    assert model.call_counts["memory_compress"] == 2
+
+
+def test_submit_during_retry_wait_is_ignored(monkeypatch):
+    manager = _setup(DeterministicChatModel())
+    worker = _worker()
+    runs = []
+    store = manager.store_compressed_memory
+
+    def store_failing_once(character_id, *args):
+        runs.append(character_id)
+        if len(runs) == 1:
+            raise RuntimeError("ChromaDB写入失败")
+        store(character_id, *args)
+
+    monkeypatch.setattr(manager, "store_compressed_memory", store_failing_once)
+
+    async def run():
+        await worker.start()
+        worker.submit(manager, NPC_ID)
+        while not worker._retry_handles:
+            await _sleep(0.001)
+        # 等待重试期间再次提交不会产生第二个任务
+        worker.submit(manager, NPC_ID)
+        assert worker._queue.qsize() == 0
+        await _drain(worker)
+        await worker.stop()
+
+    asyncio.run(run())
+
+    assert runs == [NPC_ID, NPC_ID]
+    assert len(_long_term_documents(manager)) == 1
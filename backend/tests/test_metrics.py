@@ -0,0 +1,162 @@
+# test_metrics.py
+"""
+耗时与提示词指标（metrics）：记录、概要、Prometheus文本格式，以及LLM回调对调用耗时、提示词token数和服务商用量的记录。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import threading
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+import metrics as metrics_module
+from benchmark.offline import DeterministicChatModel
+from metrics import LatencyMetric, Metrics, PrefixCacheMetric, ValueMetric, _provider_cache_usage, metrics
+
+
+def test_latency_metric_counts_errors_and_quantiles():
+    metric = LatencyMetric("trpg_test", "测试", ("node",))
+    for ms in range(1, 101):
+        metric.observe(ms / 1000, "a")
+    with pytest.raises(ValueError):
+        with metric.time("b"):
+            raise ValueError("失败")
+
+    snapshot = metric.snapshot()
+    assert snapshot["a"]["count"] == 100 and snapshot["a"]["errors"] == 0
+    assert (snapshot["a"]["p50_ms"], snapshot["a"]["p95_ms"], snapshot["a"]["max_ms"]) == (51.0, 95.0, 100.0)
+    assert snapshot["b"]["count"] == 1 and snapshot["b"]["errors"] == 1
+
+
+def test_latency_metric_renders_prometheus_text():
+    metric = LatencyMetric("trpg_test", "测试", ("node",), buckets=(0.01, 0.1))
+    metric.observe(0.005, "a")
+    metric.observe(0.05, "a", error=True)
+
+    lines = metric.render()
+    assert 'trpg_test_seconds_bucket{node="a",le="0.01"} 1' in lines
+    assert 'trpg_test_seconds_bucket{node="a",le="0.1"} 2' in lines
+    assert 'trpg_test_seconds_bucket{node="a",le="+Inf"} 2' in lines
+    assert 'trpg_test_seconds_count{node="a"} 2' in lines
+    assert 'trpg_test_calls_total{node="a"} 2' in lines
+    assert 'trpg_test_errors_total{node="a"} 1' in lines
+    assert 'trpg_test_latency_seconds{node="a",quantile="0.95"} 0.05' in lines
+
+
+def test_label_values_are_escaped():
+    metric = ValueMetric("trpg_test_tokens", "测试", ("operation",))
+    metric.observe(3, 'a"b\\c\nd')
+
+    assert 'trpg_test_tokens_count{operation="a\\"b\\\\c\\nd"} 1' in metric.render()
+
+
+def test_value_metric_tracks_max_and_average():
+    metric = ValueMetric("trpg_test_tokens", "测试", ("operation",))
+    for value in (10, 30, 20):
+        metric.observe(value, "npc_reaction")
+
+    assert metric.snapshot()["npc_reaction"] == {"count": 3, "avg": 20.0, "max": 30, "p50": 20, "p95": 30, "p99": 30}
+    assert 'trpg_test_tokens_max{operation="npc_reaction"} 30' in metric.render()
+
+
+def test_prefix_cache_hits_within_ttl(monkeypatch):
+    metric = PrefixCacheMetric("trpg_test_prompt", "测试")
+    clock = iter([0.0, 10.0, 10.0, 500.0])
+    monkeypatch.setattr(metrics_module.time, "monotonic", lambda: next(clock))
+
+    assert metric.observe_prefix("npc_reaction", "系统提示词") is False
+    assert metric.observe_prefix("npc_reaction", "系统提示词") is True
+    assert metric.observe_prefix("intent_parse", "系统提示词") is False
+    # 超过 PROMPT_PREFIX_CACHE_TTL（默认300秒）后视为未命中
+    assert metric.observe_prefix("npc_reaction", "系统提示词") is False
+    metric.observe_usage("npc_reaction", 1000, 600)
+
+    snapshot = metric.snapshot()["npc_reaction"]
+    assert (snapshot["prefix_hits"], snapshot["prefix_misses"], snapshot["prefix_hit_rate"]) == (1, 2, 0.333)
+    assert (snapshot["input_tokens"], snapshot["cached_tokens"], snapshot["cached_token_ratio"]) == (1000, 600, 0.6)
+
+
+def test_reset_clears_every_metric():
+    registry = Metrics()
+    registry.turns.observe(0.1, "/api/chat")
+    registry.prompt_tokens.observe(10, "npc_reaction")
+    registry.prompt_cache.observe_usage("npc_reaction", 10, 0)
+    registry.reset()
+
+    assert all(not section for section in registry.snapshot().values())
+
+
+def _llm_result(message: AIMessage = None, llm_output: dict = None) -> LLMResult:
+    generations = [[ChatGeneration(message=message)]] if message else [[]]
+    return LLMResult(generations=generations, llm_output=llm_output)
+
+
+def test_provider_usage_from_message_or_llm_output():
+    message = AIMessage(content="{}", usage_metadata={
+        "input_tokens": 120, "output_tokens": 5, "total_tokens": 125, "input_token_details": {"cache_read": 64}})
+    legacy = {"token_usage": {"prompt_tokens": 80, "prompt_tokens_details": {"cached_tokens": 32}}}
+
+    assert _provider_cache_usage(_llm_result(message)) == (120, 64)
+    assert _provider_cache_usage(_llm_result(llm_output=legacy)) == (80, 32)
+    assert _provider_cache_usage(_llm_result()) is None
+
+
+class UsageFreeChatModel(DeterministicChatModel):
+    """不返回 usage_metadata 的替身模型，模拟不报告用量的服务商"""
+    def _result(self, operation, messages):
+        result = super()._result(operation, messages)
+        for generation in result.generations:
+            generation.message.usage_metadata = None
+        return result
+
+
+def _invoke_twice(model, messages):
+    async def run():
+        for _ in range(2):
+            await model.ainvoke(messages, config={"metadata": {"llm_operation": "intent_parse"}})
+
+    asyncio.run(run())
+
+
+def _count_tokenizer_calls(monkeypatch) -> list:
+    calls = []
+    count_message_tokens = metrics_module.count_message_tokens
+
+    def counting(messages):
+        calls.append(threading.current_thread())
+        return count_message_tokens(messages)
+
+    monkeypatch.setattr(metrics_module, "count_message_tokens", counting)
+    return calls
+
+
+PROMPT = [SystemMessage(content="你是一个COC跑团的指令解析器。"), HumanMessage(content="检查挂坠")]
+
+
+def test_llm_callback_uses_provider_usage_for_prompt_tokens(monkeypatch):
+    calls = _count_tokenizer_calls(monkeypatch)
+    metrics.reset()
+
+    _invoke_twice(DeterministicChatModel(callbacks=[metrics_module.llm_metrics_handler]), PROMPT)
+
+    snapshot = metrics.snapshot()
+    input_tokens = snapshot["prompt_cache"]["intent_parse"]["input_tokens"]
+    assert snapshot["dependencies"]["llm/intent_parse"]["count"] == 2
+    assert snapshot["prompt_tokens"]["intent_parse"]["count"] == 2
+    assert snapshot["prompt_tokens"]["intent_parse"]["max"] * 2 == input_tokens > 0
+    assert snapshot["prompt_cache"]["intent_parse"]["prefix_hits"] == 1
+    assert calls == []
+
+
+def test_llm_callback_counts_tokens_off_the_loop_without_usage(monkeypatch):
+    calls = _count_tokenizer_calls(monkeypatch)
+    metrics.reset()
+
+    _invoke_twice(UsageFreeChatModel(callbacks=[metrics_module.llm_metrics_handler]), PROMPT)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["prompt_tokens"]["intent_parse"]["count"] == 2
+    assert snapshot["prompt_cache"]["intent_parse"]["input_tokens"] == 0
+    assert len(calls) == 2 and threading.main_thread() not in calls
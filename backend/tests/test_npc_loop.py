@@ -0,0 +1,83 @@
+# test_npc_loop.py
+"""
+并发模式下的NPC循环：前序NPC的公开反应必须出现在后面NPC的提示词中（与串行模式一致），
+以及可选的 NPC_LOOP_RELEVANCE_RERUN 模式下的LLM调用次数。
+在离线替身（确定性模型、fakeredis、数据库副本）上运行，用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+from typing import List
+
+from pydantic import Field
+
+from benchmark.offline import DeterministicChatModel, offline_backend
+
+NPC_IDS = ["amelia_weber", "sam_kelhan", "mary_lake"]
+
+
+class RecordingChatModel(DeterministicChatModel):
+    """记录每次NPC反应调用的用户消息"""
+    npc_prompts: List[str] = Field(default_factory=list)
+
+    def _result(self, operation, messages):
+        if operation == "npc_reaction":
+            self.npc_prompts.append(messages[-1].content)
+        return super()._result(operation, messages)
+
+
+def _public_reaction(dialogue: str):
+    return {"visibility": "public", "dialogue": dialogue, "action": "看了看四周",
+            "new_status": "警觉", "new_goal": "观察局势"}
+
+
+async def _run_npc_loop(model: DeterministicChatModel, relevance_rerun: bool = False, dialogue=None):
+    """dialogue 为 None 时使用模型已有的回复，否则按本回合NPC列表生成所有NPC共用的公开台词"""
+    async with offline_backend(model):
+        import graph
+        from databaseManager import db_manager
+        from redis_manager import asave_character_sheet
+        graph.NPC_LOOP_CONCURRENT = True
+        graph.NPC_LOOP_RELEVANCE_RERUN = relevance_rerun
+        for npc_id in NPC_IDS:
+            await asave_character_sheet(npc_id, db_manager.get_character_data(npc_id))
+        npc_infos = await graph._load_npc_infos(NPC_IDS)
+        if dialogue:
+            model.responses["npc_reaction"] = _public_reaction(dialogue(npc_infos))
+        state = graph.AgentState(
+            player_input="大家好", character_id="", session_state={}, turn_context_summary="玩家说：大家好\n",
+            active_npcs=npc_infos, triggered_event=None, npc_reactions=[], npc_reactions_info=[], npc_memories={}
+        )
+        await graph.npc_loop_agent(state)
+        return state['npc_reactions']
+
+
+def test_public_reactions_reach_later_npcs():
+    model = RecordingChatModel(responses={"npc_reaction": _public_reaction("今晚的雾真大。")})
+    reactions = asyncio.run(_run_npc_loop(model))
+
+    assert len(reactions) == len(NPC_IDS)
+    # 第一个NPC采用并行生成的反应，后面的NPC都要带着前序的公开反应重新生成
+    assert model.call_counts["npc_reaction"] == 2 * len(NPC_IDS) - 1
+    last_prompt = model.npc_prompts[-1]
+    for reaction in reactions[:-1]:
+        assert f"{reaction['npc_name']}说：“今晚的雾真大。”" in last_prompt
+
+
+def test_relevance_rerun_skips_unaddressed_npcs():
+    model = DeterministicChatModel(responses={"npc_reaction": _public_reaction("我注意到了。")})
+    reactions = asyncio.run(_run_npc_loop(model, relevance_rerun=True))
+
+    assert len(reactions) == len(NPC_IDS)
+    assert model.call_counts["npc_reaction"] == len(NPC_IDS)
+
+
+def test_relevance_rerun_regenerates_addressed_npcs():
+    model = DeterministicChatModel()
+    # 每个反应都点名所有NPC：除第一个行动的NPC外，其余NPC都要带着前序反应重新生成
+    reactions = asyncio.run(_run_npc_loop(
+        model, relevance_rerun=True,
+        dialogue=lambda infos: "、".join(npc['name'] for npc in infos) + "，你们听到了吗？"))
+
+    assert len(reactions) == len(NPC_IDS)
+    assert model.call_counts["npc_reaction"] == 2 * len(NPC_IDS) - 1
@@ -0,0 +1,64 @@
+# test_player_action_parser.py
+"""
+规则意图解析（fast_parse_player_action / rule_parse_player_action）的命中与交给LLM的情况。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import pytest
+
+from player_action_parser import fast_parse_player_action, rule_parse_player_action
+
+OBJECTS = [
+    {"object_id": 101, "object_name": "调查员的车"},
+    {"object_id": 102, "object_name": "古老的金币式挂坠"},
+]
+MAPS = [
+    {"id": 2, "map_name": "加油站咖啡馆"},
+    {"id": 3, "map_name": "前往阿卡姆市区方向的道路"},
+]
+
+HITS = [
+    ("检查挂坠", {"intent": "inspect", "target": "古老的金币式挂坠"}),
+    ("我要检查一下挂坠", {"intent": "inspect", "target": "古老的金币式挂坠"}),
+    ("看看挂坠。", {"intent": "inspect", "target": "古老的金币式挂坠"}),
+    ("查看调查员的车", {"intent": "inspect", "target": "调查员的车"}),
+    ("拿起挂坠", {"intent": "take", "target": "古老的金币式挂坠"}),
+    ("我想使用调查员的车", {"intent": "use", "target": "调查员的车"}),
+    ("去加油站咖啡馆吧", {"intent": "move", "target": "加油站咖啡馆", "target_location_id": 2}),
+    ("我要回阿卡姆", {"intent": "move", "target": "前往阿卡姆市区方向的道路", "target_location_id": 3}),
+    ("前往加油站", {"intent": "move", "target": "加油站咖啡馆", "target_location_id": 2}),
+]
+
+DEFERRALS = [
+    "观察挂坠",                # 可能需要技能检定
+    "我想仔细看看这个挂坠",     # 修饰语
+    "用车钥匙打开车门",         # 目标不是单个已知实体
+    "看起来雨越来越大了",       # "看"不是指令
+    "这个挂坠好看吗",           # 动词不在句首
+    "我去问问她",               # 对话
+    "挂坠",                     # 没有指令动词
+    "检查",                     # 没有目标
+    "检查桌子",                 # 未知目标
+    "去阿卡姆和加油站",         # 多个目标
+    "拿挂坠然后去加油站咖啡馆",  # 多个动作
+    "尝试回忆附近有什么地方",
+    "上车避雨吧",
+]
+
+
+@pytest.mark.parametrize("player_input, expected", HITS)
+def test_rule_parse_hits(player_input, expected):
+    assert rule_parse_player_action(player_input, OBJECTS, MAPS) == expected
+
+
+@pytest.mark.parametrize("player_input", DEFERRALS)
+def test_rule_parse_defers_to_llm(player_input):
+    assert rule_parse_player_action(player_input, OBJECTS, MAPS) is None
+
+
+def test_partial_name_match_confidence_and_ambiguity():
+    # "阿卡姆" 只是地图名称的一部分：置信度 0.9，仍高于默认阈值
+    assert fast_parse_player_action("去阿卡姆", OBJECTS, MAPS)["confidence"] == 0.9
+    # 两个候选同等匹配时视为有歧义
+    maps = MAPS + [{"id": 1, "map_name": "离开阿卡姆的一条郊外公路"}]
+    assert fast_parse_player_action("去阿卡姆", OBJECTS, maps) is None
@@ -0,0 +1,99 @@
+# test_prompt_budget.py
+"""
+提示词token预算（prompt_budget）：单段截断、按行裁剪和多片段按优先级裁剪的顺序。
+使用估算计数（中日韩字符1个token，其余约4个字符1个token），结果不依赖能否下载 tiktoken 编码。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import pytest
+
+import prompt_budget
+from prompt_budget import TRUNCATION_MARK, PromptSection, count_tokens, fit_sections, truncate_lines, truncate_text
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    monkeypatch.setattr(prompt_budget, "_encoding_loaded", True)
+    monkeypatch.setattr(prompt_budget, "_encoding", None)
+
+
+def _lines(prefix: str, count: int) -> str:
+    """count 行，prefix 为两个汉字时每行 4 个token（3个汉字 + 4个其他字符），整段的token数等于各行之和"""
+    return "".join(f"{prefix}{'一二三四五六七八九十'[i]}abc\n" for i in range(count))
+
+
+def _head(text: str, count: int) -> str:
+    return "".join(text.splitlines(keepends=True)[:count])
+
+
+def _tail(text: str, count: int) -> str:
+    return "".join(text.splitlines(keepends=True)[-count:])
+
+
+def test_estimated_counts():
+    assert count_tokens("") == 0
+    assert count_tokens("雾很大") == 3
+    assert count_tokens("abcdefgh") == 2
+    assert count_tokens(_lines("记忆", 3)) == 12
+
+
+def test_truncate_text_keeps_head_or_tail():
+    text = "一二三四五六七八九十"
+    mark_tokens = count_tokens(TRUNCATION_MARK)
+
+    assert truncate_text(text, 20) == text
+    assert truncate_text(text, 0) == ""
+    assert truncate_text(text, mark_tokens + 3) == "一二三" + TRUNCATION_MARK
+    assert truncate_text(text, mark_tokens + 3, keep="tail") == TRUNCATION_MARK + "八九十"
+
+
+def test_truncate_lines_drops_whole_lines():
+    text = _lines("记忆", 4)
+
+    assert truncate_lines(text, 16) == text
+    assert truncate_lines(text, 11) == _head(text, 2)
+    assert truncate_lines(text, 11, keep="tail") == _tail(text, 2)
+    # 第一行本身就超出预算时按token截断
+    assert truncate_lines(text, 3).endswith(TRUNCATION_MARK)
+
+
+def test_section_limits_apply_before_the_total_budget():
+    texts, report = fit_sections([
+        PromptSection("memories", _lines("记忆", 4), max_tokens=8, keep="tail"),
+        PromptSection("scene", _lines("情景", 2)),
+    ], total_tokens=100)
+
+    assert texts == [_tail(_lines("记忆", 4), 2), _lines("情景", 2)]
+    assert report == {"tokens": 16, "trimmed": ["memories"]}
+
+
+def test_overflow_is_trimmed_from_lowest_priority_first():
+    sections = [
+        PromptSection("public", _lines("公开", 4), priority=3),
+        PromptSection("perception", _lines("察觉", 4), priority=2),
+        PromptSection("memories", _lines("记忆", 4), priority=1, keep="tail"),
+        PromptSection("others", _lines("其他", 4), priority=0),
+    ]
+
+    # 共 64 个token，超出 8 个：只裁剪优先级最低的片段
+    texts, report = fit_sections(sections, total_tokens=56)
+    assert report == {"tokens": 56, "trimmed": ["others"]}
+    assert texts[:3] == [section.text for section in sections[:3]]
+    assert texts[3] == _head(sections[3].text, 2)
+
+    # 超出 24 个token：最低优先级的片段裁空后继续裁剪下一个，记忆保留最近的几行
+    texts, report = fit_sections(sections, total_tokens=40)
+    assert report == {"tokens": 40, "trimmed": ["others", "memories"]}
+    assert texts[3] == ""
+    assert texts[2] == _tail(sections[2].text, 2)
+    assert texts[:2] == [sections[0].text, sections[1].text]
+
+
+def test_equal_priority_trims_later_sections_first():
+    texts, report = fit_sections([
+        PromptSection("first", _lines("甲方", 2)),
+        PromptSection("second", _lines("乙方", 2)),
+    ], total_tokens=12)
+
+    assert report == {"tokens": 12, "trimmed": ["second"]}
+    assert texts == [_lines("甲方", 2), _head(_lines("乙方", 2), 1)]
@@ -0,0 +1,148 @@
+# test_redis_state.py
+"""
+redis_manager 的对话历史列表和状态变更（HINCRBY/HSET），在 fakeredis 上运行。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from benchmark.offline import install_fake_redis
+
+HISTORY_KEY = "conversation_history:p1"
+SESSION_KEY = "session_state:p1"
+
+
+@pytest.fixture
+def redis_client():
+    from redis_manager import get_redis_client
+    install_fake_redis()
+    return get_redis_client()
+
+
+def _messages(start: int, count: int) -> list:
+    return [{"role": "user", "content": f"消息{i}"} for i in range(start, start + count)]
+
+
+# --- 对话历史 ---
+def test_history_appends_and_reads_recent_window(redis_client):
+    from redis_manager import append_conversation_messages, get_conversation_history
+
+    append_conversation_messages("p1", _messages(0, 3))
+    append_conversation_messages("p1", _messages(3, 2))
+
+    assert get_conversation_history("p1") == _messages(0, 5)
+    assert get_conversation_history("p1", limit=2) == _messages(3, 2)
+    assert redis_client.ttl(HISTORY_KEY) > 0
+
+
+def test_history_is_trimmed_to_max_length(redis_client, monkeypatch):
+    import redis_manager
+    monkeypatch.setattr(redis_manager, "CONVERSATION_HISTORY_MAX_LENGTH", 3)
+
+    redis_manager.append_conversation_messages("p1", _messages(0, 2))
+    redis_manager.append_conversation_messages("p1", _messages(2, 2))
+
+    assert redis_manager.get_conversation_history("p1") == _messages(1, 3)
+
+
+def test_legacy_json_history_is_converted_on_read(redis_client):
+    from redis_manager import aget_conversation_history, get_conversation_history
+
+    redis_client.set(HISTORY_KEY, json.dumps(_messages(0, 4), ensure_ascii=False))
+
+    assert asyncio.run(aget_conversation_history("p1", limit=3)) == _messages(1, 3)
+    assert redis_client.type(HISTORY_KEY) == "list"
+    assert get_conversation_history("p1") == _messages(0, 4)
+
+
+def test_turn_snapshot_appends_only_new_messages(redis_client):
+    from redis_manager import aappend_conversation_messages, aload_turn_snapshot, asave_turn_snapshot, turn_cache
+
+    async def run():
+        await aappend_conversation_messages("p1", _messages(0, 12))
+        with turn_cache():
+            snapshot = await aload_turn_snapshot("p1")
+            await asave_turn_snapshot("p1", snapshot['world_state'], 1, snapshot['map_state'],
+                                      snapshot['session_state'], _messages(12, 2), [])
+        return snapshot['conversation_history']
+
+    window = asyncio.run(run())
+
+    assert window == _messages(2, 10)
+    assert redis_client.llen(HISTORY_KEY) == 14
+
+
+# --- 状态变更 ---
+def _apply(player_character_id: str, changes: list):
+    from redis_manager import aapply_state_changes
+    return asyncio.run(aapply_state_changes(player_character_id, changes))
+
+
+def test_state_changes_increment_and_set_fields(redis_client):
+    from redis_manager import get_session_state, save_session_state
+    save_session_state("p1", {"hp": 10, "sanity": 50, "current_map_id": 1})
+
+    changed = _apply("p1", [
+        {"target": "player", "attribute_id": 13, "change": -3},
+        {"target": "player", "attribute_id": 10, "change": "-5", "set_state": {"status": "受伤"}},
+    ])
+
+    assert changed == {"p1": {"hp": 7, "sanity": 45, "status": "受伤"}}
+    assert get_session_state("p1") == {"hp": 7, "sanity": 45, "current_map_id": 1, "status": "受伤"}
+
+
+def test_concurrent_increments_are_not_lost(redis_client):
+    from redis_manager import aapply_state_changes, get_session_state, save_session_state
+    save_session_state("p1", {"hp": 10})
+
+    async def run():
+        await asyncio.gather(*[
+            aapply_state_changes("p1", [{"target": "player", "attribute_id": 13, "change": -1}]) for _ in range(5)
+        ])
+
+    asyncio.run(run())
+
+    assert get_session_state("p1")["hp"] == 5
+
+
+def test_uninitialized_targets_start_from_character_sheet(redis_client):
+    from databaseManager import db_manager
+    from redis_manager import get_session_state, initial_session_from_sheet
+
+    changed = _apply("p1", [
+        {"target": "amelia_weber", "attribute_id": 13, "change": -2},
+        {"target": "unknown_npc", "attribute_id": 13, "change": -2},
+    ])
+
+    initial = initial_session_from_sheet(db_manager.get_character_data("amelia_weber"))
+    assert changed == {"amelia_weber": {"hp": initial["hp"] - 2}}
+    assert get_session_state("amelia_weber") == dict(initial, hp=initial["hp"] - 2)
+    # 无法加载角色数据的目标被跳过，不会留下只有一个字段的 session
+    assert redis_client.exists("session_state:unknown_npc") == 0
+
+
+def test_legacy_json_session_is_converted_before_increment(redis_client):
+    from redis_manager import get_session_state
+    redis_client.set(SESSION_KEY, json.dumps({"hp": 10, "current_map_id": 2}))
+
+    changed = _apply("p1", [{"target": "player", "attribute_id": 13, "change": 4}])
+
+    assert changed == {"p1": {"hp": 14}}
+    assert redis_client.type(SESSION_KEY) == "hash"
+    assert get_session_state("p1") == {"hp": 14, "current_map_id": 2}
+
+
+def test_state_changes_refresh_the_turn_cache(redis_client):
+    from redis_manager import aapply_state_changes, aget_session_state, save_session_state, turn_cache
+    save_session_state("p1", {"hp": 10})
+
+    async def run():
+        with turn_cache():
+            await aget_session_state("p1")
+            await aapply_state_changes("p1", [{"target": "player", "attribute_id": 13, "change": -4}])
+            return await aget_session_state("p1")
+
+    assert asyncio.run(run()) == {"hp": 6}
@@ -0,0 +1,138 @@
+# test_turn_cache.py
+"""
+回合内的Redis读缓存（redis_manager.turn_cache）：命中/未命中、写入时更新、作用域结束后失效，在 fakeredis 上运行。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from benchmark.offline import install_fake_redis
+
+
+@pytest.fixture
+def redis_client():
+    from redis_manager import get_redis_client
+    install_fake_redis()
+    redis_client = get_redis_client()
+    redis_client.set("world_state", json.dumps({"weather": "雾"}, ensure_ascii=False))
+    return redis_client
+
+
+def _count_commands(monkeypatch) -> list:
+    """记录同步客户端发出的命令名"""
+    from redis_manager import get_redis_client
+    redis_client = get_redis_client()
+    commands = []
+    execute_command = redis_client.execute_command
+
+    def counting(*args, **kwargs):
+        commands.append(str(args[0]).lower())
+        return execute_command(*args, **kwargs)
+
+    monkeypatch.setattr(redis_client, "execute_command", counting)
+    return commands
+
+
+def test_reads_hit_the_cache_within_a_turn(redis_client, monkeypatch):
+    from redis_manager import get_world_state, turn_cache
+    commands = _count_commands(monkeypatch)
+
+    with turn_cache() as cache:
+        first = get_world_state()
+        first["weather"] = "雨"  # 调用方修改返回值不影响缓存
+        second = get_world_state()
+
+    assert second == {"weather": "雾"}
+    assert commands == ["get"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_missing_keys_are_cached_too(redis_client, monkeypatch):
+    from redis_manager import get_completed_event_ids, turn_cache
+    commands = _count_commands(monkeypatch)
+
+    with turn_cache() as cache:
+        assert get_completed_event_ids("p1") == []
+        assert get_completed_event_ids("p1") == []
+
+    assert commands == ["get"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_writes_update_the_cache(redis_client, monkeypatch):
+    from redis_manager import get_world_state, save_world_state, turn_cache
+
+    with turn_cache() as cache:
+        get_world_state()
+        save_world_state({"weather": "晴"})
+        commands = _count_commands(monkeypatch)
+        assert get_world_state() == {"weather": "晴"}
+
+    assert commands == []
+    assert cache.hits == 1
+
+
+def test_cache_is_dropped_when_the_turn_ends(redis_client):
+    from redis_manager import get_world_state, turn_cache
+
+    with turn_cache():
+        assert get_world_state() == {"weather": "雾"}
+        # 其他进程在回合中途写入，本回合仍看到开始时读取的值
+        redis_client.set("world_state", json.dumps({"weather": "雪"}, ensure_ascii=False))
+        assert get_world_state() == {"weather": "雾"}
+
+    assert get_world_state() == {"weather": "雪"}
+    with turn_cache():
+        assert get_world_state() == {"weather": "雪"}
+
+
+def test_no_caching_outside_a_turn(redis_client, monkeypatch):
+    from redis_manager import get_world_state
+    commands = _count_commands(monkeypatch)
+
+    get_world_state()
+    get_world_state()
+
+    assert commands == ["get", "get"]
+
+
+def test_mget_fetches_only_uncached_keys(redis_client):
+    from redis_manager import aget_character_sheet, aget_character_sheets, asave_character_sheet, turn_cache
+
+    async def run():
+        await asave_character_sheet("amelia_weber", {"name": "艾米利亚"})
+        with turn_cache() as cache:
+            await aget_character_sheet("amelia_weber")
+            sheets = await aget_character_sheets(["amelia_weber", "sam_kelhan", "amelia_weber"])
+            return sheets, cache.hits, cache.misses
+
+    sheets, hits, misses = asyncio.run(run())
+
+    assert sheets == {"amelia_weber": {"name": "艾米利亚"}, "sam_kelhan": {}}
+    # 第一次读取未命中；MGET 时 amelia_weber 两次命中，只有 sam_kelhan 需要读取
+    assert (hits, misses) == (2, 2)
+
+
+def test_child_tasks_share_the_turn_cache_and_turns_are_isolated(redis_client):
+    from redis_manager import aget_world_state, turn_cache
+
+    async def turn(weather_seen: list):
+        with turn_cache() as cache:
+            weather_seen.append((await aget_world_state())["weather"])
+            await asyncio.gather(aget_world_state(), asyncio.create_task(aget_world_state()))
+            return cache.hits, cache.misses
+
+    async def run():
+        seen = []
+        first = await turn(seen)
+        redis_client.set("world_state", json.dumps({"weather": "雪"}, ensure_ascii=False))
+        second = await turn(seen)
+        return seen, first, second
+
+    seen, first, second = asyncio.run(run())
+
+    assert seen == ["雾", "雪"]
+    assert first == second == (2, 1)
@@ -0,0 +1,186 @@
+# test_turn_snapshot.py
+"""
+回合快照的读取与写回（redis_manager），在 fakeredis 上运行。用法（backend目录下）:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import json
+
+from benchmark.offline import install_fake_redis
+
+MAP_KEY = "map_state:1"
+
+
+def _seed_shared_state():
+    from redis_manager import get_redis_client
+    redis_client = get_redis_client()
+    redis_client.set("world_state", json.dumps({"weather": "雾", "clock": "20:00"}, ensure_ascii=False))
+    redis_client.set(MAP_KEY, json.dumps({
+        "npcs": ["amelia_weber"], "accessible_maps": [2],
+        "objects": {"door": {"state": "closed"}, "lamp": {"state": "off"}},
+    }, ensure_ascii=False))
+    return redis_client
+
+
+async def _turn(character_id: str, loaded: asyncio.Event, proceed: asyncio.Event, change):
+    """读取快照后等待 proceed，再修改并写回，模拟与其他回合交错执行"""
+    from redis_manager import aload_turn_snapshot, asave_turn_snapshot, turn_cache
+    with turn_cache():
+        snapshot = await aload_turn_snapshot(character_id)
+        loaded.set()
+        await proceed.wait()
+        change(snapshot['world_state'], snapshot['map_state'])
+        await asave_turn_snapshot(character_id, snapshot['world_state'], 1, snapshot['map_state'],
+                                  snapshot['session_state'], [], [])
+
+
+def _first_turn(world_state, map_state):
+    world_state["clock"] = "21:00"
+    map_state["objects"]["door"]["state"] = "open"
+
+
+def _second_turn(world_state, map_state):
+    world_state["weather"] = "雨"
+    map_state["objects"]["lamp"]["state"] = "on"
+    map_state["npcs"].append("sam_kelhan")
+
+
+async def _interleaved_turns():
+    install_fake_redis()
+    redis_client = _seed_shared_state()
+    events = [(asyncio.Event(), asyncio.Event()) for _ in range(2)]
+    tasks = [asyncio.create_task(_turn(character_id, loaded, proceed, change))
+             for character_id, (loaded, proceed), change in zip(["p1", "p2"], events, [_first_turn, _second_turn])]
+    # 两个回合都读取完快照后，先让第一个回合写回，再让第二个回合写回
+    await asyncio.gather(*(loaded.wait() for loaded, _ in events))
+    events[0][1].set()
+    await tasks[0]
+    events[1][1].set()
+    await tasks[1]
+    return json.loads(redis_client.get("world_state")), json.loads(redis_client.get(MAP_KEY))
+
+
+def test_interleaved_turns_keep_both_shared_state_updates():
+    world_state, map_state = asyncio.run(_interleaved_turns())
+
+    assert world_state == {"weather": "雨", "clock": "21:00"}
+    assert map_state["objects"] == {"door": {"state": "open"}, "lamp": {"state": "on"}}
+    assert map_state["npcs"] == ["amelia_weber", "sam_kelhan"]
+    assert map_state["accessible_maps"] == [2]
+
+
+def test_shared_state_patch_applies_only_changed_keys():
+    from redis_manager import _apply_patch, _dict_patch
+    previous = {"a": 1, "b": {"x": 1, "y": 2}, "c": [1]}
+    patch = _dict_patch(previous, {"a": 1, "b": {"x": 1, "y": 3}, "d": True})
+
+    assert _apply_patch({"a": 5, "b": {"x": 9, "y": 2}, "c": [1, 2], "e": 0}, patch) == \
+        {"a": 5, "b": {"x": 9, "y": 3}, "d": True, "e": 0}
+    assert _dict_patch(previous, json.loads(json.dumps(previous))) == {}
+
+
+def _set_event() -> asyncio.Event:
+    event = asyncio.Event()
+    event.set()
+    return event
+
+
+async def _turn_with_write_during_merge(monkeypatch):
+    import redis_manager
+    install_fake_redis()
+    redis_client = _seed_shared_state()
+    merge = redis_manager._merge_shared_state
+    calls = []
+
+    def merge_with_concurrent_write(patches, current, map_id):
+        # WATCH 之后、EXEC 之前另一个回合写入世界状态，事务应失败并基于最新值重新合并
+        if not calls:
+            redis_client.set("world_state", json.dumps({"weather": "雾", "clock": "20:00", "alarm": True}))
+        calls.append(current)
+        return merge(patches, current, map_id)
+
+    monkeypatch.setattr(redis_manager, "_merge_shared_state", merge_with_concurrent_write)
+    await _turn("p1", asyncio.Event(), _set_event(), _first_turn)
+    return calls, json.loads(redis_client.get("world_state"))
+
+
+def test_write_between_watch_and_exec_is_retried(monkeypatch):
+    calls, world_state = asyncio.run(_turn_with_write_during_merge(monkeypatch))
+
+    assert len(calls) == 2
+    assert world_state == {"weather": "雾", "clock": "21:00", "alarm": True}
+
+
+async def _session_writer(character_id: str, loaded: asyncio.Event, proceed: asyncio.Event, fields: dict):
+    """在自己的回合缓存中读取 session，等待 proceed 后修改部分字段并整体写回"""
+    from redis_manager import aget_session_state, asave_session_state, turn_cache
+    with turn_cache():
+        session = await aget_session_state(character_id)
+        loaded.set()
+        await proceed.wait()
+        session.update(fields)
+        await asave_session_state(character_id, session)
+
+
+async def _interleaved_session_writers():
+    from redis_manager import aapply_state_changes, aget_session_state, asave_session_state
+    install_fake_redis()
+    await asave_session_state("p1", {"hp": 10, "sanity": 50, "current_map_id": 1})
+    events = [(asyncio.Event(), asyncio.Event()) for _ in range(2)]
+    writers = [asyncio.create_task(_session_writer("p1", loaded, proceed, fields))
+               for (loaded, proceed), fields in zip(events, [{"current_map_id": 2}, {"pending_check_event_id": 7}])]
+    await asyncio.gather(*(loaded.wait() for loaded, _ in events))
+    # 两个写入方读取之后，事件又用 HINCRBY 修改了 hp
+    await aapply_state_changes("p1", [{"target": "player", "attribute_id": 13, "change": -3}])
+    for task, (_, proceed) in zip(writers, events):
+        proceed.set()
+        await task
+    return await aget_session_state("p1")
+
+
+def test_session_writers_changing_different_fields_both_survive():
+    session = asyncio.run(_interleaved_session_writers())
+
+    assert session == {"hp": 7, "sanity": 50, "current_map_id": 2, "pending_check_event_id": 7}
+
+
+async def _turn_on_map_without_state():
+    from redis_manager import aload_turn_snapshot, asave_session_state, asave_turn_snapshot, get_redis_client, turn_cache
+    install_fake_redis()
+    await asave_session_state("p1", {"current_map_id": 2})
+    with turn_cache():
+        snapshot = await aload_turn_snapshot("p1")
+        await asave_turn_snapshot("p1", snapshot['world_state'], 2, snapshot['map_state'],
+                                  snapshot['session_state'], [], [])
+    return snapshot['map_state'], json.loads(get_redis_client().get("map_state:2"))
+
+
+def test_missing_map_state_defaults_to_scenario_exits():
+    from scenario_catalog import scenario_catalog
+    loaded, saved = asyncio.run(_turn_on_map_without_state())
+    exits = scenario_catalog.static_accessible_maps(2)
+
+    assert exits
+    assert loaded == {"npcs": [], "objects": {}, "accessible_maps": exits}
+    # 写回后地图仍保留剧本设定的出口，而不是变成"已无出口"
+    assert saved["accessible_maps"] == exits
+
+
+def test_last_turn_map_ids_keep_only_recent_characters(monkeypatch):
+    import redis_manager
+    from redis_manager import get_redis_client, load_turn_snapshot, save_session_state
+    install_fake_redis()
+    monkeypatch.setattr(redis_manager, "TURN_MAP_ID_CACHE_SIZE", 2)
+    monkeypatch.setattr(redis_manager, "_last_turn_map_ids", type(redis_manager._last_turn_map_ids)())
+    get_redis_client().set("map_state:3", json.dumps({"npcs": ["sam_kelhan"], "objects": {}}))
+    for character_id in ("p1", "p2", "p3"):
+        save_session_state(character_id, {"current_map_id": 3})
+        load_turn_snapshot(character_id)
+    # p2 最近被读取过，淘汰的是最久未使用的 p1
+    load_turn_snapshot("p2")
+    load_turn_snapshot("p4")
+
+    assert list(redis_manager._last_turn_map_ids) == ["p2", "p4"]
+    # 被淘汰的角色按地图1预取，仍能读到所在地图的状态
+    assert load_turn_snapshot("p1")["map_state"]["npcs"] == ["sam_kelhan"]
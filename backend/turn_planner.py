@@ -0,0 +1,156 @@
+# turn_planner.py
+"""
+回合规划器（可选，TURN_PLANNER_ENABLED=true 开启）：
+用一次LLM调用同时完成 意图解析、NPC筛选 和 软性事件判断，
+替代编排节点中最多三次串行的LLM调用 (parse_player_action -> npc_filter -> soft_check_event_trigger)。
+规划失败或返回格式无效时返回 None，编排节点退回原有流程。
+"""
+
+import os
+import json
+from typing import Dict, Any, List, Optional
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+from llm_registry import get_llm
+from llm_cache import cached_ainvoke, is_json
+from event_engine import event_engine, format_events_for_prompt, soft_check_candidates
+from npc_filter import describe_npcs_for_selection
+from player_action_parser import build_intent_rules, aget_available_maps, rule_parse_player_action
+from log_manager import get_logger
+
+logger = get_logger("turn_planner")
+
+# 与软性判断一致：只接受高/中置信度的事件
+ACCEPTED_SOFT_CONFIDENCE = ("高", "中")
+
+
+class TurnPlanner:
+    def __init__(self):
+        self.enabled = os.getenv("TURN_PLANNER_ENABLED", "false").lower() in ("1", "true", "yes")
+
+    def _build_prompt(self, available_npcs: List[Dict[str, Any]], available_objects: List[Dict[str, Any]],
+                      available_maps: List[Dict[str, Any]], session_state: Dict[str, Any],
+                      selection_npcs: List[Dict[str, Any]], max_npcs: int, recent_npcs: List[str],
+                      soft_events: List[Dict[str, Any]]) -> str:
+        if selection_npcs:
+            recent_info = f"最近几轮已激活的NPC: {recent_npcs}" if recent_npcs else ""
+            selection_section = f"""
+        ## 任务二：选择需要做出反应的NPC (selected_npc_ids)
+        可用NPC列表:
+        {json.dumps(describe_npcs_for_selection(selection_npcs), ensure_ascii=False)}
+        {recent_info}
+        - 如果玩家明确指定交谈对象（如"问杰克"、"和玛丽说话"），只选择该NPC（1个）
+        - 如果玩家行动是面向所有人的（如"大家听我说"），选择多个相关NPC（最多{max_npcs}个）
+        - 如果玩家行动是观察或检查，选择最相关的1-2个NPC
+        - 如果最近几轮总是同样的NPC，优先选择其他NPC增加多样性
+        - 如果没有NPC需要对玩家行动做出反应，返回空列表
+        """
+        else:
+            selection_section = """
+        ## 任务二：selected_npc_ids 返回空列表
+        """
+
+        if soft_events:
+            soft_section = f"""
+        ## 任务三：软性事件判断 (soft_event)
+        当前状态: 地图ID={session_state.get('current_map_id')}, 载具ID={session_state.get('current_vehicle_id')}
+        可用事件列表:
+        {format_events_for_prompt(soft_events)}
+        - 只有当玩家行动与事件描述高度语义匹配、当前状态基本满足事件要求、且符合剧情逻辑时才给出事件
+        - 过于宽泛或存在明显不匹配的行动，soft_event 返回 null
+        - confidence 取值 高/中/低
+        """
+        else:
+            soft_section = """
+        ## 任务三：soft_event 返回 null
+        """
+
+        return f"""
+        你是一个COC跑团的回合规划器。根据玩家输入，一次性完成以下任务，并返回一个JSON对象。
+
+        ## 任务一：解析玩家意图 (player_action)
+        {build_intent_rules(available_npcs, available_objects, available_maps)}
+        {selection_section}
+        {soft_section}
+
+        返回格式:
+        {{"player_action": {{"intent": "...", ...}}, "selected_npc_ids": ["npc_id", ...], "soft_event": {{"event_id": 事件ID, "confidence": "高/中/低", "reason": "原因"}} 或 null}}
+
+        严格只返回JSON对象。
+        """
+
+    async def plan_turn(self, player_input: str, all_npcs: List[Dict[str, Any]],
+                        interactable_objects: List[Dict[str, Any]], session_state: Dict[str, Any],
+                        completed_events: List[int], selected_npcs: Optional[List[str]] = None,
+                        recent_npcs: Optional[List[str]] = None, max_npcs: int = 3) -> Optional[Dict[str, Any]]:
+        """
+        返回 {"player_action": {...}, "selected_npc_ids": [...] 或 None, "soft_event": 事件数据 或 None}。
+        selected_npc_ids 为 None 表示本回合不需要筛选（玩家已选择NPC或NPC数量不多）或规划未给出有效选择，
+        空列表表示本回合没有NPC需要反应。
+        """
+        current_map_id = session_state.get('current_map_id', 1)
+        available_maps = await aget_available_maps(current_map_id)
+        needs_selection = not selected_npcs and len(all_npcs) > max_npcs
+
+        soft_events = []
+        if not session_state.get('pending_check_event_id'):
+            soft_events = soft_check_candidates(event_engine.events_on_map(current_map_id), completed_events)
+
+        # 简单指令的意图由规则确定；若也不需要筛选且已有硬性事件命中（或没有可判断的事件），则无需调用LLM
+        fast_action = rule_parse_player_action(player_input, interactable_objects, available_maps)
+        if fast_action and not needs_selection:
+            probe_state = {'player_action': fast_action, 'session_state': session_state, 'completed_events': completed_events}
+            if not soft_events or await event_engine.acandidate_events(current_map_id, probe_state):
+                logger.info("[Planner] 规则解析即可完成本回合规划: %s", fast_action)
+                return {"player_action": fast_action, "selected_npc_ids": None, "soft_event": None}
+
+        system_prompt = self._build_prompt(
+            all_npcs, interactable_objects, available_maps, session_state,
+            all_npcs if needs_selection else [], max_npcs, recent_npcs or [], soft_events
+        )
+        messages = [SystemMessage(content=system_prompt), HumanMessage(content=f"玩家输入: {player_input}")]
+
+        try:
+            content = await cached_ainvoke("turn_plan", get_llm(temperature=0), messages, is_cacheable=is_json)
+            result = json.loads(content)
+        except Exception as e:
+            logger.warning("[Planner] 回合规划失败，退回逐项调用: %s", e)
+            return None
+
+        player_action = result.get('player_action') if isinstance(result, dict) else None
+        if not isinstance(player_action, dict) or not player_action.get('intent'):
+            logger.warning("[Planner] 回合规划缺少有效的 player_action，退回逐项调用: %s", content)
+            return None
+        if fast_action:
+            player_action = fast_action
+
+        selected_npc_ids = None
+        if needs_selection:
+            # 空列表是有效的选择（本回合没有NPC需要反应）；缺失、格式错误或全是未知ID时交给NPC筛选器
+            raw_ids = result.get('selected_npc_ids')
+            valid_ids = {npc.get('id') for npc in all_npcs}
+            if isinstance(raw_ids, list):
+                selected_npc_ids = [npc_id for npc_id in raw_ids if npc_id in valid_ids][:max_npcs]
+                if raw_ids and not selected_npc_ids:
+                    logger.warning("[Planner] 回合规划选择的NPC均不存在，改用NPC筛选器: %s", raw_ids)
+                    selected_npc_ids = None
+            else:
+                logger.warning("[Planner] 回合规划缺少有效的 selected_npc_ids，改用NPC筛选器: %s", raw_ids)
+
+        soft_event = None
+        soft_result = result.get('soft_event')
+        if isinstance(soft_result, dict) and soft_result.get('event_id') is not None:
+            if soft_result.get('confidence', '低') in ACCEPTED_SOFT_CONFIDENCE:
+                soft_event = next((e for e in soft_events if e['event_id'] == soft_result['event_id']), None)
+            else:
+                logger.info("[Planner] 软性事件置信度过低(%s)，不触发事件 %s", soft_result.get('confidence'), soft_result['event_id'])
+
+        plan = {"player_action": player_action, "selected_npc_ids": selected_npc_ids, "soft_event": soft_event}
+        logger.info("[Planner] 回合规划结果", action=player_action, npcs=selected_npc_ids,
+                    soft_event=soft_event['event_id'] if soft_event else None)
+        return plan
+
+
+# 创建全局实例
+turn_planner = TurnPlanner()
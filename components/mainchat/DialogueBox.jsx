@@ -2,7 +2,7 @@ import { useState } from "react";
 import axios from "axios";
 import ReactMarkdown from "react-markdown";
 
-export default function DialogueBox({ messages, setMessages, selectedNPCs = [] }) {
+export default function DialogueBox({ messages, setMessages, selectedNPCs = [], sessionToken = null }) {
   const [input, setInput] = useState("");
   const [loading, setLoading] = useState(false);
 
@@ -17,7 +17,8 @@ export default function DialogueBox({ messages, setMessages, selectedNPCs = [] }
     try {
       const response = await axios.post("/api/chat", {
         input,
-        selected_npcs: selectedNPCs
+        selected_npcs: selectedNPCs,
+        session_token: sessionToken
       });
 
       // 处理新的聊天格式
@@ -33,7 +33,7 @@ export default async function handler(req, res) {
     return res.status(405).json({ error: "Only POST requests are allowed" });
   }
 
-  const { input, selected_npcs } = req.body;
+  const { input, selected_npcs, session_token } = req.body;
   if (!input) {
     return res.status(400).json({ error: "Input is required." });
   }
@@ -49,7 +49,8 @@ export default async function handler(req, res) {
       },
       body: JSON.stringify({ 
         input, 
-        selected_npcs: selected_npcs || []  // 传递选中的NPC列表
+        selected_npcs: selected_npcs || [],  // 传递选中的NPC列表
+        session_token: session_token || null  // 会话令牌，决定本回合属于哪个玩家
       }),
     });
 
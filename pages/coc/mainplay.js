@@ -32,6 +32,9 @@ export default function MainPlay() {
   
   // 新增：NPC选择状态
   const [selectedNPCs, setSelectedNPCs] = useState([]);
+
+  // 后端会话令牌：每个玩家的回合在后端按会话独立执行
+  const [sessionToken, setSessionToken] = useState(null);
   
   // NPC选择回调函数
   const handleNPCSelect = (npcIds) => {
@@ -69,6 +72,7 @@ export default function MainPlay() {
           if (response.ok) {
             const data = await response.json();
             console.log('角色ID已发送到后端:', data);
+            setSessionToken(data.session_token || null);
           } else {
             console.error('发送角色ID到后端失败:', response.status);
           }
@@ -137,6 +141,7 @@ export default function MainPlay() {
                   messages={messages}
                   setMessages={setMessages}
                   selectedNPCs={selectedNPCs}
+                  sessionToken={sessionToken}
                 />
               </div>
             </div>